@@ -0,0 +1,60 @@
+"""
+Startup time benchmark for generated pipeline executables
+
+Compares the import time of the slim scoring runtime against the full
+ExecutionHelper, and optionally times complete runs of generated
+executables (for example one exported with executable_runtime 'slim',
+and one with 'full').
+
+Usage: python benchmark_startup.py [-n repeats] [executable [config.json]] ...
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORTS = {
+    'slim runtime': 'from dsbox.executer.runtime import PipelineRuntime',
+    'full runtime': 'from dsbox.executer.executionhelper import ExecutionHelper',
+}
+
+def time_command(command, repeats):
+    '''Returns the wall clock times of running the command in fresh processes'''
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call(command, cwd=CURDIR, stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return times
+
+def report(name, times):
+    times = sorted(times)
+    print("%-40s min %7.3fs  median %7.3fs  max %7.3fs" % (
+        name, times[0], times[len(times) // 2], times[-1]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pipeline executable startup benchmark')
+    parser.add_argument('-n', '--repeats', type=int, default=5)
+    parser.add_argument('executables', nargs='*',
+                        help='Generated executables, each optionally followed by its config json')
+    args = parser.parse_args(argv)
+
+    setup = "from dsbox_dev_setup import path_setup; path_setup(); "
+    for name, statement in sorted(IMPORTS.items()):
+        report("import " + name, time_command([sys.executable, '-c', setup + statement], args.repeats))
+
+    runs = []
+    for arg in args.executables:
+        if arg.endswith('.json') and runs:
+            runs[-1].append(arg)
+        else:
+            runs.append([arg])
+    for run in runs:
+        report(os.path.basename(run[0]), time_command([sys.executable] + run, args.repeats))
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ Created on Jan 23, 2018
 @author: kyao
 '''
 
-import numpy as np
 import typing
 
 from d3m_metadata import container, hyperparams, params
@@ -14,6 +13,8 @@ from sklearn.random_projection import johnson_lindenstrauss_min_dim, GaussianRan
 from primitive_interfaces.featurization import FeaturizationPrimitiveBase, CallResult
 from builtins import int
 
+from dsbox.schema.packed_series import PackedSeries
+
 Inputs = container.List[container.DataFrame]
 Outputs = container.ndarray
 
@@ -68,28 +69,24 @@ class RandomProjectionTimeSeriesFeaturization(FeaturizationPrimitiveBase[Inputs,
     def produce(self, *, inputs: Inputs, timeout: float = None, iterations: int = None) -> CallResult[Outputs]:
         if self._training_data is None or self._y_dim==0:
             return CallResult(None, True, 0)
-        if isinstance(inputs, np.ndarray): 
-            X = np.zeros((inputs.shape[0], self._y_dim))
-        else:
-            X = np.zeros((len(inputs), self._y_dim))
-        for i, series in enumerate(inputs):
-            X[i,:] = series.iloc[:self._y_dim, 0]
+        # Truncated to the training length (shorter series are zero padded)
+        X = self._packed(inputs).to_matrix(self._y_dim)
         return CallResult(self._model.transform(X), True, 1)
 
     def set_training_data(self, *, inputs: Inputs, outputs: Outputs) -> None:
         if len(inputs) == 0:
             return
-        lengths = [x.shape[0] for x in inputs]
-        is_same_length = len(set(lengths)) == 1
-        if is_same_length:
-            self._y_dim = lengths[0]
-        else:
-            # Truncate all time series to the shortest time series
-            self._y_dim = min(lengths)
+        inputs = self._packed(inputs)
+        # Truncate all time series to the shortest time series
+        self._y_dim = int(inputs.lengths().min())
         self._x_dim = len(inputs)
-        self._training_data = np.zeros((self._x_dim, self._y_dim))
-        for i, series in enumerate(inputs):
-            self._training_data[i, :] = series.iloc[:self._y_dim, 0]
+        self._training_data = inputs.to_matrix(self._y_dim)
+
+    def _packed(self, inputs):
+        '''Inputs as a PackedSeries (the first column of each series DataFrame)'''
+        if isinstance(inputs, PackedSeries):
+            return inputs
+        return PackedSeries.from_frames(inputs)
             
     def fit(self, *, timeout: float = None, iterations: int = None) -> CallResult[None]:
         eps = self.hyperparams['eps']
@@ -0,0 +1,42 @@
+'''Bagged predictor built from cross-validation fold models'''
+
+import numpy as np
+
+from primitive_interfaces.base import CallResult
+
+
+class BaggedPredictor(object):
+    '''Combines the models fitted on the cross-validation folds into one predictor.
+
+    Used in place of a learner refitted on the full training data.
+    Classification predictions are combined by majority vote, and
+    regression predictions by averaging. Supports both the sklearn
+    (predict) and the unified D3M (produce) calling conventions, so it
+    can stand in for the original executable.
+    '''
+    def __init__(self, models, unified_interface=False, classification=False):
+        self.models = models
+        self.unified_interface = unified_interface
+        self.classification = classification
+
+    def _predict_one(self, model, X):
+        if self.unified_interface:
+            return model.produce(inputs=X).value
+        return model.predict(X)
+
+    def predict(self, X):
+        predictions = np.column_stack(
+            [np.asarray(self._predict_one(model, X)).ravel() for model in self.models])
+        if not self.classification:
+            return predictions.mean(axis=1)
+
+        # Majority vote per row, ties go to the smallest label
+        labels, codes = np.unique(predictions, return_inverse=True)
+        codes = codes.reshape(predictions.shape)
+        counts = np.zeros((predictions.shape[0], len(labels)), dtype=np.int32)
+        rows = np.repeat(np.arange(predictions.shape[0]), predictions.shape[1])
+        np.add.at(counts, (rows, codes.ravel()), 1)
+        return labels[counts.argmax(axis=1)]
+
+    def produce(self, *, inputs, timeout=None, iterations=None):
+        return CallResult(self.predict(inputs), True, 1)
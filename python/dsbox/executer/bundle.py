@@ -0,0 +1,99 @@
+'''Single file bundle of an exported pipeline'''
+
+import os
+import copy
+import time
+
+from collections import OrderedDict
+
+from sklearn.externals import joblib
+
+from dsbox.executer.model_store import ModelStore
+
+BUNDLE_FORMAT_VERSION = 1
+
+
+class PipelineBundle(object):
+    """
+    The fitted primitives of an exported pipeline, plus a manifest, in one file.
+
+    Primitives are added once per pipeline variable, and objects shared
+    between primitives (such as executables reused from the primitive
+    cache) are pickled only once. With a ModelStore, the fitted
+    executables are kept in the store and shared between bundles. Files
+    are written uncompressed, so the NumPy arrays inside them are loaded
+    with mmap_mode='r': loading is fast, and scorer processes on the same
+    host share the model pages through the OS page cache.
+    """
+
+    def __init__(self, pipeline_id=None, manifest=None, store=None):
+        self.pipeline_id = pipeline_id
+        self.manifest = manifest if manifest is not None else {}
+        self.primitives = OrderedDict()
+        # ModelStore for the fitted executables. If None, they are kept in the bundle
+        self.store = store
+        self.executable_keys = OrderedDict()
+
+    def add_primitive(self, primid, primitive):
+        '''Adds a copy of the primitive without its pipeline, and without the
+        executables of non persistent primitives (many cannot be pickled)'''
+        prim = copy.copy(primitive)
+        prim.pipeline = None
+        if not primitive.is_persistent:
+            if primitive.column_primitive:
+                prim.executables = dict((colname, None) for colname in primitive.executables.keys())
+            else:
+                prim.executables = None
+        self.primitives[primid] = prim
+        self.manifest.setdefault('primitives', []).append({
+            'id': primid, 'name': primitive.name, 'cls': primitive.cls, 'task': primitive.task})
+
+    def add_step(self, primid, task, input_var, output_var, construct=False):
+        '''Records that the primitive is applied to a pipeline variable (the
+        test data is testdata_0). Used to predict without the generated script.
+        If construct, the learner is instantiated (unfitted) before predicting.'''
+        self.manifest.setdefault('steps', []).append({
+            'id': primid, 'task': task, 'input': input_var, 'output': output_var, 'construct': construct})
+
+    def get_primitive(self, primid):
+        return self.primitives[primid]
+
+    def set_executables(self, primid, executables):
+        '''Replaces the fitted executables of a bundled primitive (the
+        primitive is a copy, so the pipeline keeps its own executables)'''
+        self.primitives[primid].executables = executables
+
+    def save(self, filename):
+        self.manifest['format_version'] = BUNDLE_FORMAT_VERSION
+        self.manifest['pipeline_id'] = self.pipeline_id
+        self.manifest['created'] = time.time()
+        primitives = self.primitives
+        if self.store is not None:
+            # Fitted executables go to the store, the bundle keeps their keys
+            self.manifest['store'] = os.path.relpath(self.store.root, os.path.dirname(os.path.abspath(filename)))
+            primitives = OrderedDict()
+            for primid, prim in self.primitives.items():
+                if prim.is_persistent and prim.executables is not None:
+                    self.executable_keys[primid] = self.store.put(prim.executables)
+                    prim = copy.copy(prim)
+                    prim.executables = None
+                primitives[primid] = prim
+        self.manifest['executables'] = self.executable_keys
+        # No compression, so that arrays can be memory mapped on load
+        joblib.dump({'manifest': self.manifest, 'primitives': primitives}, filename)
+
+    @staticmethod
+    def load(filename, mmap_mode='r'):
+        contents = joblib.load(filename, mmap_mode=mmap_mode)
+        manifest = contents['manifest']
+        if manifest.get('format_version') != BUNDLE_FORMAT_VERSION:
+            raise ValueError("Unsupported pipeline bundle version %s in %s" % (manifest.get('format_version'), filename))
+        bundle = PipelineBundle(manifest.get('pipeline_id'), manifest)
+        bundle.primitives = contents['primitives']
+        bundle.executable_keys = manifest.get('executables', {})
+        if bundle.executable_keys:
+            storedir = os.path.join(os.path.dirname(os.path.abspath(filename)), manifest['store'])
+            bundle.store = ModelStore(storedir)
+            for primid, key in bundle.executable_keys.items():
+                bundle.primitives[primid].executables = bundle.store.get(key, mmap_mode=mmap_mode)
+        return bundle
@@ -0,0 +1,308 @@
+'''Compiled evaluators for common fitted scikit-learn learners'''
+
+import sys
+
+import numpy as np
+
+from collections import Counter
+
+# Rows evaluated at once by the tree ensembles (bounds the node index matrix)
+TREE_BATCH_ROWS = 65536
+
+
+def _as_array(X, dtype=np.float64):
+    if hasattr(X, 'values'):
+        X = X.values
+    return np.asarray(X, dtype=dtype)
+
+
+class CompiledTransform(object):
+    """
+    A fitted glue transformer (imputer, scaler, normalizer) as arrays.
+
+    Kinds are 'impute' (fill NaN with per column statistics), 'standardize'
+    ((X - mean) / scale), 'affine' (X * scale + offset) and 'normalize'
+    (divide rows by their l1 or l2 norm).
+    """
+
+    def __init__(self, kind, scale=None, offset=None, norm=None):
+        self.kind = kind
+        self.scale = scale
+        self.offset = offset
+        self.norm = norm
+
+    def transform(self, X):
+        if self.kind == 'impute':
+            mask = np.isnan(X)
+            if mask.any():
+                X = np.where(mask, self.offset, X)
+        elif self.kind == 'standardize':
+            if self.offset is not None:
+                X = X - self.offset
+            if self.scale is not None:
+                X = X / self.scale
+        elif self.kind == 'affine':
+            X = X * self.scale + self.offset
+        elif self.kind == 'normalize':
+            if self.norm == 'l1':
+                norms = np.abs(X).sum(axis=1)
+            else:
+                norms = np.sqrt(np.einsum('ij,ij->i', X, X))
+            norms[norms == 0.0] = 1.0
+            X = X / norms[:, np.newaxis]
+        return X
+
+    def affine(self):
+        '''Returns (scale, offset) such that transform(X) == X * scale + offset, or None'''
+        if self.kind == 'affine':
+            return (self.scale, self.offset)
+        if self.kind == 'standardize':
+            scale = 1.0 / self.scale if self.scale is not None else 1.0
+            offset = -self.offset * scale if self.offset is not None else 0.0
+            return (scale, offset)
+        return None
+
+
+class CompiledModel(object):
+    '''Base of the compiled learners. Folded glue transforms run first'''
+
+    def __init__(self, transforms=()):
+        self.transforms = list(transforms)
+
+    def prepare(self, X):
+        X = _as_array(X)
+        for transform in self.transforms:
+            X = transform.transform(X)
+        return X
+
+    def predict(self, X):
+        raise NotImplementedError()
+
+
+class CompiledLinearModel(CompiledModel):
+    '''Linear regressor (X . coef + intercept), or linear classifier'''
+
+    def __init__(self, coef, intercept, classes=None, transforms=()):
+        super(CompiledLinearModel, self).__init__(transforms)
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.classes = classes
+
+    def predict(self, X):
+        scores = self.prepare(X).dot(self.coef.T) + self.intercept
+        if self.classes is None:
+            return scores
+        if scores.ndim == 1 or scores.shape[1] == 1:
+            indices = (scores.ravel() > 0).astype(int)
+        else:
+            indices = scores.argmax(axis=1)
+        return self.classes.take(indices)
+
+    def fold(self):
+        '''Returns an equivalent model with the trailing affine transforms
+        (scalers) folded into the coefficients'''
+        coef = self.coef
+        intercept = self.intercept
+        transforms = list(self.transforms)
+        while transforms and transforms[-1].affine() is not None:
+            scale, offset = transforms.pop().affine()
+            intercept = intercept + coef.dot(np.broadcast_to(offset, coef.shape[-1:]))
+            coef = coef * scale
+        return CompiledLinearModel(coef, intercept, self.classes, transforms)
+
+
+class CompiledTreeEnsemble(CompiledModel):
+    """
+    Decision tree, random forest or extra trees as flat node arrays.
+
+    The nodes of all trees are concatenated, and the rows descend all
+    trees at once, one level per step, with vectorized lookups.
+    Classifier leaves hold class probabilities, which are averaged over
+    the trees; regressor leaves hold values, which are averaged.
+    """
+
+    def __init__(self, trees, classes=None, transforms=()):
+        super(CompiledTreeEnsemble, self).__init__(transforms)
+        self.classes = classes
+        roots, left, right, feature, threshold, value = [], [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            roots.append(offset)
+            left.append(np.where(tree.children_left == -1, -1, tree.children_left + offset))
+            right.append(np.where(tree.children_right == -1, -1, tree.children_right + offset))
+            # Leaves have feature -2, any valid column will do
+            feature.append(np.maximum(tree.feature, 0))
+            threshold.append(tree.threshold)
+            if classes is None:
+                value.append(tree.value[:, 0, 0])
+            else:
+                proba = tree.value[:, 0, :]
+                normalizer = proba.sum(axis=1)[:, np.newaxis]
+                normalizer[normalizer == 0.0] = 1.0
+                value.append(proba / normalizer)
+            offset += tree.node_count
+        self.roots = np.array(roots, dtype=np.intp)
+        self.left = np.concatenate(left).astype(np.intp)
+        self.right = np.concatenate(right).astype(np.intp)
+        self.feature = np.concatenate(feature).astype(np.intp)
+        self.threshold = np.concatenate(threshold)
+        self.value = np.concatenate(value)
+        self.max_depth = max(tree.max_depth for tree in trees)
+
+    def apply(self, X):
+        '''Returns the leaf of each row (rows x trees)'''
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        nodes = np.tile(self.roots, (X.shape[0], 1))
+        for _ in range(self.max_depth):
+            left = self.left[nodes]
+            split = left != -1
+            if not split.any():
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(split, np.where(go_left, left, self.right[nodes]), nodes)
+        return nodes
+
+    def predict(self, X):
+        # The trees split on float32 features, as scikit-learn does
+        X = self.prepare(X).astype(np.float32)
+        predictions = []
+        for start in range(0, X.shape[0], TREE_BATCH_ROWS):
+            values = self.value[self.apply(X[start:start + TREE_BATCH_ROWS])]
+            predictions.append(values.mean(axis=1))
+        averaged = np.concatenate(predictions) if predictions else self.value[:0]
+        if self.classes is None:
+            return averaged
+        return self.classes.take(averaged.argmax(axis=1))
+
+
+def compile_transform(executable):
+    '''Returns the fitted glue transformer as a CompiledTransform, or None
+    if it is not supported'''
+    from sklearn import preprocessing
+    if type(executable) is preprocessing.StandardScaler:
+        return CompiledTransform('standardize', scale=executable.scale_, offset=executable.mean_)
+    if type(executable) is preprocessing.MinMaxScaler:
+        return CompiledTransform('affine', scale=executable.scale_, offset=executable.min_)
+    if type(executable) is preprocessing.Normalizer and executable.norm in ('l1', 'l2'):
+        return CompiledTransform('normalize', norm=executable.norm)
+    Imputer = getattr(preprocessing, 'Imputer', None)
+    if Imputer is not None and type(executable) is Imputer:
+        statistics = getattr(executable, 'statistics_', None)
+        # Columns without statistics are dropped by the imputer
+        if (executable.axis == 0 and executable.missing_values in ('NaN', 'nan') and
+                statistics is not None and not np.isnan(statistics).any()):
+            return CompiledTransform('impute', offset=statistics)
+    return None
+
+
+def compile_learner(executable, transforms=()):
+    '''Returns the fitted learner as a CompiledModel, or None if it is not supported'''
+    from sklearn import tree, ensemble
+    from sklearn.base import is_classifier
+    try:
+        from sklearn.linear_model.base import LinearModel, LinearClassifierMixin
+    except ImportError:
+        from sklearn.linear_model._base import LinearModel, LinearClassifierMixin
+
+    if getattr(executable, 'n_outputs_', 1) != 1:
+        return None
+    classes = executable.classes_ if is_classifier(executable) else None
+
+    if isinstance(executable, LinearClassifierMixin) and type(executable).predict is LinearClassifierMixin.predict:
+        if not hasattr(executable, 'coef_'):
+            return None
+        return CompiledLinearModel(executable.coef_, executable.intercept_, classes, transforms)
+    if isinstance(executable, LinearModel) and type(executable).predict is LinearModel.predict:
+        if not hasattr(executable, 'coef_'):
+            return None
+        return CompiledLinearModel(executable.coef_, executable.intercept_, None, transforms)
+
+    if type(executable) in (tree.DecisionTreeClassifier, tree.DecisionTreeRegressor,
+                            tree.ExtraTreeClassifier, tree.ExtraTreeRegressor):
+        if not hasattr(executable, 'tree_'):
+            return None
+        return CompiledTreeEnsemble([executable.tree_], classes, transforms)
+    if type(executable) in (ensemble.RandomForestClassifier, ensemble.RandomForestRegressor,
+                            ensemble.ExtraTreesClassifier, ensemble.ExtraTreesRegressor):
+        if not getattr(executable, 'estimators_', None):
+            return None
+        return CompiledTreeEnsemble([estimator.tree_ for estimator in executable.estimators_], classes, transforms)
+    return None
+
+
+def _same_predictions(model, X, expected):
+    predictions = model.predict(X)
+    expected = np.asarray(expected)
+    if predictions.shape != expected.shape:
+        return False
+    if model.classes is not None:
+        return np.array_equal(predictions, expected)
+    return np.allclose(predictions, expected, rtol=1e-9, atol=1e-12)
+
+
+def compile_bundle(bundle, runtime, sample):
+    '''Replaces the fitted learners of the bundle with compiled evaluators.
+    Persistent glue steps that only feed a learner are folded into it, and
+    marked as folded in the manifest. A learner is only replaced if the
+    compiled evaluator predicts the same as the original on the sample
+    (rows of the training input). Returns the ids of the compiled learners.'''
+    steps = bundle.manifest['steps']
+    # Restore the non persistent executables created while replaying the steps
+    unfitted = dict((primid, prim.executables) for primid, prim in bundle.primitives.items()
+                    if not prim.is_persistent)
+    variables = {}
+    try:
+        runtime.predict(bundle, sample, variables=variables)
+    finally:
+        for primid, executables in unfitted.items():
+            bundle.set_executables(primid, executables)
+
+    users = Counter(step['input'] for step in steps)
+    producers = dict((step['output'], step) for step in steps if step['task'] != "Modeling")
+    compiled = []
+    for step in steps:
+        primitive = bundle.get_primitive(step['id'])
+        if (step['task'] != "Modeling" or step['construct'] or primitive.unified_interface or
+                step['input'] not in variables):
+            continue
+
+        # Glue steps that only feed this learner, first to last
+        glue = []
+        var = step['input']
+        while var in producers and users[var] == 1:
+            producer = producers[var]
+            glueprim = bundle.get_primitive(producer['id'])
+            if (producer['task'] != "PreProcessing" or not glueprim.is_persistent or
+                    glueprim.column_primitive or glueprim.unified_interface or
+                    producer['input'] not in variables):
+                break
+            transform = compile_transform(glueprim.executables)
+            if transform is None:
+                break
+            glue.insert(0, (producer, transform))
+            var = producer['input']
+
+        try:
+            X = variables[step['input']]
+            expected = primitive.executables.predict(X)
+            # Fold as many glue steps as possible
+            for nfolded in range(len(glue), -1, -1):
+                folded = glue[len(glue) - nfolded:]
+                model = compile_learner(primitive.executables, [transform for _, transform in folded])
+                if model is None:
+                    break
+                candidates = [model.fold(), model] if isinstance(model, CompiledLinearModel) else [model]
+                Xin = variables[folded[0][0]['input']] if folded else X
+                model = next((m for m in candidates if _same_predictions(m, Xin, expected)), None)
+                if model is not None:
+                    bundle.set_executables(step['id'], model)
+                    for producer, _ in folded:
+                        producer['folded'] = True
+                    if folded:
+                        step['input'] = folded[0][0]['input']
+                    step['compiled'] = type(model).__name__
+                    compiled.append(step['id'])
+                    break
+        except Exception as e:
+            sys.stderr.write("ERROR: compile_bundle {}: {}\n".format(primitive.name, e))
+    return compiled
@@ -12,18 +12,23 @@ from primitive_interfaces.base import PrimitiveBase
 from primitive_interfaces.generator import GeneratorPrimitiveBase
 from primitive_interfaces.supervised_learning import SupervisedLearnerPrimitiveBase
 from primitive_interfaces.unsupervised_learning import UnsupervisedLearnerPrimitiveBase
-from sklearn.externals import joblib
+from sklearn.base import is_classifier
 from sklearn.model_selection import KFold
 
 from dsbox.schema.dataset_schema import VariableFileType
 from dsbox.schema.profile_schema import DataProfileType as dpt
 from dsbox.schema.problem_schema import TaskType
 from dsbox.executer.execution import Execution
+from dsbox.executer.bagging import BaggedPredictor
+from dsbox.executer.bundle import PipelineBundle
+from dsbox.executer.compiled import compile_bundle
+from dsbox.executer.runtime import PipelineRuntime, needs_problem_args
 
 
 from dsbox.executer import pickle_patch
 
 from dsbox.planner.common.pipeline import CrossValidationStat
+from dsbox.planner.common.scoring import ScoringEngine
 
 import scipy.sparse.csr
 
@@ -44,6 +49,9 @@ import d3m.primitives
 
 REMOTE = False
 
+# Epochs used by partial_fit learners that do not set max_iter
+DEFAULT_MAX_ITER = 5
+
 class ExecutionHelper(object):
     problem = None
     dataset = None
@@ -52,6 +60,7 @@ class ExecutionHelper(object):
         self.e = Execution()
         self.problem = problem
         self.data_manager = data_manager
+        self.scoring = ScoringEngine(problem)
 
     def instantiate_primitive(self, primitive):
         executable = None
@@ -114,7 +123,10 @@ class ExecutionHelper(object):
                             return None
                         # FIXME: Hack for Label encoder for python3 (cannot handle missing values)
                         if (primitive.name == "Label Encoder") and (sys.version_info[0] == 3):
-                            if df[col].dtype == object:
+                            if df[col].dtype.name == 'category':
+                                fill = '' if df[col].cat.categories.dtype == object else 0
+                                df[col] = df[col].astype(object).fillna(fill)
+                            elif df[col].dtype == object:
                                 df[col] = df[col].fillna('')
                             else:
                                 df[col] = df[col].fillna(0)
@@ -152,49 +164,24 @@ class ExecutionHelper(object):
 
     @stopit.threading_timeoutable()
     def test_execute_primitive(self, primitive, df):
-        persistent = primitive.is_persistent
-        indices = df.index
-        if primitive.column_primitive:
-            # A primitive that is run per column
-            for col in df.columns:
-                colname = col.format()
-                # If during test phase, this column wasn't hash
-                if colname not in primitive.executables.keys():
-                    continue
-
-                executable = None
-                if not persistent:
-                    executable = self.instantiate_primitive(primitive)
-                else:
-                    executable = primitive.executables.get(colname, None)
-
-                if executable is None:
-                    return None
-
-                try:
-                    # FIXME: Hack for Label encoder for python3 (cannot handle missing values)
-                    if (primitive.name == "Label Encoder") and (sys.version_info[0] == 3):
-                        if df[col].dtype == object:
-                            df[col] = df[col].fillna('')
-                        else:
-                            df[col] = df[col].fillna(0)
-                    #print("- Test on column: %s" % colname)
-                    (df[col], executable) = self._execute_primitive(
-                        primitive, executable, df[col], None, True, persistent)
-                except Exception as e:
-                    sys.stderr.write("ERROR: execute_primitive {}: {}\n".format(primitive.name, e))
-                    #sys.stderr.write("ERROR execute_primitive(%s): %s\n" % (primitive, e))
-                    #traceback.print_exc()
-                    return None
-        else:
-            if not persistent:
-                primitive.executables = self.instantiate_primitive(primitive)
-            if primitive.executables is None:
-                return None
-            (df, executable) = self._execute_primitive(
-                primitive, primitive.executables, df, None, True, persistent)
-
-        return pd.DataFrame(df, index=indices)
+        return self.get_runtime().test_execute_primitive(primitive, df)
+
+    def _input_dtypes(self):
+        '''dtypes of the training input columns, so that test data is read
+        the same way. Dates are left to the csv parser.'''
+        data = self.data_manager.input_data
+        if data is None or not hasattr(data, 'dtypes'):
+            return {}
+        return dict((str(colname), str(dtype)) for colname, dtype in data.dtypes.items()
+                    if dtype.kind not in 'mM')
+
+    def get_runtime(self):
+        '''Test time execution of primitives'''
+        runtime = PipelineRuntime(self.data_manager.media_type, self.data_manager.input_columns,
+                                  self.data_manager.index_column, helper=self)
+        runtime.image_tensors = self.data_manager.image_tensors
+        runtime.packed_series = self.data_manager.packed_series
+        return runtime
 
     def _profile_matches_precondition(self, preconditions, profile):
         for precondition in preconditions.keys():
@@ -239,13 +226,20 @@ class ExecutionHelper(object):
                     executable = executable.fit(*args)
         return (retval, executable)
 
+    def cross_validation_score_remote(self, primitive, X, y, cv=4, seed=0, keep_fold_models=False):
+        '''Remote version of cross_validation_score. Also returns the primitive executables'''
+        (predictions, metric_values, stat) = self.cross_validation_score(
+            primitive, X, y, cv, seed, keep_fold_models=keep_fold_models)
+        return (predictions, metric_values, stat, primitive.executables, primitive.unified_interface)
+
     @stopit.threading_timeoutable()
-    def cross_validation_score(self, primitive, X, y, cv=4, seed=0):
+    def cross_validation_score(self, primitive, X, y, cv=4, seed=0, keep_fold_models=False):
+        '''Cross validate the primitive. If keep_fold_models is True, the
+        fitted fold models are kept as a BaggedPredictor in primitive.executables'''
         print("Executing %s" % primitive.name)
         sys.stdout.flush()
 
-        metric_values = {}  # Dict[str, float]
-        stat = CrossValidationStat()
+        fold_models = []
 
         # Redirect stderr to an error file
         #  Directly assigning stderr to tempfile.TemporaryFile cause printing str to fail
@@ -260,9 +254,12 @@ class ExecutionHelper(object):
                     kf = KFold(n_splits=cv, shuffle=True, random_state=seed)#int(time.time()))
                     
                     tcols = [self.data_manager.target_columns[0]['colName']]
-                    yPredictions = None
+                    folds = list(kf.split(X, y))
+                    fold_predictions = []
+                    # Folds that did not fail
+                    scored_folds = []
                     num = 0.0
-                    for k, (train, test) in enumerate(kf.split(X, y)):
+                    for k, (train, test) in enumerate(folds):
                         executable = self.instantiate_primitive(primitive)
                         if executable is None:
                             primitive.finished = True
@@ -286,26 +283,17 @@ class ExecutionHelper(object):
                                     executable.fit(trainX, trainY)
                                     ypred = executable.predict(testX)
 
-                            ypredDF = pd.DataFrame(ypred, index=testX.index, columns=tcols)
-                            if yPredictions is None:
-                                yPredictions = ypredDF
-                            else:
-                                yPredictions = pd.concat([yPredictions, ypredDF])
+                            if keep_fold_models:
+                                fold_models.append(executable)
+
+                            fold_predictions.append(pd.DataFrame(ypred, index=testX.index, columns=tcols))
+                            scored_folds.append((train, test))
 
                             num = num + 1.0
                             # TODO: Removing this for now
                             primitive.progress = num/cv
                             primitive.pipeline.notifyChanges()
 
-                            # TODO: Training metrics for each fold
-
-                            # Test metrics for each fold
-                            for i in range(0, len(self.problem.metrics)):
-                                metric = self.problem.metrics[i]
-                                fn = self.problem.metric_functions[i]
-                                fold_metric_val = self._call_function(fn, y.loc[ypredDF.index], ypredDF)
-                                stat.add_fold_metric(metric, fold_metric_val)
-
                         except Exception as e:
                             sys.stderr.write("ERROR: cross_validation {}: {}\n".format(primitive.name, e))
                             # traceback.print_exc(e)
@@ -313,16 +301,22 @@ class ExecutionHelper(object):
         if num == 0:
             return (None, None, None)
 
-        yPredictions = yPredictions.sort_index()
+        yPredictions = pd.concat(fold_predictions).sort_index()
+
+        # Overall and per fold test metrics, scored together. If some folds
+        # failed, only the rows of the other folds are scored.
+        scored_y = y
+        if num < len(folds):
+            (scored_y, scored_folds) = self._select_folds(y, scored_folds)
+        scored = self._score_cross_validation(scored_y, [fold_predictions], scored_folds)
+        if scored[0] is None:
+            return (None, None, None)
+        (metric_values, stat) = scored[0]
 
-        #print ("Trained on {} samples, Tested on {} samples".format(len(train), len(ypred)))
-        for i in range(0, len(self.problem.metrics)):
-            metric = self.problem.metrics[i]
-            fn = self.problem.metric_functions[i]
-            metric_val = self._call_function(fn, y, yPredictions)
-            if metric_val is None:
-                return (None, None, None)
-            metric_values[metric.name] = metric_val
+        if keep_fold_models:
+            primitive.executables = BaggedPredictor(
+                fold_models, primitive.unified_interface,
+                classification=(self.problem.task_type == TaskType.CLASSIFICATION))
 
         primitive.end_time = time.time()
         primitive.progress = 1.0
@@ -338,6 +332,154 @@ class ExecutionHelper(object):
         return (yPredictions, metric_values, stat)
 
 
+    def _select_folds(self, y, folds):
+        '''The targets of the test rows of the folds, and the folds with
+        their test rows numbered within those targets'''
+        positions = np.sort(np.concatenate([test for (train, test) in folds]))
+        return (y.take(positions, axis=0),
+                [(train, np.searchsorted(positions, test)) for (train, test) in folds])
+
+    def _score_cross_validation(self, y, candidates, folds):
+        '''Scores the out of fold predictions of several candidates at once.
+        Each candidate is a list of prediction DataFrames, one for each fold.
+        Returns a list with (metric_values, CrossValidationStat) for each
+        candidate, or None for a candidate with a failed metric.'''
+        if not candidates:
+            return []
+        columns = []
+        for fold_predictions in candidates:
+            values = [np.asarray(ypredDF).ravel() for ypredDF in fold_predictions]
+            column = np.empty(len(y), dtype=np.result_type(*values) if values else object)
+            for (train, test), fold_values in zip(folds, values):
+                column[test] = fold_values
+            columns.append(column)
+        try:
+            predictions = np.column_stack(columns)
+        except TypeError:
+            predictions = np.column_stack([column.astype(object) for column in columns])
+        masks = ScoringEngine.fold_masks(len(y), [test for (train, test) in folds])
+        scores = self.scoring.score(y.values.ravel(), predictions, masks)
+
+        results = []
+        for j in range(len(candidates)):
+            metric_values = {}
+            stat = CrossValidationStat()
+            for metric in self.problem.metrics:
+                metric_val = ScoringEngine.value(scores[metric.name][0, j])
+                if metric_val is None:
+                    metric_values = None
+                    break
+                metric_values[metric.name] = metric_val
+                for fold_score in scores[metric.name][1:, j]:
+                    stat.add_fold_metric(metric, ScoringEngine.value(fold_score))
+            results.append(None if metric_values is None else (metric_values, stat))
+        return results
+
+    def get_warm_start_param(self, primitive):
+        '''Returns (parameter name, current value) of the learner size parameter
+        that can be grown incrementally, or None if not supported. Ensemble
+        learners grow n_estimators with warm_start, and online learners grow
+        max_iter one partial_fit epoch at a time. Only looks at the class
+        and the keyword arguments, the learner is not instantiated.'''
+        mod, cls = primitive.cls.rsplit('.', 1)
+        try:
+            PrimitiveClass = getattr(importlib.import_module(mod), cls)
+            signature = inspect.signature(PrimitiveClass.__init__)
+        except Exception:
+            return None
+        if (not inspect.isclass(PrimitiveClass) or issubclass(PrimitiveClass, PrimitiveBase)
+                or not hasattr(PrimitiveClass, 'get_params')):
+            return None
+        params = dict((name, parameter.default) for name, parameter in signature.parameters.items()
+                      if parameter.default is not inspect.Parameter.empty)
+        params.update(primitive.getInitKeywordArgs() or {})
+        if 'warm_start' in params and params.get('n_estimators', None):
+            return ('n_estimators', params['n_estimators'])
+        if hasattr(PrimitiveClass, 'partial_fit') and 'max_iter' in params:
+            return ('max_iter', params['max_iter'] or DEFAULT_MAX_ITER)
+        return None
+
+    def _partial_fit_epochs(self, executable, X, y, classes, epochs):
+        '''Runs epochs partial_fit passes over the data'''
+        for _ in range(epochs):
+            if is_classifier(executable):
+                executable.partial_fit(X, y, classes=classes)
+            else:
+                executable.partial_fit(X, y)
+
+    @stopit.threading_timeoutable()
+    def warm_start_ladder_score(self, primitive, X, y, param, sizes, cv=4, seed=0):
+        '''Cross validate a ladder of learner sizes (ascending) with a single
+        incremental fit per fold. The learner is grown from one size to the
+        next, and scored at each rung. Returns a list of
+        (size, predictions, metric_values, stat), one for each successful rung.
+        '''
+        print("Executing warm start ladder %s %s=%s" % (primitive.name, param, sizes))
+        sys.stdout.flush()
+
+        rung_predictions = [[] for _ in sizes]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, primitive.name), 'w') as errorfile:
+                with contextlib.redirect_stderr(errorfile):
+
+                    primitive.start_time = time.time()
+
+                    kf = KFold(n_splits=cv, shuffle=True, random_state=seed)
+                    tcols = [self.data_manager.target_columns[0]['colName']]
+                    classes = np.unique(y.values.ravel())
+                    folds = list(kf.split(X, y))
+                    for k, (train, test) in enumerate(folds):
+                        executable = self.instantiate_primitive(primitive)
+                        if executable is None:
+                            primitive.finished = True
+                            return []
+
+                        trainX = X.take(train, axis=0)
+                        trainY = y.take(train, axis=0).values.ravel()
+                        testX = X.take(test, axis=0)
+
+                        try:
+                            if param == 'n_estimators':
+                                executable.set_params(warm_start=True)
+                            epochs = 0
+                            for rung, size in enumerate(sizes):
+                                if param == 'n_estimators':
+                                    # Only the additional estimators are fitted
+                                    executable.set_params(n_estimators=size)
+                                    executable.fit(trainX, trainY)
+                                else:
+                                    self._partial_fit_epochs(executable, trainX, trainY, classes, size - epochs)
+                                    epochs = size
+
+                                ypredDF = pd.DataFrame(executable.predict(testX), index=testX.index, columns=tcols)
+                                rung_predictions[rung].append(ypredDF)
+
+                            primitive.progress = (k + 1.0) / cv
+                            primitive.pipeline.notifyChanges()
+
+                        except Exception as e:
+                            sys.stderr.write("ERROR: warm_start_ladder {}: {}\n".format(primitive.name, e))
+
+        # Score all rungs with complete out of fold predictions in one pass
+        rungs = [rung for rung in range(len(sizes)) if len(rung_predictions[rung]) == len(folds)]
+        scored = self._score_cross_validation(y, [rung_predictions[rung] for rung in rungs], folds)
+        results = []
+        for rung, rung_scored in zip(rungs, scored):
+            if rung_scored is None:
+                continue
+            yPredictions = pd.concat(rung_predictions[rung]).sort_index()
+            (metric_values, stat) = rung_scored
+            results.append((sizes[rung], yPredictions, metric_values, stat))
+
+        primitive.end_time = time.time()
+        primitive.progress = 1.0
+        primitive.finished = True
+        primitive.pipeline.notifyChanges()
+
+        print('warm start ladder metric values = {}'.format([(r[0], r[2]) for r in results]))
+        return results
+
     def create_primitive_model_remote(self, primitive, X, y):
         '''Remote version of create_primitive_model'''
         self.create_primitive_model( primitive, X, y)
@@ -358,17 +500,16 @@ class ExecutionHelper(object):
         else:
             if REMOTE:
                 executable = self.e.execute('fit', args=[X, y], kwargs=None, obj=executable, objreturn=True)
+            elif getattr(primitive, 'partial_fit_epochs', None):
+                # Fitted the way the warm start ladder scored it
+                yvalues = y.values.ravel()
+                self._partial_fit_epochs(executable, X, yvalues, np.unique(yvalues), primitive.partial_fit_epochs)
             else:
                 executable.fit(X, y.values.ravel())
         primitive.executables = executable
 
-    def _as_tensor(self, image_list):
-        from keras.preprocessing import image
-        shape = (len(image_list), ) + image.img_to_array(image_list[0]).shape
-        result = np.empty(shape)
-        for i in range(len(image_list)):
-            result[i] = image.img_to_array(image_list[i])
-        return result
+    def _as_tensor(self, image_list, colname=None):
+        return self.get_runtime()._as_tensor(image_list, colname)
 
     def featurise_remote(self, primitive, df):
         '''Use this method if running in subprocess of remotely'''
@@ -436,9 +577,10 @@ class ExecutionHelper(object):
                   if executable is None:
                       primitive.finished = True
                       return None
-                  executable.set_training_data(inputs=df[col].values, outputs=[])
+                  series = self.get_runtime().series_inputs(col, df[col].values)
+                  executable.set_training_data(inputs=series, outputs=[])
                   executable.fit()
-                  call_result = executable.produce(inputs=df[col].values)
+                  call_result = executable.produce(inputs=series)
                   fcols = [(col.format() + "_" + str(index)) for index in range(0, call_result.value.shape[1])]
                   newdf = pd.DataFrame(call_result.value, columns=fcols, index=df.index)
                   del df[col]
@@ -451,9 +593,7 @@ class ExecutionHelper(object):
                   if executable is None:
                       primitive.finished = True
                       return None
-                  image_tensor = self._as_tensor(df[col].values)
-                  call_result = executable.produce(inputs=image_tensor)
-                  nvals = call_result.value
+                  nvals = self.get_runtime().image_features(executable, col, df[col].values)
                   fcols = [(col.format() + "_" + str(index)) for index in range(0, nvals.shape[1])]
                   newdf = pd.DataFrame(nvals, columns=fcols, index=df.index)
                   del df[col]
@@ -503,88 +643,10 @@ class ExecutionHelper(object):
 
     @stopit.threading_timeoutable()
     def test_featurise(self, primitive, df):
-        persistent = primitive.is_persistent
-        ncols = [col.format() for col in df.columns]
-        featurecols = self.raw_data_columns(self.data_manager.input_columns)
-        indices = df.index
-        for col in featurecols:
-            executable = None
-            if not persistent:
-                executable = self.instantiate_primitive(primitive)
-            else:
-                executable = primitive.executables[col]
-            if executable is None:
-                return None
-
-            if self.data_manager.media_type == VariableFileType.TEXT:
-                # Using an unfitted primitive for each column (needed for Corex)
-                #df_col = pd.DataFrame(df[col])
-                #executable.fit(df_col)
-                nvals = None
-                if persistent:
-                    call_result = executable.produce(df[col])
-                else:
-                    executable.fit()
-                    call_result = executable.produce(inputs=df[col].values)
-
-                val = call_result.value.todense() if isinstance(call_result.value, scipy.sparse.csr.csr_matrix) else call_result.value
-                #fcols = [(col.format() + "_" + feature) for feature in executable.get_feature_names()]
-                fcols = [(col.format() + "_" + str(index)) for index in range(0, val.shape[1])]
-                newdf = pd.DataFrame(val, columns=fcols, index=df.index)
-                del df[col]
-                ncols = ncols + fcols
-                ncols.remove(col)
-                df = pd.concat([df, newdf], axis=1)
-                df.columns=ncols
-            elif self.data_manager.media_type == VariableFileType.TIMESERIES:
-                call_result = executable.produce(inputs=df[col].values)
-                features = call_result.value
-                fcols = [(col.format() + "_" + str(index)) for index in range(0, features.shape[1])]
-                newdf = pd.DataFrame(call_result.value, columns=fcols, index=df.index)
-                del df[col]
-                ncols = ncols + fcols
-                ncols.remove(col)
-                df = pd.concat([df, newdf], axis=1)
-                df.columns = ncols
-            elif self.data_manager.media_type == VariableFileType.IMAGE:
-                image_tensor = self._as_tensor(df[col].values)
-                call_result = executable.produce(inputs=image_tensor)
-                nvals = call_result.value
-                fcols = [(col.format() + "_" + str(index)) for index in range(0, nvals.shape[1])]
-                newdf = pd.DataFrame(nvals, columns=fcols, index=df.index)
-                del df[col]
-                ncols = ncols + fcols
-                ncols.remove(col)
-                df = pd.concat([df, newdf], axis=1)
-                df.columns=ncols
-            elif self.data_manager.media_type == VariableFileType.AUDIO:
-                # Featurize audio
-                call_result = executable.produce(inputs=pd.DataFrame(df[col]))
-                features = call_result.value
-                rows = []
-                for row_list in features:
-                    total = np.zeros((row_list[0].size,))
-                    for elt in row_list:
-                        total += elt.flatten()
-                    total /= len(row_list)
-                    rows.append(total)
-                col_names = ['{}_{}'.format(col.format(), i) for i in range(total.size)]
-
-                newdf = pd.DataFrame(rows, index=df.index, columns=col_names)
-
-                # FIXME: Need to be more general
-                df.drop(['filename', 'start', 'end'], axis=1, inplace=True)
-                df = pd.concat([df, newdf], axis=1)
-
-        return pd.DataFrame(df, index=indices)
+        return self.get_runtime().test_featurise(primitive, df)
 
     def raw_data_columns(self, columns):
-        cols = []
-        for col in columns:
-            if ("refersTo" in col or
-                    col['colType'] == "string"):
-                cols.append(col['colName'])
-        return cols
+        return self.get_runtime().raw_data_columns(columns)
 
     def _process_args(self, args, task_type, metrics):
         result_args = []
@@ -629,7 +691,9 @@ class ExecutionHelper(object):
                 result_kwargs[key] = arg
         return result_kwargs
 
-    def create_pipeline_executable(self, pipeline, config):
+    def create_pipeline_executable(self, pipeline, config, model_store=None):
+        '''Writes the pipeline executable script and its bundle. If a
+        ModelStore is given, fitted executables are written to the store'''
         pipeid = pipeline.id
 
         # Get directory information
@@ -647,6 +711,16 @@ class ExecutionHelper(object):
         if not os.path.exists(modelsdir):
             os.makedirs(modelsdir)
 
+        ensembling = pipeline.ensemble is not None
+        n_pipelines = len(pipeline.ensemble.pipelines) if ensembling else 1
+        ens_pipeline = pipeline
+        members = pipeline.ensemble.pipelines if ensembling else [pipeline]
+
+        # The slim runtime avoids importing the planner, unless a primitive
+        # needs the problem to be instantiated at test time
+        slim = (config.get('executable_runtime', 'slim') == 'slim' and
+                not any(needs_problem_args(primitive) for member in members for primitive in member.primitives))
+
         rdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
         imports = []
         statements = [
@@ -660,14 +734,19 @@ class ExecutionHelper(object):
                 "import pandas",
                 "import os.path",
                 ""
-                "import sklearn.externals",
+                "from dsbox.executer.bundle import PipelineBundle"]
+        if slim:
+            statements.append("from dsbox.executer.runtime import PipelineRuntime")
+        else:
+            statements.extend([
                 "from dsbox.executer.executionhelper import ExecutionHelper",
                 "from dsbox.planner.common.data_manager import Dataset, DataManager",
                 "from dsbox.planner.common.problem_manager import Problem",
-                "from dsbox.schema.problem_schema import TaskType, Metric",
+                "from dsbox.schema.problem_schema import TaskType, Metric"])
+        statements.extend([
                 "",
                 "# Pipeline : %s" % str(pipeline),
-                ""]
+                ""])
 
         statements.append("\ncurdir = os.path.dirname(os.path.abspath(__file__))")
         statements.append("numpy.set_printoptions(threshold=numpy.nan)")
@@ -683,6 +762,7 @@ class ExecutionHelper(object):
         statements.append("numcpus = %s" % config.get('cpus'))
         statements.append("timeout = %s*60" % config.get('timeout'))
         statements.append("ram = '%s'" % config.get('ram'))
+        statements.append("stream_chunksize = %s" % config.get('stream_chunksize'))
 
         statements.append("\nconfig = {}")
         statements.append("if len(sys.argv) > 1:")
@@ -703,33 +783,50 @@ class ExecutionHelper(object):
         statements.append("    executables_root = config['executables_root']")
         statements.append("if config.get('temp_storage_root', None) is not None:")
         statements.append("    temp_storage_root = config['temp_storage_root']")
+        statements.append("if config.get('stream_chunksize', None) is not None:")
+        statements.append("    stream_chunksize = config['stream_chunksize']")
         statements.append("predictions_file = os.path.join(results_root, '%s')" % self.problem.predictions_file)
         statements.append("scores_file = os.path.join(results_root, '%s')" % self.problem.scores_file)
 
-        statements.append("\nproblem = Problem()")
-        statements.append("problem.load_problem(problem_root, problem_schema)")
-        statements.append("\ndataset = Dataset()")
-        statements.append("dataset.load_dataset(test_data_root, dataset_schema)")
-        statements.append("\ndata_manager = DataManager()")
-        statements.append("data_manager.initialize_data(problem, [dataset], view='TEST')")
-        #statements.append("\ntestdata = data_manager.input_data")
+        if not slim:
+            statements.append("\nproblem = Problem()")
+            statements.append("problem.load_problem(problem_root, problem_schema)")
+            statements.append("\ndataset = Dataset()")
+            statements.append("dataset.load_dataset(test_data_root, dataset_schema, streaming=bool(stream_chunksize), problem=problem,")
+            statements.append("                     engine=%r, float32=%s)" % (config.get('csv_engine', None), bool(config.get('table_float32', False))))
+            statements.append("\ndata_manager = DataManager()")
+            #statements.append("\ntestdata = data_manager.input_data")
 
-        statements.append("\nhp = ExecutionHelper(problem, data_manager)")
+            statements.append("\nhp = ExecutionHelper(problem, data_manager)")
         index = 1
 
-        ensembling = pipeline.ensemble is not None
-        n_pipelines = len(pipeline.ensemble.pipelines) if ensembling else 1
-        ens_pipeline = pipeline
+        # Statements of the predict(testdata_0) function, which is run on
+        # the whole test set, or on each chunk of rows when streaming
+        predict_statements = []
 
         if ensembling:
             [low_pred, hi_pred] = pipeline.ensemble.prediction_range
-            statements.append("results = []")
+            predict_statements.append("results = []")
             median = pipeline.ensemble.median
 
+        # All fitted primitives go into one bundle file
+        bundle = PipelineBundle(pipeid, {
+            'pipeline': str(ens_pipeline),
+            'ensemble': ensembling,
+            'index_column': self.data_manager.index_column,
+            'target_column': self.data_manager.target_columns[0]['colName'],
+            'input_columns': self.data_manager.input_columns,
+            'input_dtypes': self._input_dtypes(),
+            'media_type': self.data_manager.media_type.value if self.data_manager.media_type is not None else None},
+            store=model_store)
+        bundlefilename = "models%s%s.bundle" % (os.sep, pipeid)
+        statements.append("\nbundle = PipelineBundle.load(temp_storage_root + '%s%s')" % (os.sep, bundlefilename))
+        if slim:
+            statements.append("hp = PipelineRuntime.from_manifest(bundle.manifest)")
+
         variable_cache = {}
         varindex = 0
         for pipe_i in range(n_pipelines):
-            statements.append("\ntestdata_0 = data_manager.input_data")
             if ensembling:
                 pipeline = ens_pipeline.ensemble.pipelines[pipe_i]
 
@@ -753,46 +850,18 @@ class ExecutionHelper(object):
                 varindex += 1
 
                 primid = "primitive_%s" % str(index)
-                try:
-                    statements.append("\nprint('\\nExecuting %s...')" % primitive)
-                    # Remove executables(instances) from not persistent primitives
-                    # as many of them have pickling(serialization) issues
-                    execs = primitive.executables
-                    if not primitive.is_persistent:
-                        if primitive.column_primitive:
-                            execs = {}
-                            for colname in primitive.executables.keys():
-                                execs[colname] = primitive.executables[colname]
-                                primitive.executables[colname] = None
-                        else:
-                            execs = primitive.executables
-                            primitive.executables = None
-
-                    primfilename = "models%s%s.%s.pkl" % (os.sep, pipeid, primid)
-                    primfile = "%s%s%s" % (tmp_dir, os.sep, primfilename)
-                    statements.append("primfile = temp_storage_root + '%s%s'" % (os.sep, primfilename))
-                    statements.append("%s = sklearn.externals.joblib.load(primfile)" % primid)
-
-                    # Remove pipeline from pickling
-                    pipe = primitive.pipeline
-                    primitive.pipeline = None
-
-                    joblib.dump(primitive, primfile)
-                    # Restore pipeline after pickling is done
-                    primitive.pipeline = pipe
-                    # Restore executables(instances) after pickling(serialization) is done
-                    primitive.executables = execs
-                except Exception as e:
-                    sys.stderr.write("ERROR pickling %s : %s\n" % (primitive.name, e))
+                predict_statements.append("\nprint('\\nExecuting %s...')" % primitive)
+                statements.append("%s = bundle.get_primitive('%s')" % (primid, primid))
+                bundle.add_primitive(primid, primitive)
 
                 if primitive.task == "Modeling":
                     # Initialize primitive
                     if not primitive.is_persistent:
                         mod, cls = primitive.cls.rsplit('.', 1)
                         imports.append(mod)
-                        statements.append("args = %s" % primitive.init_args)
-                        statements.append("kwargs = %s" % primitive.init_kwargs)
-                        statements.append("%s.executables = %s(*args, **kwargs)" % (primid, primitive.cls))
+                        predict_statements.append("args = %s" % primitive.init_args)
+                        predict_statements.append("kwargs = %s" % primitive.init_kwargs)
+                        predict_statements.append("%s.executables = %s(*args, **kwargs)" % (primid, primitive.cls))
 
                     #statements.append("\nprint('\\nStoring results in %s' % predictions_file)")
                     #statements.append("if not os.path.exists(results_root):")
@@ -800,52 +869,101 @@ class ExecutionHelper(object):
                     target_column = self.data_manager.target_columns[0]['colName']
 
                     if primitive.unified_interface:
-                        statements.append("result = pandas.DataFrame(%s.executables.produce(inputs=%s).value, index=%s.index, columns=['%s'])" %
+                        predict_statements.append("result = pandas.DataFrame(%s.executables.produce(inputs=%s).value, index=%s.index, columns=['%s'])" %
                             (primid, varid, varid, target_column))
                     else:
-                        statements.append("result = pandas.DataFrame(%s.executables.predict(%s), index=%s.index, columns=['%s'])" %
+                        predict_statements.append("result = pandas.DataFrame(%s.executables.predict(%s), index=%s.index, columns=['%s'])" %
                             (primid, varid, varid, target_column))
 
                     if ensembling:
-                        statements.append("results.append(result)")
+                        predict_statements.append("results.append(result)")
+                    bundle.add_step(primid, primitive.task, varid, 'result',
+                                    construct=not primitive.is_persistent)
 
                 else:
                     if primitive.task == "PreProcessing":
-                        statements.append("%s = hp.test_execute_primitive(%s, %s)" % (newvarid, primid, varid))
+                        predict_statements.append("%s = hp.test_execute_primitive(%s, %s)" % (newvarid, primid, varid))
                     elif primitive.task == "FeatureExtraction":
-                        statements.append("%s = hp.test_featurise(%s, %s)" % (newvarid, primid, varid))
+                        predict_statements.append("%s = hp.test_featurise(%s, %s)" % (newvarid, primid, varid))
+                    bundle.add_step(primid, primitive.task, varid, newvarid)
 
                 index += 1
 
-        # Write results
-        statements.append("\nprint('\\nStoring results in %s' % predictions_file)")
-        statements.append("if not os.path.exists(results_root):")
-        statements.append("    os.makedirs(results_root)")
-        statements.append("")
-
-        # transform categorical labels?
-        if not ensembling:
-            statements.append("result.to_csv(predictions_file, index_label='%s')" % self.data_manager.index_column)
-        else:
-            statements.append("results_np = numpy.array([df.values for df in results])")
+        if ensembling:
+            predict_statements.append("results_np = numpy.array([df.values for df in results])")
             # ONLY to how many pipelines have executed
             weights_string = ', '.join([str(w) for w in ens_pipeline.ensemble.pipeline_weights[:pipe_i+1]])
-            statements.append("weights_np = numpy.array([%s]).astype(numpy.int32)" % weights_string)
+            predict_statements.append("weights_np = numpy.array([%s]).astype(numpy.int32)" % weights_string)
             #statements.append("weighted_total = numpy.array([df*const for df, const in zip(results_np, weights_np)])")
             #statements.append("average_pred = numpy.sum(weighted_total, axis = 0)/numpy.sum(weights_np)")
 
             if median:
-                statements.append("results_np = numpy.repeat(results_np, repeats = weights_np, axis = 0)")
-                statements.append("ens_pred = numpy.median(results_np, axis = 0)")
+                predict_statements.append("results_np = numpy.repeat(results_np, repeats = weights_np, axis = 0)")
+                predict_statements.append("ens_pred = numpy.median(results_np, axis = 0)")
             else:
-                statements.append("weight_mask = numpy.multiply(weights_np[:,numpy.newaxis, numpy.newaxis], numpy.logical_and(results_np >= %s, results_np <= %s))" % (low_pred, hi_pred))
-                statements.append("ens_pred = numpy.average(results_np, axis = 0, weights = weight_mask)")
+                predict_statements.append("weight_mask = numpy.multiply(weights_np[:,numpy.newaxis, numpy.newaxis], numpy.logical_and(results_np >= %s, results_np <= %s))" % (low_pred, hi_pred))
+                predict_statements.append("ens_pred = numpy.average(results_np, axis = 0, weights = weight_mask)")
 
             if ens_pipeline.ensemble.discrete_metric:
-                statements.append("ens_pred = numpy.rint(ens_pred)")
-            statements.append("result = pandas.DataFrame(ens_pred, index=testdata_0.index, columns=['%s'])" % self.data_manager.target_columns[0]['colName'])
-            statements.append("result.to_csv(predictions_file, index_label='%s')" % self.data_manager.index_column)
+                predict_statements.append("ens_pred = numpy.rint(ens_pred)")
+            predict_statements.append("result = pandas.DataFrame(ens_pred, index=testdata_0.index, columns=['%s'])" % self.data_manager.target_columns[0]['colName'])
             # ~ timeout check
+            bundle.manifest['ensemble_combination'] = {
+                'weights': list(ens_pipeline.ensemble.pipeline_weights[:pipe_i+1]),
+                'median': bool(median),
+                'prediction_range': [low_pred, hi_pred],
+                'discrete': bool(ens_pipeline.ensemble.discrete_metric)}
+
+        if config.get('compile_learners', False):
+            # Replace the fitted learners by compiled evaluators, checked on training rows
+            try:
+                sample = self.data_manager.input_data.iloc[:config.get('compile_check_rows', 1000)].copy()
+                compiled = compile_bundle(bundle, self.get_runtime(), sample)
+            except Exception as e:
+                sys.stderr.write("ERROR compiling learners of %s : %s\n" % (pipeid, e))
+                compiled = []
+            if compiled:
+                print("Compiled learners %s of pipeline %s" % (compiled, pipeid))
+                # Folded glue steps are skipped, so predict with the recorded steps
+                predict_statements = ["result = %s.predict(bundle, testdata_0)" %
+                                      ("hp" if slim else "hp.get_runtime()")]
+
+        try:
+            bundle.save("%s%s%s" % (tmp_dir, os.sep, bundlefilename))
+        except Exception as e:
+            sys.stderr.write("ERROR pickling bundle %s : %s\n" % (pipeid, e))
+
+        statements.append("\ndef predict(testdata_0):")
+        for st in predict_statements:
+            statements.append("\n".join([("    " + line) if line else line for line in st.split("\n")]))
+        statements.append("    return result")
+
+        # Write results
+        statements.append("\nprint('\\nStoring results in %s' % predictions_file)")
+        statements.append("if not os.path.exists(results_root):")
+        statements.append("    os.makedirs(results_root)")
+        statements.append("")
+
+        # transform categorical labels?
+        if slim:
+            statements.append("# Predict the whole test set, or one chunk of rows at a time when streaming")
+            statements.append("header = True")
+            statements.append("for testdata in hp.iter_test_data(problem_root, problem_schema, test_data_root, dataset_schema, chunksize=stream_chunksize):")
+            statements.append("    result = predict(testdata)")
+            statements.append("    result.to_csv(predictions_file, mode='w' if header else 'a', header=header, index_label='%s')" % self.data_manager.index_column)
+            statements.append("    header = False")
+        else:
+            statements.append("if stream_chunksize:")
+            statements.append("    # Predict one chunk of rows at a time, and append to the predictions file")
+            statements.append("    header = True")
+            statements.append("    for testdata in data_manager.initialize_data_chunks(problem, [dataset], view='TEST', chunksize=stream_chunksize):")
+            statements.append("        result = predict(testdata)")
+            statements.append("        result.to_csv(predictions_file, mode='w' if header else 'a', header=header, index_label='%s')" % self.data_manager.index_column)
+            statements.append("        header = False")
+            statements.append("else:")
+            statements.append("    data_manager.initialize_data(problem, [dataset], view='TEST')")
+            statements.append("    result = predict(data_manager.input_data)")
+            statements.append("    result.to_csv(predictions_file, index_label='%s')" % self.data_manager.index_column)
 
         # Write executable
         exfilename = "%s%s%s" % (exec_dir, os.sep, pipeid)
@@ -858,9 +976,7 @@ class ExecutionHelper(object):
         os.chmod(exfilename, 0o755)
 
     def _call_function(self, scoring_function, *args):
-        mod = inspect.getmodule(scoring_function)
         try:
-            module = importlib.import_module(mod.__name__)
             return scoring_function(*args)
         except Exception as e:
             sys.stderr.write("ERROR: _call_function {}: {}\n".format(scoring_function, e))
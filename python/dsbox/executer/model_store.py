@@ -0,0 +1,72 @@
+'''Content addressed store of fitted primitive executables'''
+
+import os
+import pickle
+import threading
+import uuid
+
+from hashlib import blake2b
+
+from sklearn.externals import joblib
+
+
+class ModelStore(object):
+    """
+    Stores each distinct fitted executable once, under the hash of its
+    pickled content, so that many exported pipelines can refer to it.
+
+    Executables shared between pipelines (the ResourceManager primitive
+    cache hands the same fitted object to every pipeline with the same
+    prefix) are only pickled and hashed once, until release(). Files are
+    written uncompressed, so they can be loaded with mmap_mode='r'.
+    Safe to use from several export threads.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # id(object) -> [object, key, lock]. The object is kept so the id is not reused.
+        self._keys = {}
+        # key -> loaded object
+        self._loaded = {}
+
+    def release(self):
+        '''Forgets the stored and loaded objects, so they can be freed'''
+        with self._lock:
+            self._keys = {}
+            self._loaded = {}
+
+    def put(self, obj):
+        '''Stores the object if it is not stored yet, and returns its key'''
+        with self._lock:
+            entry = self._keys.get(id(obj))
+            if entry is None:
+                entry = [obj, None, threading.Lock()]
+                self._keys[id(obj)] = entry
+        with entry[2]:
+            if entry[1] is None:
+                entry[1] = self._write(obj)
+        return entry[1]
+
+    def get(self, key, mmap_mode='r'):
+        with self._lock:
+            if key in self._loaded:
+                return self._loaded[key]
+        obj = joblib.load(self.get_path(key), mmap_mode=mmap_mode)
+        with self._lock:
+            return self._loaded.setdefault(key, obj)
+
+    def get_path(self, key):
+        return os.path.join(self.root, "%s.pkl" % key)
+
+    def _write(self, obj):
+        key = blake2b(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), digest_size=20).hexdigest()
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            # Write to a temporary file first, other processes may be reading the store
+            tmppath = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+            joblib.dump(obj, tmppath)
+            os.replace(tmppath, path)
+        return key
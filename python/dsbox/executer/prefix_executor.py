@@ -0,0 +1,235 @@
+'''Test time execution of several pipelines with shared prefixes'''
+
+import sys
+import copy
+import traceback
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+
+
+def predict_remote(executables, unified_interface, df):
+    '''Returns (index, predictions) of a fitted learner. Module level, so
+    that it can be run in a worker process'''
+    if unified_interface:
+        return (df.index, executables.produce(inputs=df).value)
+    return (df.index, executables.predict(df))
+
+
+class PrefixNode(object):
+    '''Node of the prefix tree. Holds the primitive applied at this node,
+    and the learners (member index, primitive) that consume its output'''
+    def __init__(self, primitive=None):
+        self.primitive = primitive
+        self.children = OrderedDict()
+        self.learners = []
+
+
+class PrefixExecutor(object):
+    """
+    Runs the test data through many pipelines at once.
+
+    All pipelines, and the members of ensemble pipelines, are merged into
+    a tree keyed by the same primitive cache keys the ResourceManager uses
+    during training. Each distinct PreProcessing/FeatureExtraction prefix
+    is applied once, and the learners hanging off the tree are run in
+    parallel on the executor (inline if there is none).
+    """
+
+    def __init__(self, helper, executor=None):
+        self.helper = helper
+        self.executor = executor
+
+    def get_members(self, pipeline):
+        '''Returns the pipelines whose predictions make up the pipeline result'''
+        if pipeline.ensemble is not None:
+            try:
+                return list(pipeline.ensemble.pipelines)
+            except:
+                pass
+        return [pipeline]
+
+    def build_prefix_tree(self, members):
+        root = PrefixNode()
+        for index, member in enumerate(members):
+            node = root
+            cachekey = ""
+            for primitive in member.primitives:
+                if primitive.task == "Modeling":
+                    node.learners.append((index, primitive))
+                    break
+                cachekey = "%s.%s" % (cachekey, primitive)
+                if cachekey not in node.children:
+                    node.children[cachekey] = PrefixNode(primitive)
+                node = node.children[cachekey]
+        return root
+
+    def execute(self, pipelines, df, target_data, target_col):
+        '''Generator of (pipeline, predictions, metric values), in order of completion.
+        Predictions is None if none of the pipeline members could be run.'''
+        members = []
+        owners = []
+        for pipeline in pipelines:
+            for member in self.get_members(pipeline):
+                members.append(member)
+                owners.append(pipeline)
+
+        root = self.build_prefix_tree(members)
+        futures = OrderedDict()
+        self._apply(root, pd.DataFrame(copy.copy(df)), futures)
+
+        # Members without a learner, or whose prefix failed, have no result
+        submitted = set(futures.values())
+        remaining = OrderedDict((pipeline.id, 0) for pipeline in pipelines)
+        results = dict((pipeline.id, []) for pipeline in pipelines)
+        for index in submitted:
+            remaining[owners[index].id] += 1
+
+        for pipeline in pipelines:
+            if remaining[pipeline.id] == 0:
+                yield self._aggregate(pipeline, [], target_data)
+
+        for future in concurrent.futures.as_completed(list(futures.keys())):
+            index = futures[future]
+            pipeline = owners[index]
+            try:
+                (result_index, ypred) = future.result()
+                results[pipeline.id].append(pd.DataFrame(ypred, index=result_index, columns=[target_col]))
+            except Exception as e:
+                sys.stderr.write("ERROR test(%s) : %s\n" % (members[index], e))
+            remaining[pipeline.id] -= 1
+            if remaining[pipeline.id] == 0:
+                yield self._aggregate(pipeline, results[pipeline.id], target_data)
+
+    def _apply(self, node, df, futures):
+        for (index, primitive) in node.learners:
+            print("Executing %s" % primitive)
+            sys.stdout.flush()
+            futures[self._submit(primitive, df)] = index
+
+        # The input is still needed if other branches or pending learners use it
+        shared = len(node.children) > 1 or len(node.learners) > 0
+        for child in node.children.values():
+            primitive = child.primitive
+            testdf = df.copy() if shared else df
+            try:
+                print("Executing %s" % primitive)
+                sys.stdout.flush()
+                if primitive.task == "PreProcessing":
+                    testdf = self.helper.test_execute_primitive(primitive, testdf)
+                elif primitive.task == "FeatureExtraction":
+                    testdf = self.helper.test_featurise(primitive, testdf)
+            except Exception as e:
+                sys.stderr.write("ERROR test(%s) : %s\n" % (primitive, e))
+                traceback.print_exc()
+                testdf = None
+            if testdf is not None:
+                self._apply(child, testdf, futures)
+
+    def _submit(self, primitive, df):
+        if self.executor is not None:
+            future = self.executor.submit(predict_remote, primitive.executables,
+                                          primitive.unified_interface, df)
+        else:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(predict_remote(primitive.executables, primitive.unified_interface, df))
+            except Exception as e:
+                future.set_exception(e)
+        return future
+
+    def partial_fit(self, pipelines, chunks, classes=None):
+        '''Fits the learners of the pipelines again over a stream of (input,
+        target) chunks, with partial_fit, one pass over the stream. The
+        prefixes are applied once per chunk, with their fitted primitives.
+        Learners without partial_fit keep their executables. Returns the
+        number of refitted learners.'''
+        members = []
+        for pipeline in pipelines:
+            members.extend(self.get_members(pipeline))
+        root = self.build_prefix_tree(members)
+
+        # id(primitive) -> (primitive, new executable)
+        learners = OrderedDict()
+        failed = set()
+        for (df, target) in chunks:
+            self._partial_fit(root, pd.DataFrame(copy.copy(df)), target.values.ravel(),
+                              classes, learners, failed)
+        refitted = 0
+        for key, (primitive, executable) in learners.items():
+            if key not in failed:
+                primitive.executables = executable
+                refitted += 1
+        return refitted
+
+    def _partial_fit(self, node, df, y, classes, learners, failed):
+        from sklearn.base import is_classifier
+        for (_, primitive) in node.learners:
+            key = id(primitive)
+            if (key in failed or primitive.unified_interface or
+                    not hasattr(primitive.executables, 'partial_fit')):
+                continue
+            try:
+                if key not in learners:
+                    executable = self.helper.instantiate_primitive(primitive)
+                    if executable is None:
+                        failed.add(key)
+                        continue
+                    learners[key] = (primitive, executable)
+                executable = learners[key][1]
+                if is_classifier(executable):
+                    # Every call needs all the classes, a chunk may not have them
+                    executable.partial_fit(df, y, classes=classes if classes is not None
+                                           else primitive.executables.classes_)
+                else:
+                    executable.partial_fit(df, y)
+            except Exception as e:
+                # Keep the learner fitted on the sample
+                sys.stderr.write("ERROR: partial_fit {}: {}\n".format(primitive.name, e))
+                failed.add(key)
+
+        shared = len(node.children) > 1 or len(node.learners) > 0
+        for child in node.children.values():
+            primitive = child.primitive
+            chunkdf = df.copy() if shared else df
+            try:
+                if primitive.task == "PreProcessing":
+                    chunkdf = self.helper.test_execute_primitive(primitive, chunkdf)
+                elif primitive.task == "FeatureExtraction":
+                    chunkdf = self.helper.test_featurise(primitive, chunkdf)
+            except Exception as e:
+                sys.stderr.write("ERROR: partial_fit({}) : {}\n".format(primitive, e))
+                chunkdf = None
+            if chunkdf is not None:
+                self._partial_fit(child, chunkdf, y, classes, learners, failed)
+            else:
+                # The learners below would miss this chunk
+                failed.update(id(learner) for (_, learner) in self._subtree_learners(child))
+
+    def _subtree_learners(self, node):
+        for learner in node.learners:
+            yield learner
+        for child in node.children.values():
+            for learner in self._subtree_learners(child):
+                yield learner
+
+    def _aggregate(self, pipeline, results, target_data):
+        '''Averages the member predictions, and the member metric values'''
+        num_members = len(self.get_members(pipeline))
+        metric_values = dict((metric.name, 0.0) for metric in self.helper.problem.metrics)
+        if not results:
+            return (pipeline, None, metric_values)
+
+        # Score the results of all members at once
+        predictions = np.column_stack([result.values.ravel() for result in results])
+        scores = self.helper.scoring.score(target_data, predictions)
+        for metric in self.helper.problem.metrics:
+            metric_values[metric.name] = np.nansum(scores[metric.name][0]) / num_members
+
+        res = pd.DataFrame(np.mean(np.array([result.values for result in results]), axis=0),
+                           index=results[0].index, columns=results[0].columns)
+        return (pipeline, res, metric_values)
+
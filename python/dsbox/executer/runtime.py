@@ -0,0 +1,409 @@
+'''Minimal runtime for scoring with exported pipelines.
+
+Only NumPy and pandas are imported up front. Primitive classes, media
+libraries and the planner data loading stack are imported when needed,
+so that generated executables start scoring quickly.
+'''
+
+import os
+import sys
+import json
+import importlib
+
+import numpy as np
+import pandas as pd
+
+from dsbox.schema.dataset_schema import VariableFileType
+
+DEFAULT_DATA_DOC = "datasetDoc.json"
+DEFAULT_PROBLEM_DOC = "problemDoc.json"
+# Images converted to float32 and featurized at once
+IMAGE_BATCH_ROWS = 256
+
+
+def needs_problem_args(primitive):
+    '''True if the primitive is instantiated at test time with arguments
+    that depend on the problem (such as *SCORER), see ExecutionHelper._get_arg_value'''
+    if primitive.is_persistent:
+        return False
+    args = list(primitive.getInitArgs() or []) + list((primitive.getInitKeywordArgs() or {}).values())
+    return any(isinstance(arg, str) and arg.startswith('*') for arg in args)
+
+
+class PipelineRuntime(object):
+    """
+    Applies fitted primitives to test data.
+
+    This is the test time part of ExecutionHelper, which uses it for
+    test_execute_primitive and test_featurise. Generated executables use
+    it directly, with the media type and input columns recorded in the
+    pipeline bundle manifest, so they do not need the planner modules.
+    """
+
+    def __init__(self, media_type=None, input_columns=None, index_column=None, helper=None, input_dtypes=None):
+        self.media_type = media_type
+        self.input_columns = input_columns if input_columns is not None else []
+        self.index_column = index_column
+        # Column name -> dtype name of the training input data
+        self.input_dtypes = input_dtypes if input_dtypes is not None else {}
+        # ExecutionHelper used to instantiate primitives, if available
+        self.helper = helper
+        # Column name -> SharedTensor of decoded images (see ImageResource)
+        self.image_tensors = {}
+        # Column name -> PackedSeries of time series (see TimeSeriesResource)
+        self.packed_series = {}
+
+    @staticmethod
+    def from_manifest(manifest):
+        media_type = manifest.get('media_type', None)
+        return PipelineRuntime(
+            VariableFileType(media_type) if media_type is not None else None,
+            manifest.get('input_columns', []),
+            manifest.get('index_column', None),
+            input_dtypes=manifest.get('input_dtypes', {}))
+
+    def predict(self, bundle, testdata, variables=None):
+        '''Runs the recorded steps of the bundle on the test data. Same as the
+        predict function of the generated executable. If a variables dict is
+        given, it is filled with the pipeline variables.'''
+        manifest = bundle.manifest
+        if variables is None:
+            variables = {}
+        variables['testdata_0'] = testdata
+        results = []
+        for step in manifest['steps']:
+            if step.get('folded', False):
+                # Glue step folded into the compiled learner it feeds
+                continue
+            primitive = bundle.get_primitive(step['id'])
+            df = variables[step['input']]
+            if step['task'] == "Modeling":
+                if step['construct']:
+                    mod, cls = primitive.cls.rsplit('.', 1)
+                    PrimitiveClass = getattr(importlib.import_module(mod), cls)
+                    primitive.executables = PrimitiveClass(*primitive.init_args, **primitive.init_kwargs)
+                if primitive.unified_interface:
+                    ypred = primitive.executables.produce(inputs=df).value
+                else:
+                    ypred = primitive.executables.predict(df)
+                results.append(pd.DataFrame(ypred, index=df.index, columns=[manifest['target_column']]))
+            elif step['task'] == "PreProcessing":
+                variables[step['output']] = self.test_execute_primitive(primitive, df)
+            elif step['task'] == "FeatureExtraction":
+                variables[step['output']] = self.test_featurise(primitive, df)
+
+        combination = manifest.get('ensemble_combination', None)
+        if combination is None:
+            return results[-1]
+
+        results_np = np.array([df.values for df in results])
+        weights_np = np.array(combination['weights']).astype(np.int32)
+        if combination['median']:
+            results_np = np.repeat(results_np, repeats=weights_np, axis=0)
+            ens_pred = np.median(results_np, axis=0)
+        else:
+            [low_pred, hi_pred] = combination['prediction_range']
+            weight_mask = np.multiply(weights_np[:, np.newaxis, np.newaxis],
+                                      np.logical_and(results_np >= low_pred, results_np <= hi_pred))
+            ens_pred = np.average(results_np, axis=0, weights=weight_mask)
+        if combination['discrete']:
+            ens_pred = np.rint(ens_pred)
+        return pd.DataFrame(ens_pred, index=testdata.index, columns=[manifest['target_column']])
+
+    def instantiate_primitive(self, primitive):
+        if self.helper is not None:
+            return self.helper.instantiate_primitive(primitive)
+        mod, cls = primitive.cls.rsplit('.', 1)
+        try:
+            PrimitiveClass = getattr(importlib.import_module(mod), cls)
+            if primitive.unified_interface:
+                return PrimitiveClass(hyperparams=primitive.getHyperparams())
+            return PrimitiveClass(*(primitive.getInitArgs() or []), **(primitive.getInitKeywordArgs() or {}))
+        except Exception as e:
+            sys.stderr.write("ERROR: instantiate_primitive {}: {}\n".format(primitive.name, e))
+            return None
+
+    def test_execute_primitive(self, primitive, df):
+        persistent = primitive.is_persistent
+        indices = df.index
+        if primitive.column_primitive:
+            # A primitive that is run per column
+            for col in df.columns:
+                colname = col.format()
+                # If during test phase, this column wasn't hash
+                if colname not in primitive.executables.keys():
+                    continue
+
+                executable = None
+                if not persistent:
+                    executable = self.instantiate_primitive(primitive)
+                else:
+                    executable = primitive.executables.get(colname, None)
+
+                if executable is None:
+                    return None
+
+                try:
+                    # FIXME: Hack for Label encoder for python3 (cannot handle missing values)
+                    if (primitive.name == "Label Encoder") and (sys.version_info[0] == 3):
+                        if df[col].dtype.name == 'category':
+                            fill = '' if df[col].cat.categories.dtype == object else 0
+                            df[col] = df[col].astype(object).fillna(fill)
+                        elif df[col].dtype == object:
+                            df[col] = df[col].fillna('')
+                        else:
+                            df[col] = df[col].fillna(0)
+                    df[col] = self._transform(primitive, executable, df[col], persistent)
+                except Exception as e:
+                    sys.stderr.write("ERROR: execute_primitive {}: {}\n".format(primitive.name, e))
+                    return None
+        else:
+            if not persistent:
+                primitive.executables = self.instantiate_primitive(primitive)
+            if primitive.executables is None:
+                return None
+            df = self._transform(primitive, primitive.executables, df, persistent)
+
+        return pd.DataFrame(df, index=indices)
+
+    def _transform(self, primitive, executable, df, persistent):
+        '''Test time part of ExecutionHelper._execute_primitive'''
+        if primitive.unified_interface:
+            if persistent:
+                return executable.produce(inputs=df).value
+            from primitive_interfaces.generator import GeneratorPrimitiveBase
+            from primitive_interfaces.supervised_learning import SupervisedLearnerPrimitiveBase
+            from primitive_interfaces.unsupervised_learning import UnsupervisedLearnerPrimitiveBase
+            if isinstance(executable, SupervisedLearnerPrimitiveBase):
+                executable.set_training_data(inputs=df, outputs=None)
+            elif isinstance(executable, UnsupervisedLearnerPrimitiveBase):
+                executable.set_training_data(inputs=df)
+            elif isinstance(executable, GeneratorPrimitiveBase):
+                executable.set_training_data(outputs=None)
+            executable.fit()
+            return executable.produce(inputs=df).value
+        if persistent:
+            return executable.transform(df)
+        return executable.fit_transform(df)
+
+    def test_featurise(self, primitive, df):
+        persistent = primitive.is_persistent
+        ncols = [col.format() for col in df.columns]
+        featurecols = self.raw_data_columns(self.input_columns)
+        indices = df.index
+        for col in featurecols:
+            executable = None
+            if not persistent:
+                executable = self.instantiate_primitive(primitive)
+            else:
+                executable = primitive.executables[col]
+            if executable is None:
+                return None
+
+            if self.media_type == VariableFileType.TEXT:
+                # Using an unfitted primitive for each column (needed for Corex)
+                import scipy.sparse
+                if persistent:
+                    call_result = executable.produce(df[col])
+                else:
+                    executable.fit()
+                    call_result = executable.produce(inputs=df[col].values)
+
+                val = call_result.value.todense() if isinstance(call_result.value, scipy.sparse.csr_matrix) else call_result.value
+                fcols = [(col.format() + "_" + str(index)) for index in range(0, val.shape[1])]
+                newdf = pd.DataFrame(val, columns=fcols, index=df.index)
+                del df[col]
+                ncols = ncols + fcols
+                ncols.remove(col)
+                df = pd.concat([df, newdf], axis=1)
+                df.columns=ncols
+            elif self.media_type == VariableFileType.TIMESERIES:
+                call_result = executable.produce(inputs=self.series_inputs(col, df[col].values))
+                features = call_result.value
+                fcols = [(col.format() + "_" + str(index)) for index in range(0, features.shape[1])]
+                newdf = pd.DataFrame(call_result.value, columns=fcols, index=df.index)
+                del df[col]
+                ncols = ncols + fcols
+                ncols.remove(col)
+                df = pd.concat([df, newdf], axis=1)
+                df.columns = ncols
+            elif self.media_type == VariableFileType.IMAGE:
+                nvals = self.image_features(executable, col, df[col].values)
+                fcols = [(col.format() + "_" + str(index)) for index in range(0, nvals.shape[1])]
+                newdf = pd.DataFrame(nvals, columns=fcols, index=df.index)
+                del df[col]
+                ncols = ncols + fcols
+                ncols.remove(col)
+                df = pd.concat([df, newdf], axis=1)
+                df.columns=ncols
+            elif self.media_type == VariableFileType.AUDIO:
+                # Featurize audio
+                call_result = executable.produce(inputs=pd.DataFrame(df[col]))
+                features = call_result.value
+                rows = []
+                for row_list in features:
+                    total = np.zeros((row_list[0].size,))
+                    for elt in row_list:
+                        total += elt.flatten()
+                    total /= len(row_list)
+                    rows.append(total)
+                col_names = ['{}_{}'.format(col.format(), i) for i in range(total.size)]
+
+                newdf = pd.DataFrame(rows, index=df.index, columns=col_names)
+
+                # FIXME: Need to be more general
+                df.drop(['filename', 'start', 'end'], axis=1, inplace=True)
+                df = pd.concat([df, newdf], axis=1)
+
+        return pd.DataFrame(df, index=indices)
+
+    def raw_data_columns(self, columns):
+        cols = []
+        for col in columns:
+            if ("refersTo" in col or
+                    col['colType'] == "string"):
+                cols.append(col['colName'])
+        return cols
+
+    def series_inputs(self, colname, values):
+        '''The time series of a column. If the column is backed by a
+        PackedSeries, values are series indices, and those series are taken'''
+        if colname in self.packed_series:
+            return self.packed_series[colname].take(values)
+        return values
+
+    def image_features(self, executable, colname, values):
+        '''Features of the images in a column, produced one batch at a time'''
+        features = []
+        for start in range(0, len(values), IMAGE_BATCH_ROWS):
+            image_tensor = self._as_tensor(values[start:start + IMAGE_BATCH_ROWS], colname)
+            features.append(executable.produce(inputs=image_tensor).value)
+        return np.concatenate(features)
+
+    def _as_tensor(self, image_list, colname=None):
+        '''float32 tensor of the images. If the column is backed by a shared
+        tensor, image_list holds rows of that tensor'''
+        if colname in self.image_tensors:
+            return self.image_tensors[colname].rows(image_list).astype(np.float32)
+        from keras.preprocessing import image
+        shape = (len(image_list), ) + image.img_to_array(image_list[0]).shape
+        result = np.empty(shape)
+        for i in range(len(image_list)):
+            result[i] = image.img_to_array(image_list[i])
+        return result
+
+    def iter_test_data(self, problem_root, problem_schema, test_data_root, dataset_schema, chunksize=None):
+        '''Generator of the test input data, in chunks of rows if chunksize is set.
+        Datasets with a single table and no filters are read directly, others
+        are loaded with the planner DataManager.'''
+        table = self._single_table(problem_root, problem_schema, test_data_root, dataset_schema)
+        if table is None:
+            for testdata in self._iter_data_manager(problem_root, problem_schema, test_data_root, dataset_schema, chunksize):
+                yield testdata
+            return
+
+        (tablefile, splitsfile) = table
+        splits = None
+        if splitsfile is not None:
+            splits = pd.read_csv(splitsfile, index_col='d3mIndex')
+            splits = splits[splits['type'] == 'TEST']
+        colnames = [col['colName'] for col in self.input_columns]
+        usecols = colnames + ([self.index_column] if self.index_column is not None else [])
+        if chunksize:
+            for chunk in self._read_chunks(tablefile, chunksize, index_col=self.index_column, usecols=usecols):
+                if splits is not None:
+                    chunk = chunk[chunk.index.isin(splits.index)]
+                if len(chunk) > 0:
+                    yield chunk[colnames]
+        else:
+            df = self._read_csv(tablefile, index_col=self.index_column, usecols=usecols)
+            if splits is not None:
+                df = df.loc[splits.index]
+            yield df[colnames]
+
+    def apply_dtypes(self, df):
+        '''Casts the columns of df to the dtypes of the training input data,
+        where the values allow it'''
+        for colname, dtype in self.input_dtypes.items():
+            if colname in df.columns and str(df[colname].dtype) != dtype:
+                try:
+                    df[colname] = df[colname].astype(dtype)
+                except (ValueError, TypeError):
+                    pass
+        return df
+
+    def _read_csv(self, tablefile, **kwargs):
+        '''Reads a test table with the dtypes of the training input data'''
+        if self.input_dtypes:
+            try:
+                return pd.read_csv(tablefile, dtype=self.input_dtypes, **kwargs)
+            except (ValueError, TypeError) as e:
+                # Values that do not match the training dtypes
+                sys.stderr.write("ERROR: reading {} with training dtypes: {}\n".format(tablefile, e))
+        return self.apply_dtypes(pd.read_csv(tablefile, **kwargs))
+
+    def _read_chunks(self, tablefile, chunksize, **kwargs):
+        '''Same as _read_csv, in chunks of rows'''
+        nrows = 0
+        if self.input_dtypes:
+            try:
+                for chunk in pd.read_csv(tablefile, dtype=self.input_dtypes, chunksize=chunksize, **kwargs):
+                    nrows += len(chunk)
+                    yield chunk
+                return
+            except (ValueError, TypeError) as e:
+                sys.stderr.write("ERROR: reading {} with training dtypes: {}\n".format(tablefile, e))
+        # Read the rest of the rows (after the header and the rows already read)
+        for chunk in pd.read_csv(tablefile, chunksize=chunksize, skiprows=range(1, nrows + 1), **kwargs):
+            yield self.apply_dtypes(chunk)
+
+    def load_test_data(self, problem_root, problem_schema, test_data_root, dataset_schema):
+        for testdata in self.iter_test_data(problem_root, problem_schema, test_data_root, dataset_schema):
+            return testdata
+
+    def _single_table(self, problem_root, problem_schema, test_data_root, dataset_schema):
+        '''Returns (table file, splits file) if the test data can be read
+        without the DataManager, or None'''
+        if not self.input_columns or self.media_type is not None:
+            return None
+        problem_doc = problem_schema if problem_schema else os.path.join(problem_root, DEFAULT_PROBLEM_DOC)
+        dataset_doc = dataset_schema if dataset_schema else os.path.join(test_data_root, DEFAULT_DATA_DOC)
+        with open(problem_doc, 'r') as f:
+            prDoc = json.load(f)
+        with open(dataset_doc, 'r') as f:
+            dsDoc = json.load(f)
+
+        # References and filters change the columns, leave those to the DataManager
+        if any(dsitem.get("filters", {}) for dsitem in prDoc["inputs"]["data"]):
+            return None
+        resources = dsDoc["dataResources"]
+        if len(resources) != 1 or resources[0]["resType"] != "table":
+            return None
+        if any("refersTo" in col for col in resources[0].get("columns", [])):
+            return None
+
+        splitsfile = None
+        splits = prDoc["inputs"].get("dataSplits", {}).get("splitsFile", None)
+        if splits is not None:
+            splitsfile = os.path.join(problem_root, splits)
+        return (os.path.join(test_data_root, resources[0]["resPath"]), splitsfile)
+
+    def _iter_data_manager(self, problem_root, problem_schema, test_data_root, dataset_schema, chunksize):
+        from dsbox.planner.common.data_manager import Dataset, DataManager
+        from dsbox.planner.common.problem_manager import Problem
+
+        problem = Problem()
+        problem.load_problem(problem_root, problem_schema)
+        dataset = Dataset()
+        dataset.load_dataset(test_data_root, dataset_schema, streaming=bool(chunksize), problem=problem)
+        data_manager = DataManager()
+        if chunksize:
+            for testdata in data_manager.initialize_data_chunks(problem, [dataset], view='TEST', chunksize=chunksize):
+                self.image_tensors = data_manager.image_tensors
+                self.packed_series = data_manager.packed_series
+                yield testdata
+        else:
+            data_manager.initialize_data(problem, [dataset], view='TEST')
+            self.image_tensors = data_manager.image_tensors
+            self.packed_series = data_manager.packed_series
+            yield data_manager.input_data
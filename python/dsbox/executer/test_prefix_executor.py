@@ -0,0 +1,158 @@
+'''Tests of the test time execution of pipelines with shared prefixes.
+Run with pytest.'''
+
+import numpy as np
+import pandas as pd
+
+import dsbox.planner.controller
+
+from dsbox.executer.prefix_executor import PrefixExecutor
+from dsbox.planner.common.pipeline import Pipeline
+from dsbox.planner.common.primitive import Primitive
+from dsbox.planner.common.problem_manager import Problem
+from dsbox.planner.common.scoring import ScoringEngine
+from dsbox.planner.controller import Controller
+from dsbox.schema.problem_schema import Metric
+
+INPUT = pd.DataFrame({'a': [1.0, np.nan, 3.0, 4.0, np.nan, 6.0],
+                      'b': [0.5, 2.0, np.nan, 1.0, 3.0, 0.0]},
+                     index=[10, 11, 12, 13, 14, 15])
+TARGET = pd.DataFrame({'label': [0, 0, 1, 1, 0, 1]}, index=INPUT.index)
+
+
+class ThresholdModel(object):
+    '''Fitted learner: predicts 1 where the column is above the threshold'''
+    def __init__(self, column, threshold):
+        self.column = column
+        self.threshold = threshold
+
+    def predict(self, df):
+        assert not df.isnull().values.any()
+        return (df[self.column] > self.threshold).astype(int).values
+
+
+class ImputingHelper(object):
+    '''Stands in for the ExecutionHelper. Imputes missing values with 0,
+    and counts the prefix executions'''
+    def __init__(self, problem):
+        self.problem = problem
+        self.scoring = ScoringEngine(problem)
+        self.executed = []
+
+    def test_execute_primitive(self, primitive, df):
+        self.executed.append(primitive.name)
+        return df.fillna(0.0)
+
+    def test_featurise(self, primitive, df):
+        raise AssertionError("No feature extraction in these pipelines")
+
+
+class MemberEnsemble(object):
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+
+
+class EventHandler(object):
+    def ExecutedPipeline(self, pipeline):
+        return pipeline
+
+
+class ResourceManager(object):
+    executor = None
+
+    def __init__(self):
+        self.background = []
+        self.refitted = []
+
+    def refit_pipelines_in_background(self, pipelines):
+        self.background.extend(pipelines)
+
+    def refit_pipeline(self, pipeline):
+        self.refitted.append(pipeline)
+
+
+def make_problem():
+    problem = Problem()
+    problem.set_task_type('classification', 'binary')
+    problem.set_metrics([Metric.ACCURACY, Metric.F1])
+    return problem
+
+
+def imputer():
+    primitive = Primitive('imputer', 'Imputer', 'sklearn.preprocessing.Imputer')
+    primitive.task = "PreProcessing"
+    return primitive
+
+
+def learner(name, column, threshold):
+    primitive = Primitive(name, name, 'dsbox.test.%s' % name)
+    primitive.task = "Modeling"
+    primitive.executables = ThresholdModel(column, threshold)
+    return primitive
+
+
+def make_pipelines():
+    first = Pipeline(primitives=[imputer(), learner('LearnerA', 'a', 2.0)])
+    second = Pipeline(primitives=[imputer(), learner('LearnerB', 'b', 0.75)])
+    members = [Pipeline(primitives=[imputer(), learner('LearnerA', 'a', 2.0)]),
+               Pipeline(primitives=[imputer(), learner('LearnerC', 'a', 5.0)])]
+    ensemble = Pipeline(primitives=[], ensemble=MemberEnsemble(members))
+    return [first, second, ensemble]
+
+
+def baseline_metrics(problem, pipeline):
+    '''Average of the member metric values, as the original Controller.test computed them'''
+    members = pipeline.ensemble.pipelines if pipeline.ensemble is not None else [pipeline]
+    testdf = INPUT.fillna(0.0)
+    metric_values = dict((metric.name, 0.0) for metric in problem.metrics)
+    for member in members:
+        predictions = member.primitives[-1].executables.predict(testdf)
+        for metric, metric_fn in zip(problem.metrics, problem.metric_functions):
+            metric_values[metric.name] += metric_fn(TARGET.values.ravel(), predictions)
+    return dict((name, value / len(members)) for name, value in metric_values.items())
+
+
+def test_shared_prefix_applied_once():
+    problem = make_problem()
+    helper = ImputingHelper(problem)
+    pipelines = make_pipelines()
+    results = list(PrefixExecutor(helper).execute(pipelines, INPUT, TARGET, 'label'))
+
+    # The four learners all use the same Imputer prefix
+    assert helper.executed == ['Imputer']
+    assert sorted(pipeline.id for (pipeline, _, _) in results) == sorted(pipeline.id for pipeline in pipelines)
+    for (pipeline, predictions, metric_values) in results:
+        assert predictions is not None
+        assert list(predictions.index) == list(INPUT.index)
+        expected = baseline_metrics(problem, pipeline)
+        for name, value in expected.items():
+            assert np.isclose(metric_values[name], value), (pipeline, name)
+
+
+def test_controller_test_pipelines(monkeypatch):
+    problem = make_problem()
+    helper = ImputingHelper(problem)
+    monkeypatch.setattr(dsbox.planner.controller, 'ExecutionHelper', lambda problem, data_manager: helper)
+
+    class DataManager(object):
+        input_data = INPUT
+        target_data = TARGET
+        target_columns = [{'colName': 'label'}]
+
+    controller = Controller('.')
+    controller.problem = problem
+    controller.data_manager = DataManager()
+    controller.resource_manager = ResourceManager()
+    pipelines = make_pipelines()
+
+    events = list(controller.test_pipelines(pipelines, EventHandler()))
+
+    # Refits are submitted together before they are collected
+    assert controller.resource_manager.background == pipelines
+    assert controller.resource_manager.refitted == pipelines
+    assert helper.executed == ['Imputer']
+    assert sorted(pipeline.id for pipeline in events) == sorted(pipeline.id for pipeline in pipelines)
+    for pipeline in pipelines:
+        expected = baseline_metrics(problem, pipeline)
+        for name, value in expected.items():
+            assert np.isclose(pipeline.test_result.metric_values[name], value), (pipeline, name)
@@ -0,0 +1,105 @@
+'''Tests of the scheduling of the shared worker pool, with threads instead
+of worker processes. Run with pytest.'''
+
+import threading
+import time
+import concurrent.futures
+
+from dsbox.executer.worker_pool import WorkerPool, PRIORITY_BACKGROUND, PRIORITY_EXECUTION, PRIORITY_LOADING
+
+TIMEOUT = 10
+
+
+def thread_pool(max_workers):
+    return WorkerPool(max_workers, executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_workers))
+
+
+def record(started, name):
+    started.append(name)
+    return name
+
+
+def wait_until(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_priority_order():
+    pool = thread_pool(1)
+    release = threading.Event()
+    started = []
+    try:
+        blocker = pool.client("blocker").submit(release.wait, TIMEOUT)
+        background = pool.client("background", PRIORITY_BACKGROUND)
+        execution = pool.client("execution", PRIORITY_EXECUTION)
+        loading = pool.client("loading", PRIORITY_LOADING)
+        futures = [background.submit(record, started, "background-%d" % i) for i in range(2)]
+        futures += [execution.submit(record, started, "execution-%d" % i) for i in range(2)]
+        futures += [loading.submit(record, started, "loading")]
+        release.set()
+        concurrent.futures.wait(futures + [blocker], timeout=TIMEOUT)
+        assert started == ["loading", "execution-0", "execution-1", "background-0", "background-1"]
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_quota_holds_client():
+    pool = thread_pool(3)
+    release = threading.Event()
+    try:
+        limited = pool.client("limited", quota=1)
+        other = pool.client("other", PRIORITY_BACKGROUND)
+        held = [limited.submit(release.wait, TIMEOUT) for _ in range(2)]
+        wait_until(lambda: limited.running == 1)
+        # The other client runs on the free workers, below the limited client priority
+        results = [other.submit(abs, -i) for i in range(5)]
+        assert [future.result(timeout=TIMEOUT) for future in results] == list(range(5))
+        assert limited.running == 1
+        assert limited.pending == 1
+        assert not held[1].running() and not held[1].done()
+        release.set()
+        concurrent.futures.wait(held, timeout=TIMEOUT)
+        assert all(future.result() for future in held)
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_shutdown_cancels_only_client_tasks():
+    pool = thread_pool(1)
+    release = threading.Event()
+    try:
+        blocker = pool.client("blocker").submit(release.wait, TIMEOUT)
+        wait_until(lambda: blocker.running())
+        cancelled = pool.client("cancelled")
+        kept = pool.client("kept")
+        cancelled_futures = [cancelled.submit(abs, -1) for _ in range(2)]
+        kept_future = kept.submit(abs, -2)
+        cancelled.shutdown(wait=False, cancel_futures=True)
+        assert all(future.cancelled() for future in cancelled_futures)
+        assert cancelled.pending == 0
+        release.set()
+        assert kept_future.result(timeout=TIMEOUT) == 2
+        assert blocker.result(timeout=TIMEOUT)
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def sleep_and_return(value):
+    # Later items finish first
+    time.sleep(0.01 * (10 - value))
+    return value
+
+
+def test_imap_keeps_order():
+    pool = thread_pool(4)
+    try:
+        client = pool.client("imap")
+        assert list(client.imap(sleep_and_return, range(10))) == list(range(10))
+        assert sorted(client.imap_unordered(sleep_and_return, range(10))) == list(range(10))
+    finally:
+        pool.shutdown()
@@ -0,0 +1,215 @@
+'''One pool of worker processes, shared by resource loading, primitive
+execution and all the sessions of a process'''
+
+import heapq
+import atexit
+import functools
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
+
+from collections import deque
+
+# Priorities of the pool clients, lower runs first
+PRIORITY_LOADING = 0
+PRIORITY_EXECUTION = 10
+PRIORITY_BACKGROUND = 20
+
+# Tasks of an imap submitted ahead of the consumed results, per worker
+IMAP_AHEAD = 2
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes shared by several clients.
+
+    Each client (see client()) is a concurrent.futures Executor with a
+    priority and a quota (the most of its tasks running at once, None
+    for no limit). Tasks wait in the pool until a worker is free, and
+    then the next task of the highest priority client under its quota
+    runs (first in, first out within a priority). WorkerPool.shared() is
+    the pool of the process.
+
+    When a task finishes, the next tasks are started by a dispatcher
+    thread of the pool, not by the callback thread of the process pool
+    executor (which must not submit tasks).
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers=0, executor=None):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        # The executor running the tasks, worker processes unless given
+        self.executor = executor if executor is not None else \
+            concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        self.lock = threading.Lock()
+        # (priority, sequence, (client, future, fn, args, kwargs)) of the waiting tasks
+        self.pending = []
+        self.sequence = itertools.count()
+        self.running = 0
+        self.closed = False
+        # Set when workers become free
+        self.dispatch_needed = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatcher, name="worker-pool-dispatcher", daemon=True)
+        self.dispatcher.start()
+
+    @staticmethod
+    def shared(max_workers=0):
+        '''The pool of the process, started on first use with max_workers
+        workers (the number of CPUs if 0)'''
+        with WorkerPool._shared_lock:
+            if WorkerPool._shared is None:
+                WorkerPool._shared = WorkerPool(max_workers)
+                atexit.register(WorkerPool.shutdown_shared)
+            return WorkerPool._shared
+
+    @staticmethod
+    def shutdown_shared(wait=True):
+        with WorkerPool._shared_lock:
+            pool = WorkerPool._shared
+            WorkerPool._shared = None
+        if pool is not None:
+            pool.shutdown(wait)
+
+    def client(self, name, priority=PRIORITY_EXECUTION, quota=None):
+        '''Returns a new client (an Executor) of the pool'''
+        return PoolClient(self, name, priority, quota)
+
+    def shutdown(self, wait=True):
+        '''Cancels the waiting tasks, and stops the workers'''
+        with self.lock:
+            self.closed = True
+            pending = self.pending
+            self.pending = []
+        for (_, _, (client, future, _, _, _)) in pending:
+            client.pending -= 1
+            future.cancel()
+        self.dispatch_needed.set()
+        self.executor.shutdown(wait=wait)
+
+    def _submit(self, client, fn, args, kwargs):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed or client.closed:
+                raise RuntimeError("Cannot submit to shut down worker pool client %s" % client.name)
+            heapq.heappush(self.pending, (client.priority, next(self.sequence), (client, future, fn, args, kwargs)))
+            client.pending += 1
+        self._dispatch()
+        return future
+
+    def _cancel_pending(self, client):
+        with self.lock:
+            cancelled = [entry for entry in self.pending if entry[2][0] is client]
+            self.pending = [entry for entry in self.pending if entry[2][0] is not client]
+            heapq.heapify(self.pending)
+            client.pending -= len(cancelled)
+        for (_, _, (_, future, _, _, _)) in cancelled:
+            future.cancel()
+
+    def _dispatcher(self):
+        '''Runs _dispatch when workers become free, until the pool is shut down'''
+        while True:
+            self.dispatch_needed.wait()
+            self.dispatch_needed.clear()
+            if self.closed:
+                return
+            self._dispatch()
+
+    def _dispatch(self):
+        '''Starts waiting tasks while workers are free'''
+        started = []
+        with self.lock:
+            held = []
+            while self.pending and self.running < self.max_workers:
+                entry = heapq.heappop(self.pending)
+                (client, future, fn, args, kwargs) = entry[2]
+                if client.quota is not None and client.running >= client.quota:
+                    held.append(entry)
+                    continue
+                client.pending -= 1
+                if not future.set_running_or_notify_cancel():
+                    continue
+                client.running += 1
+                self.running += 1
+                started.append((client, future, fn, args, kwargs))
+            for entry in held:
+                heapq.heappush(self.pending, entry)
+
+        for (client, future, fn, args, kwargs) in started:
+            try:
+                task = self.executor.submit(fn, *args, **kwargs)
+            except Exception as e:
+                self._finished(client)
+                future.set_exception(e)
+                continue
+            task.add_done_callback(functools.partial(self._done, client, future))
+
+    def _finished(self, client):
+        with self.lock:
+            client.running -= 1
+            self.running -= 1
+
+    def _done(self, client, future, task):
+        self._finished(client)
+        self.dispatch_needed.set()
+        try:
+            future.set_result(task.result())
+        except BaseException as e:
+            future.set_exception(e)
+
+
+class PoolClient(concurrent.futures.Executor):
+    '''A client of a WorkerPool (see WorkerPool.client)'''
+
+    def __init__(self, pool, name, priority=PRIORITY_EXECUTION, quota=None):
+        self.pool = pool
+        self.name = name
+        self.priority = priority
+        self.quota = quota
+        # Tasks of the client waiting and running in the pool
+        self.pending = 0
+        self.running = 0
+        self.closed = False
+        self.futures = set()
+
+    def submit(self, fn, *args, **kwargs):
+        future = self.pool._submit(self, fn, args, kwargs)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def imap(self, fn, iterable, ordered=True):
+        '''Like multiprocessing.Pool.imap: yields fn(item) for the items, in
+        order, with only a few tasks submitted ahead of the consumer'''
+        workers = self.pool.max_workers if self.quota is None else min(self.quota, self.pool.max_workers)
+        iterator = iter(iterable)
+        futures = deque(self.submit(fn, item) for item in itertools.islice(iterator, IMAP_AHEAD * workers))
+        try:
+            while futures:
+                if ordered:
+                    future = futures.popleft()
+                else:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    future = next(iter(done))
+                    futures.remove(future)
+                result = future.result()
+                for item in itertools.islice(iterator, 1):
+                    futures.append(self.submit(fn, item))
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def imap_unordered(self, fn, iterable):
+        '''Like multiprocessing.Pool.imap_unordered'''
+        return self.imap(fn, iterable, ordered=False)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        '''No more tasks can be submitted. The pool keeps running for its
+        other clients.'''
+        self.closed = True
+        if cancel_futures:
+            self.pool._cancel_pending(self)
+        if wait:
+            concurrent.futures.wait(list(self.futures))
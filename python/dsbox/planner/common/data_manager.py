@@ -1,22 +1,48 @@
 import os
 import sys
+import glob
+import atexit
 import json
 import copy
+import time
+import uuid
+import hashlib
+import tempfile
 import inspect
 import warnings
 import importlib
 import numpy as np
 import pandas as pd
 
-import multiprocessing
-from multiprocessing import Pool
 
 from dsbox.schema.dataset_schema import VariableFileType
+from dsbox.schema.packed_series import PackedSeries
+from dsbox.schema.csr_graph import CSRGraph
+from dsbox.executer.worker_pool import WorkerPool, PRIORITY_LOADING
 #from dsbox.schema.data_profile import DataProfile
 #from dsbox.schema.profile_schema import DataProfileType as dpt
 
 DATASET_SCHEMA_VERSION = '3.0'
 DEFAULT_DATA_DOC = "datasetDoc.json"
+DEFAULT_CHUNKSIZE = 10000
+# Rows of the in-memory training sample in out of core mode
+DEFAULT_SAMPLE_ROWS = 100000
+# Name of the view of all the rows (see DataManager.get_view)
+FULL_VIEW = "full"
+# Columnar copies of the csv tables, next to the tables
+TABLE_CACHE_DIR = ".dsbox_cache"
+
+# Files loaded per task of the raw resource loading pool
+LOADING_CHUNKSIZE = 32
+# Seconds between raw resource loading progress messages
+LOADING_PROGRESS_INTERVAL = 10
+
+# Pandas dtypes of the declared column types. Others are inferred by pandas
+COLUMN_DTYPES = {
+    "categorical": "category",
+    "real": np.float64,
+    "string": object
+}
 
 class DataManager(object):
     input_data = None
@@ -25,6 +51,20 @@ class DataManager(object):
     target_data = None
     target_columns = None
     media_type = None
+    streaming = False
+    _splits = None
+    # Column name -> SharedTensor of the decoded images, for image datasets
+    image_tensors = {}
+    # Column name -> PackedSeries, for time series datasets
+    packed_series = {}
+    # Out of core mode: input_data is a sample, profile is the profile
+    # of the full data, and target_classes are all classes seen
+    sampled = False
+    profile = None
+    target_classes = None
+    _stream = None
+    # View name -> (row positions, seed) of the sample views
+    views = None
 
     """
     The Manage Data management Class.
@@ -45,6 +85,8 @@ class DataManager(object):
         dsmap = {}
         for dataset in datasets:
             dsmap[dataset.dsID] = dataset
+            # Unused columns are not read, rather than dropped after the read
+            dataset.use_problem_columns(problem)
 
         dataframes = {}
         # Split dataset into data and targets
@@ -64,7 +106,7 @@ class DataManager(object):
                         if type(resource) is TableResource:
                             # Select appropriate rows of the resource
                             if splits_df is not None:
-                                resource.df = resource.df.loc[splits_df.index]
+                                resource.df = self._select_split(resource.df, splits_df)
                                 resource.split = True
                             # Select targets
                             target_cols = list(map(lambda x: x['colName'], targets))
@@ -91,12 +133,16 @@ class DataManager(object):
                             resource = dataset.resources[resid]
                             if type(resource) is TableResource:
                                 if splits_df is not None and not resource.split:
-                                    resource.df = resource.df.loc[splits_df.index]
+                                    resource.df = self._select_split(resource.df, splits_df)
                                     resource.split = True
                                 filter_cols = list(map(lambda x: x['colName'], filters))
                                 if resource.index_column in filter_cols:
                                     filter_cols.remove(resource.index_column)
-                                resource.df = copy.copy(resource.df[filter_cols])
+                                # Drop the columns only read for the references (refersTo)
+                                resource.df.drop([col for col in resource.df.columns if col not in filter_cols],
+                                                 axis=1, inplace=True)
+                                if list(resource.df.columns) != filter_cols:
+                                    resource.df = resource.df[filter_cols]
                                 if resid not in dataframes[dsid]:
                                     dataframes[dsid][resid] = {}
                                 dataframes[dsid][resid]["filter_cols"] = filter_cols
@@ -112,16 +158,27 @@ class DataManager(object):
                                 dataframes[dsid][resid] = {}
                 '''
 
-        self.input_data = pd.DataFrame()
-        self.target_data = pd.DataFrame()
         self.input_columns = []
         self.target_columns = []
 
         # Resolve references
+        for tensor in self.image_tensors.values():
+            tensor.release()
+        self.image_tensors = {}
+        self.packed_series = {}
         for dsid, resdfs in dataframes.items():
             dsmap[dsid].resolve_references()
-
-        # Combine multiple dataframes
+            for resource in dsmap[dsid].resources.values():
+                if type(resource) is ImageResource:
+                    self.image_tensors.update(resource.tensors)
+                    resource.tensors = {}
+                elif type(resource) is TimeSeriesResource:
+                    self.packed_series.update(resource.packed)
+                    resource.packed = {}
+
+        # Combine multiple dataframes (with a single concat)
+        input_frames = []
+        target_frames = []
         for dsid, resdfs in dataframes.items():
             if dsmap[dsid].resType is not None and self.media_type is None:
                 self.media_type = VariableFileType(dsmap[dsid].resType)
@@ -132,7 +189,8 @@ class DataManager(object):
                             col['colName'] in resdf["target_cols"]):
                         self.target_columns.append(col)
                     elif ("filter_cols" not in resdf or
-                            col['colName'] in resdf['filter_cols']):
+                            col['colName'] in resdf['filter_cols'] or
+                            col.get('derivedFrom', None) in resdf['filter_cols']):
                         if "index" in col['role']:
                             self.index_column = col['colName']
                         else:
@@ -145,12 +203,128 @@ class DataManager(object):
                             self.media_type is  None):
                         self.media_type = VariableFileType("text")
 
-                self.input_data = pd.concat([self.input_data, resource.df])
+                input_frames.append(resource.df)
                 if "targets" in resdf:
-                    self.target_data = pd.concat([self.target_data, resdf["targets"]])
-                self.input_data.columns = list(map(lambda x: x['colName'], self.input_columns))
-                self.target_data.columns = list(map(lambda x: x['colName'], self.target_columns))
+                    target_frames.append(resdf["targets"])
+        self.input_data = pd.concat(input_frames) if input_frames else pd.DataFrame()
+        self.target_data = pd.concat(target_frames) if target_frames else pd.DataFrame()
+        self.input_data.columns = list(map(lambda x: x['colName'], self.input_columns))
+        self.target_data.columns = list(map(lambda x: x['colName'], self.target_columns))
+
+
+    def initialize_data_chunks(self, problem, datasets, view=None, chunksize=DEFAULT_CHUNKSIZE):
+        """
+        Generator version of initialize_data for large (test) datasets.
+        The main (learningData) table of the first dataset is read in
+        chunks of rows, and the data is initialized for one chunk at a
+        time, so only that chunk and the resources it refers to are in
+        memory. The dataset should be loaded with streaming=True.
+        Yields input_data for each chunk.
+        """
+        resource = datasets[0].default_resource
+        columns = copy.deepcopy(resource.columns)
+        self.streaming = True
+        self._splits = None
+        try:
+            for chunk in resource.iter_chunks(chunksize):
+                # Joins modify the resource columns, so start from the originals
+                resource.df = chunk
+                resource.split = False
+                resource.initialize_columns(copy.deepcopy(columns))
+                self.initialize_data(problem, datasets, view)
+                if len(self.input_data) > 0:
+                    yield self.input_data
+        finally:
+            self.streaming = False
+            # So that the dataset can be streamed again
+            resource.initialize_columns(copy.deepcopy(columns))
+
+    def initialize_data_sample(self, problem, datasets, view=None, sample_rows=DEFAULT_SAMPLE_ROWS,
+                               chunksize=DEFAULT_CHUNKSIZE, stratify=False, random_state=None):
+        """
+        Out of core version of initialize_data, for data larger than memory.
+        The main table is streamed in chunks (the dataset should be loaded
+        with streaming=True), the DataProfile of the full data is computed
+        incrementally, and input_data and target_data are set to a random
+        sample of sample_rows rows. With stratify, the sample keeps the
+        class proportions of the (first) target. Use iter_full_data to
+        stream all the rows again.
+        """
+        from dsbox.schema.data_profile import DataProfile
+        from dsbox.planner.common.sampling import ReservoirSample, StratifiedSample
 
+        profile = DataProfile()
+        if stratify:
+            sampler = StratifiedSample(sample_rows, random_state)
+        else:
+            sampler = ReservoirSample(sample_rows, random_state)
+        rows = 0
+        for input_data in self.initialize_data_chunks(problem, datasets, view, chunksize):
+            rows += len(input_data)
+            print("Profiling and sampling .. {} rows".format(rows))
+            sys.stdout.flush()
+            profile.update(input_data)
+            chunk = pd.concat([input_data, self.target_data], axis=1)
+            if stratify:
+                sampler.add(chunk, self.target_data.iloc[:, 0].values)
+            else:
+                sampler.add(chunk)
+
+        sample = sampler.get()
+        ninputs = len(self.input_columns)
+        if sample is not None:
+            self.input_data = sample.iloc[:, :ninputs]
+            self.target_data = sample.iloc[:, ninputs:]
+        self.profile = profile
+        self.sampled = True
+        self.target_classes = sorted(sampler.classes(), key=str) if stratify else None
+        self._stream = (problem, datasets, view, chunksize)
+        print("Sampled {} of {} rows".format(len(self.input_data), rows))
+
+    def add_sample_view(self, name, rows, stratify=False, random_state=None):
+        '''Adds a named view of a random sample of rows (in their original
+        order). With stratify, the sample keeps the class proportions of the
+        (first) target. If the data has no more than rows rows, the view is
+        all the data. Returns the number of rows of the view.'''
+        from dsbox.planner.common.sampling import ReservoirSample, StratifiedSample
+        if self.views is None:
+            self.views = {}
+        nrows = len(self.input_data)
+        if rows >= nrows:
+            self.views[name] = (None, random_state)
+            return nrows
+        positions = pd.DataFrame({'row': np.arange(nrows)})
+        if stratify:
+            sampler = StratifiedSample(rows, random_state)
+            sampler.add(positions, self.target_data.iloc[:, 0].values)
+        else:
+            sampler = ReservoirSample(rows, random_state)
+            sampler.add(positions)
+        self.views[name] = (np.sort(sampler.get()['row'].values), random_state)
+        return len(self.views[name][0])
+
+    def get_view(self, name=FULL_VIEW):
+        '''Returns (input_data, target_data) of the named view'''
+        if name == FULL_VIEW:
+            return (self.input_data, self.target_data)
+        (positions, _) = self.views[name]
+        if positions is None:
+            return (self.input_data, self.target_data)
+        return (self.input_data.iloc[positions], self.target_data.iloc[positions])
+
+    def iter_full_data(self):
+        '''Streams all the rows again after initialize_data_sample.
+        Yields (input_data, target_data) for each chunk'''
+        (problem, datasets, view, chunksize) = self._stream
+        manager = DataManager()
+        for input_data in manager.initialize_data_chunks(problem, datasets, view, chunksize):
+            yield (input_data, manager.target_data)
+
+    def _select_split(self, df, splits_df):
+        if self.streaming:
+            # Chunks only contain some of the split rows
+            return df[df.index.isin(splits_df.index)]
+        return df.loc[splits_df.index]
 
     def _get_datasplits(self, problem, view=None):
         """
@@ -158,6 +332,14 @@ class DataManager(object):
         """
         if problem.splits_file is None:
             return None
+        if self.streaming and self._splits is not None and self._splits[0] == view:
+            return self._splits[1]
+        df = self._read_datasplits(problem, view)
+        if self.streaming:
+            self._splits = (view, df)
+        return df
+
+    def _read_datasplits(self, problem, view):
         df = pd.read_csv(problem.splits_file, index_col='d3mIndex')
         if view is None:
             return df
@@ -191,8 +373,14 @@ class Dataset(object):
     resources = {}
     default_resource = None
     resType = None
-
-    def load_dataset(self, datasetPath, datasetDoc=None):
+    # IDs of the resources the problem can use, None for all
+    needed_resources = None
+
+    def load_dataset(self, datasetPath, datasetDoc=None, streaming=False, problem=None,
+                     engine=None, cache=False, float32=False):
+        '''Loads the dataset. With streaming, the main (learningData) table
+        is not loaded, but read in chunks by DataManager.initialize_data_chunks.
+        See set_read_options for the other arguments.'''
         self.dsHome = datasetPath
 
         # read the schema in dsHome
@@ -209,21 +397,87 @@ class Dataset(object):
             warnings.warn("Dataset Schema version mismatch")
 
         self.dsID = self.about["datasetID"]
+        self.resources = {}
         for res in self.dsDoc["dataResources"]:
             resource = DataResource.initialize(res, self.dsHome)
             if resource.resType != "table":
                 self.resType = resource.resType
             self.resources[resource.resID] = resource
 
-        self.load_resources()
+        self.set_read_options(problem, engine, cache, float32)
+        self.needed_resources = self.get_needed_resources(problem)
+        self.load_resources(streaming)
+
+    def set_read_options(self, problem=None, engine=None, cache=False, float32=False):
+        '''Sets how the tables are read. Attribute columns get the dtype of
+        their declared type (float32 for reals, if float32). With a problem,
+        only the columns of the filtered tables that the problem uses are
+        read, and its targets keep the inferred types. engine is the pandas
+        csv parser, and with cache, tables are cached in a columnar file.'''
+        for resid, res in self.resources.items():
+            if type(res) is not TableResource:
+                continue
+            (usecols, restargets) = self._problem_columns(problem, resid)
+            res.set_read_options(usecols, restargets, engine, cache, float32)
+
+    def use_problem_columns(self, problem):
+        '''Only reads the columns that the problem uses from the tables not
+        read yet (such as when the dataset was loaded without the problem)'''
+        for resid, res in self.resources.items():
+            if type(res) is not TableResource or res.loaded:
+                continue
+            (usecols, restargets) = self._problem_columns(problem, resid)
+            if usecols is not None:
+                res.usecols = usecols
+            # Targets keep the inferred types
+            res.dtypes = dict((name, dtype) for name, dtype in res.dtypes.items() if name not in restargets)
+
+    def _problem_columns(self, problem, resid):
+        '''The columns of the table that the problem uses (None for all),
+        and its target columns'''
+        filters = problem.dataset_filters.get(self.dsID, []) if problem is not None else []
+        targets = problem.dataset_targets.get(self.dsID, []) if problem is not None else []
+        res = self.resources[resid]
+        restargets = [target["colName"] for target in targets if target["resID"] == resid]
+        resfilters = [filt["colName"] for filt in filters if filt["resID"] == resid]
+        usecols = None
+        if len(resfilters) > 0:
+            needed = set(resfilters + restargets)
+            usecols = [col["colName"] for col in res.columns
+                       if col["colName"] in needed or col["colName"] == res.index_column or "refersTo" in col]
+        return (usecols, restargets)
+
+    def get_needed_resources(self, problem=None):
+        '''IDs of the resources reachable through refersTo links from the
+        resources of the problem targets and filters. All the resources
+        without a problem'''
+        if problem is None:
+            return None
+        pending = [col["resID"] for col in problem.dataset_targets.get(self.dsID, []) +
+                   problem.dataset_filters.get(self.dsID, [])]
+        if not pending:
+            return None
+        needed = set()
+        while pending:
+            resid = pending.pop()
+            if resid in needed or resid not in self.resources:
+                continue
+            needed.add(resid)
+            resource = self.resources[resid]
+            if type(resource) is TableResource:
+                pending.extend(col["refersTo"]["resID"] for col in resource.columns if "refersTo" in col)
+        return needed
 
-    def load_resources(self):
-        # Load all resources
+    def load_resources(self, streaming=False):
+        '''Resources are loaded on first use (see DataResource.ensure_loaded),
+        so resources the problem does not use are never read'''
         for resid, res in self.resources.items():
-            res.load()
             if type(res) is TableResource:
                 if res.resPath.endswith("learningData.csv"):
                     self.default_resource = res
+                    if streaming:
+                        # Read in chunks by DataManager.initialize_data_chunks
+                        res.loaded = True
         #self.resolve_references()
 
     # This is called by the data manager after splicing into training/test
@@ -232,6 +486,8 @@ class Dataset(object):
         # Get all references
         references = {}
         for resid, resource in self.resources.items():
+            if self.needed_resources is not None and resid not in self.needed_resources:
+                continue
             if type(resource) is TableResource:
                 for col in resource.columns:
                     referobj = col.get("refersTo", None)
@@ -244,22 +500,54 @@ class Dataset(object):
                             if resid not in references:
                                 references[resid] = {}
                             references[resid][col["colName"]] = reference
-        for resid, refmap in references.items():
-            for colname, reference in refmap.items():
-                self.load_reference(reference, references)
-
-    def load_reference(self, reference, references):
-        reference.scanned = True
-        tores = reference.to_resource
-        if type(tores) is TableResource:
-            # Check for further reference from this resource, if exists, load that first
-            tocol = reference.to_reference["columnName"]
-            if tores.resID in references:
-                # Load all references from this table
-                for col, further_ref in references[tores.resID]:
-                    if not further_ref.scanned:
-                        self.load_reference(further_ref, references)
-        tores.join_with(reference.from_resource, reference)
+        for reference in self.plan_joins(references):
+            start = time.time()
+            reference.to_resource.ensure_loaded()
+            reference.to_resource.join_with(reference.from_resource, reference)
+            print("Joined {} in {:.2f}s".format(reference, time.time() - start))
+            sys.stdout.flush()
+
+    def plan_joins(self, references):
+        '''Orders the references to join. A table is joined into others after
+        its own references are resolved, and smaller tables are joined first'''
+        def size(reference):
+            tores = reference.to_resource
+            return tores.estimated_size() if type(tores) is TableResource else 0
+
+        plan = []
+        def visit(reference):
+            if reference.scanned:
+                return
+            reference.scanned = True
+            tores = reference.to_resource
+            if type(tores) is TableResource and tores.resID in references:
+                # Resolve the references of this table first
+                for further_ref in sorted(references[tores.resID].values(), key=size):
+                    visit(further_ref)
+            plan.append(reference)
+
+        allrefs = [ref for refmap in references.values() for ref in refmap.values()]
+        for reference in sorted(allrefs, key=size):
+            visit(reference)
+        return plan
+
+
+def column_dtypes(columns, exclude=[], float32=False):
+    '''Pandas dtypes of the attribute columns, from their declared types.
+    The excluded columns, and columns referring to other resources (which
+    are joined on), are left to type inference'''
+    dtypes = {}
+    for col in columns:
+        if (col["colName"] in exclude or "attribute" not in col.get("role", []) or
+                "refersTo" in col):
+            continue
+        dtype = COLUMN_DTYPES.get(col.get("colType"), None)
+        if dtype is None:
+            continue
+        if dtype is np.float64 and float32:
+            dtype = np.float32
+        dtypes[col["colName"]] = dtype
+    return dtypes
 
 
 class DataResource(object):
@@ -272,6 +560,8 @@ class DataResource(object):
         self.resType = resType
         self.resFormat = resFormat
         self.split = False
+        # Whether load() has run
+        self.loaded = False
 
     '''
     Initial resource loading (if any)
@@ -279,6 +569,12 @@ class DataResource(object):
     def load(self):
         pass
 
+    def ensure_loaded(self):
+        '''Loads the resource on first use'''
+        if not self.loaded:
+            self.loaded = True
+            self.load()
+
     '''
     Modify the input resource with data from itself based on the reference.
     The input resource has to be a tabular resource
@@ -318,10 +614,13 @@ class TableResource(DataResource):
     """
     This contains tabular data (csv)
     """
-    df = None
-    orig_df = None
+    _df = None
     columns = []
     index_column = None
+    usecols = None
+    dtypes = {}
+    engine = None
+    cache = False
 
     def __init__(self, resID, resPath, resType, resFormat, columns):
         super(TableResource, self).__init__(resID, resPath, resType, resFormat)
@@ -339,9 +638,93 @@ class TableResource(DataResource):
         self.columns = [index_hash[i] for i in sorted(index_hash.keys())]
         self.named_columns = name_hash
 
+    def set_read_options(self, usecols=None, targets=[], engine=None, cache=False, float32=False):
+        '''Columns to read (None for all), and how (see Dataset.set_read_options)'''
+        self.usecols = usecols
+        self.dtypes = column_dtypes(self.columns, exclude=targets + [self.index_column], float32=float32)
+        self.engine = engine
+        self.cache = cache
+
     def load(self):
-        self.df = pd.read_csv(self.resPath, index_col=self.index_column)
-        self.orig_df = copy.copy(self.df)
+        self.df = self.read_table()
+
+    @property
+    def df(self):
+        '''The table, read on first access'''
+        if self._df is None and not self.loaded:
+            self.ensure_loaded()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        # An assigned table (such as a chunk of rows) replaces the file
+        self._df = df
+        self.loaded = True
+
+    def iter_chunks(self, chunksize):
+        '''Reads the table in chunks of rows'''
+        for chunk in self._read_csv(chunksize=chunksize):
+            yield chunk
+
+    def read_table(self):
+        '''Reads the csv table, or its columnar cache if the csv is unchanged'''
+        cachefile = self.get_cache_file() if self.cache else None
+        if cachefile is not None and os.path.exists(cachefile):
+            try:
+                df = pd.read_feather(cachefile)
+                if self.index_column is not None:
+                    df = df.set_index(self.index_column)
+                return df
+            except Exception as e:
+                sys.stderr.write("ERROR: reading table cache {}: {}\n".format(cachefile, e))
+        df = self._read_csv(engine=self.engine)
+        if cachefile is not None:
+            self._write_cache(df, cachefile)
+        return df
+
+    def get_cache_file(self):
+        '''Cache file of the table, keyed by the csv modification time and
+        size, and the columns and dtypes read'''
+        try:
+            stat = os.stat(self.resPath)
+        except OSError:
+            return None
+        key = json.dumps([stat.st_mtime_ns, stat.st_size, self.usecols,
+                          sorted((name, str(dtype)) for name, dtype in self.dtypes.items())])
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(os.path.dirname(self.resPath), TABLE_CACHE_DIR,
+                            "%s.%s.feather" % (os.path.basename(self.resPath), digest))
+
+    def _read_csv(self, engine=None, **kwargs):
+        # The index column is needed to set the index
+        usecols = self.usecols
+        if usecols is not None and self.index_column is not None and self.index_column not in usecols:
+            usecols = [self.index_column] + usecols
+        if self.dtypes or engine is not None:
+            try:
+                return pd.read_csv(self.resPath, index_col=self.index_column, usecols=usecols,
+                                   dtype=self.dtypes or None, engine=engine, **kwargs)
+            except (ValueError, TypeError) as e:
+                # Values that do not match the declared types, or an unsupported engine
+                sys.stderr.write("ERROR: reading {} with declared types: {}\n".format(self.resPath, e))
+        return pd.read_csv(self.resPath, index_col=self.index_column, usecols=usecols, **kwargs)
+
+    def _write_cache(self, df, cachefile):
+        '''Writes the table to the cache (needs pyarrow), and removes older
+        caches of the table. Skipped if the dataset is not writable.'''
+        try:
+            cachedir = os.path.dirname(cachefile)
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir, exist_ok=True)
+            # Write to a temporary file first, other processes may read the cache
+            tmpfile = "%s.%s.tmp" % (cachefile, uuid.uuid4().hex)
+            df.reset_index(drop=(self.index_column is None)).to_feather(tmpfile)
+            os.replace(tmpfile, cachefile)
+            for oldfile in glob.glob(os.path.join(cachedir, "%s.*.feather" % os.path.basename(self.resPath))):
+                if oldfile != cachefile:
+                    os.remove(oldfile)
+        except Exception as e:
+            sys.stderr.write("ERROR: writing table cache {}: {}\n".format(cachefile, e))
 
     def join_with(self, resource, reference):
         assert(type(resource) is TableResource)
@@ -349,10 +732,38 @@ class TableResource(DataResource):
         leftcol = reference.from_column["colName"]
         rightcol = reference.to_reference["columnName"]
 
+        # Position of the joined columns, where the reference column was
+        position = 0
+        for col in resource.columns:
+            if col["colName"] == leftcol:
+                break
+            if col["colName"] in resource.df.columns:
+                position += 1
+
         # Update columns
         self.update_columns(resource, leftcol, self, rightcol)
 
         # Update dataframe itself
+        if leftcol == resource.index_column:
+            keys = resource.df.index
+        else:
+            keys = resource.df[leftcol]
+        if rightcol == self.index_column:
+            lookup = self.df
+        else:
+            lookup = self.df.set_index(rightcol)
+        other = resource.df.drop([leftcol], axis=1, errors='ignore')
+
+        if lookup.index.is_unique and not (set(lookup.columns) & set(other.columns)):
+            # Look up the row of each key, rather than a general merge
+            rows = lookup.index.get_indexer(keys)
+            found = lookup.take(np.where(rows >= 0, rows, 0))
+            found.index = resource.df.index
+            if (rows < 0).any():
+                found[rows < 0] = np.nan
+            resource.df = pd.concat([other.iloc[:, :position], found, other.iloc[:, position:]], axis=1)
+            return
+
         leftindex = False
         rightindex = False
         if leftcol == resource.index_column:
@@ -372,6 +783,17 @@ class TableResource(DataResource):
             del resource.df[leftcol]
         if rightcol is not None:
             del resource.df[rightcol]
+        # Same column order as the fast path (and the column descriptors)
+        ordered = [col["colName"] for col in resource.columns if col["colName"] in resource.df.columns]
+        others = [colname for colname in resource.df.columns if colname not in set(ordered)]
+        if list(resource.df.columns) != ordered + others:
+            resource.df = resource.df[ordered + others]
+
+    def estimated_size(self):
+        '''Number of cells of the table, to order the joins'''
+        if self.df is None:
+            return 0
+        return self.df.shape[0] * max(self.df.shape[1], 1)
 
     def get_boundary_columns(self):
         boundary_columns = []
@@ -410,12 +832,17 @@ class RawResource(DataResource):
     LOADING_POOL = None
 
     def __init__(self, resID, resPath, resType, resFormat, numcpus=0):
-        if RawResource.LOADING_POOL is None:
-            if numcpus == 0:
-                numcpus = multiprocessing.cpu_count()
-            RawResource.LOADING_POOL = Pool(numcpus)
+        self.numcpus = numcpus
         super(RawResource, self).__init__(resID, resPath, resType, resFormat)
 
+    def get_loading_pool(self):
+        '''The client of the shared worker pool that loads the files. Loading
+        runs before the other tasks in the pool'''
+        if RawResource.LOADING_POOL is None:
+            RawResource.LOADING_POOL = WorkerPool.shared().client(
+                "loading", PRIORITY_LOADING, self.numcpus or None)
+        return RawResource.LOADING_POOL
+
     def load(self):
         # Preload all images ?
         pass
@@ -432,26 +859,55 @@ class RawResource(DataResource):
     def unserialize_resource(self, value):
         return value
 
+    def get_filepaths(self, resource, colname):
+        '''Paths of the files named in the column of the table (a Series)'''
+        filenames = resource.df[colname]
+        if filenames.isnull().any():
+            print(self.resPath, "Missing file names in", colname)
+        return os.path.join(self.resPath, "") + filenames.astype(str)
+
+    def get_boundary_values(self, resource, count):
+        '''Boundary column values of each row of the table ([] without boundaries)'''
+        boundary_columns = resource.get_boundary_columns()
+        if len(boundary_columns) > 0:
+            return resource.df[boundary_columns].values.tolist()
+        return [[]] * count
+
+    def load_files(self, chunk_function, items, pack, description="files", ordered=True, extra=()):
+        '''Runs chunk_function in the loading pool on chunks of items. Its
+        argument is (resource, start, chunk of items) + extra, so the
+        resource is pickled once per chunk, not once per file. pack(loaded,
+        result) takes the result of each chunk (in order, if ordered), and
+        returns the number of items loaded from it. Returns the total.'''
+        chunks = ((self, start, items[start:start + LOADING_CHUNKSIZE]) + tuple(extra)
+                  for start in range(0, len(items), LOADING_CHUNKSIZE))
+        pool = self.get_loading_pool()
+        results = pool.imap(chunk_function, chunks) if ordered else pool.imap_unordered(chunk_function, chunks)
+        loaded = 0
+        reported = time.time()
+        for result in results:
+            loaded += pack(loaded, result)
+            if time.time() - reported >= LOADING_PROGRESS_INTERVAL:
+                reported = time.time()
+                print("Loading .. {}/{} {} of {}".format(loaded, len(items), description, self.resPath))
+                sys.stdout.flush()
+        print("Loaded {} {} of {}".format(loaded, description, self.resPath))
+        sys.stdout.flush()
+        return loaded
+
     def join_with(self, resource, reference):
         assert(type(resource) is TableResource)
         colname = reference.from_column["colName"]
-        boundary_columns = resource.get_boundary_columns()
-        loadrefs = []
-        for index, row in resource.df.iterrows():
-            filename = row[colname]
-            if type(filename) == float:
-                print(self.resPath, filename, type(filename))
-            filepath = os.path.join(self.resPath, filename)
-            boundary_values = resource.get_column_values(row, boundary_columns)
-            ref = RawResource.LOADING_POOL.apply_async(self.load_resource, args=(filepath, boundary_values))
-            loadrefs.append({"ref":ref, "index":index, "filename":filename})
-
-        resource.df[colname] = resource.df[colname].astype(object)
-        for loadref in loadrefs:
-            value = loadref["ref"].get()
-            print("Loading .. {}".format(loadref["filename"]))
-            sys.stdout.flush()
-            resource.df.at[loadref["index"], colname] = self.unserialize_resource(value)
+        filepaths = self.get_filepaths(resource, colname).tolist()
+        items = list(zip(filepaths, self.get_boundary_values(resource, len(filepaths))))
+
+        column = np.empty(len(items), dtype=object)
+        def pack(loaded, values):
+            for (i, value) in enumerate(values):
+                column[loaded + i] = self.unserialize_resource(value)
+            return len(values)
+        self.load_files(_load_resource_chunk, items, pack)
+        resource.df[colname] = column
 
     '''
     def __getstate__(self):
@@ -463,6 +919,11 @@ class RawResource(DataResource):
         self.__dict__.update(state)
     '''
 
+def _load_resource_chunk(args):
+    '''Loads a chunk of (filepath, boundary_values) of a raw resource, in a loading pool worker'''
+    (resource, _, items) = args
+    return [resource.load_resource(filepath, boundary_values) for (filepath, boundary_values) in items]
+
 class TextResource(RawResource):
     """
     A collection of text files
@@ -482,100 +943,360 @@ class TextResource(RawResource):
 class ImageResource(RawResource):
     """
     ImageResource: A collection of image files
+
+    The images referred to by a table column are decoded in the loading
+    pool straight into one memory mapped uint8 tensor (images x height x
+    width x channels). The column then holds the row of each image in
+    the tensor, and the tensor is kept in DataManager.image_tensors.
     """
+    image_size = (224, 224)
+
     def __init__(self, resID, resPath, resType, resFormat):
-        self.keras_image = importlib.import_module('keras.preprocessing.image')
-        self.pil_image = importlib.import_module('PIL.Image')
         super(ImageResource, self).__init__(resID, resPath, resType, resFormat)
+        # Column name -> SharedTensor, taken over by the DataManager
+        self.tensors = {}
+
+    @property
+    def keras_image(self):
+        # Imported on first use (also in the pool workers)
+        return importlib.import_module('keras.preprocessing.image')
 
     def load(self):
         # Preload all images ?
         pass
 
     def load_resource(self, filepath, boundary_values):
-        im = self.keras_image.load_img(filepath, target_size=(224, 224))
-        return dict(data=im.tobytes(), size=im.size, mode=im.mode)
+        im = self.keras_image.load_img(filepath, target_size=self.image_size)
+        return np.asarray(im, dtype=np.uint8)
 
-    def unserialize_resource(self, value):
-        return self.pil_image.frombytes(**value)
+    def join_with(self, resource, reference):
+        assert(type(resource) is TableResource)
+        colname = reference.from_column["colName"]
+        filepaths = self.get_filepaths(resource, colname).tolist()
+
+        tensor = SharedTensor.create((len(filepaths), ) + self.image_size + (3, ))
+        # Chunks write their own rows of the tensor, in any order
+        self.load_files(_decode_image_chunk, filepaths, lambda loaded, count: count, "images",
+                        ordered=False, extra=(tensor.filename, ))
+        self.tensors[colname] = tensor
+        resource.df[colname] = np.arange(len(filepaths))
+
+
+def _decode_image_chunk(args):
+    '''Decodes a chunk of images into rows start.. of the tensor file, in a
+    loading pool worker. Images that cannot be read are left black.'''
+    (resource, start, filepaths, filename) = args
+    tensor = np.load(filename, mmap_mode='r+')
+    for (i, filepath) in enumerate(filepaths):
+        try:
+            tensor[start + i] = resource.load_resource(filepath, [])
+        except Exception as e:
+            sys.stderr.write("ERROR: loading image {}: {}\n".format(filepath, e))
+    tensor.flush()
+    del tensor
+    return len(filepaths)
+
+
+class SharedTensor(object):
+    """
+    A NumPy array in a .npy file, memory mapped by each process that uses
+    it. It is pickled as the file name, and mapped again read only when
+    unpickled, so worker processes share the pages instead of copies.
+    The process that created the file removes it on release (or exit).
+    """
+    def __init__(self, filename, owner=False):
+        self.filename = filename
+        self.owner = owner
+        self.array = np.load(filename, mmap_mode='r+' if owner else 'r')
+
+    @staticmethod
+    def create(shape, dtype=np.uint8):
+        (fd, filename) = tempfile.mkstemp(prefix='dsbox-tensor-', suffix='.npy')
+        os.close(fd)
+        np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape).flush()
+        tensor = SharedTensor(filename, owner=True)
+        atexit.register(tensor.release)
+        return tensor
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def rows(self, indices):
+        '''The rows at the indices, as a view when they are consecutive'''
+        indices = np.asarray(indices, dtype=np.intp)
+        if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+            return self.array[indices[0]:indices[-1] + 1]
+        return self.array[indices]
+
+    def release(self):
+        if self.owner and os.path.exists(self.filename):
+            self.array = None
+            os.remove(self.filename)
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
 
 class AudioResource(RawResource):
     """
     AudioResource: A collection of audio files
+
+    Rows may refer to segments of a file (with start and end boundary
+    columns). Rows are grouped by file, and each file is decoded once in
+    the loading pool, with all its segments sliced from it. Waveforms are
+    packed in one float32 buffer, and each cell holds a (waveform view,
+    sampling rate) tuple, or None if the file could not be decoded.
     """
     def __init__(self, resID, resPath, resType, resFormat):
-        self.librosa = importlib.import_module('librosa')
         super(AudioResource, self).__init__(resID, resPath, resType, resFormat)
 
+    @property
+    def librosa(self):
+        # Imported on first use (also in the pool workers)
+        return importlib.import_module('librosa')
+
     def load(self):
         # Preload all audio ?
         pass
 
     def load_resource(self, filepath, boundary_values):
-        kwargs = {'sr':None}
-        if len(boundary_values) == 2:
-            start = float(boundary_values[0])
-            end = float(boundary_values[1])
-            if start > end:
-                tmp = start
-                start = end
-                end = tmp
-            kwargs['offset'] = start
-            kwargs['duration'] = end-start
+        '''Decodes the file once, and returns (sampling rate, packed float32
+        waveforms of the segments, segment lengths)'''
+        (data, sr) = self.librosa.load(filepath, sr=None)
+        segments = []
+        for values in boundary_values:
+            if len(values) == 2:
+                start = float(values[0])
+                end = float(values[1])
+                if start > end:
+                    tmp = start
+                    start = end
+                    end = tmp
+                # Same sample positions as librosa.load with offset and duration
+                offset = int(np.round(sr * start))
+                segments.append(data[offset:offset + int(np.round(sr * (end - start)))])
+            else:
+                segments.append(data)
+        lengths = [len(segment) for segment in segments]
+        packed = np.concatenate(segments).astype(np.float32) if segments else np.empty(0, dtype=np.float32)
+        return (sr, packed, lengths)
+
+    def join_with(self, resource, reference):
+        assert(type(resource) is TableResource)
+        colname = reference.from_column["colName"]
+        filepaths = self.get_filepaths(resource, colname)
+        boundary_values = self.get_boundary_values(resource, len(filepaths))
+
+        # Row positions of each file
+        files = []
+        for (filepath, positions) in pd.Series(np.arange(len(filepaths))).groupby(filepaths.values):
+            positions = positions.values
+            files.append((filepath, positions, [boundary_values[i] for i in positions]))
+
+        results = []
+        def pack(loaded, chunk_results):
+            results.extend(chunk_results)
+            return len(chunk_results)
+        self.load_files(_load_audio_chunk, [(filepath, values) for (filepath, _, values) in files],
+                        pack, "audio files")
+
+        # One buffer for all waveforms, cells are views into it
+        buffer = np.concatenate([result[1] for result in results if result is not None] or
+                                [np.empty(0, dtype=np.float32)])
+        column = np.empty(len(filepaths), dtype=object)
+        offset = 0
+        for ((filepath, positions, _), result) in zip(files, results):
+            if result is None:
+                continue
+            (sr, _, lengths) = result
+            for (position, length) in zip(positions, lengths):
+                column[position] = (buffer[offset:offset + length], sr)
+                offset += length
+        resource.df[colname] = column
+
+
+def _load_audio_chunk(args):
+    '''Decodes a chunk of (filepath, boundary values of its rows) of an
+    audio resource, in a loading pool worker. None for files that fail.'''
+    (resource, _, files) = args
+    results = []
+    for (filepath, boundary_values) in files:
         try:
-            return self.librosa.load(filepath, **kwargs)
-        except:
-            return None
+            results.append(resource.load_resource(filepath, boundary_values))
+        except Exception as e:
+            sys.stderr.write("ERROR: loading audio {}: {}\n".format(filepath, e))
+            results.append(None)
+    return results
 
 class TimeSeriesResource(RawResource):
     """
     TimeSeriesResource: A collection of time series files.
+
+    The series referred to by a table column are packed in a PackedSeries
+    (the first value column of each file), and the column holds the
+    series index of each row. The collection is cached next to the files,
+    and reused while the files are unchanged.
     """
     def __init__(self, resID, resPath, resType, resFormat):
         super(TimeSeriesResource, self).__init__(resID, resPath, resType, resFormat)
         
         # FIXME: assume name of index is 'time'
         self.index_column = 'time'
+        # Column name -> PackedSeries, taken over by the DataManager
+        self.packed = {}
 
     def load(self):
         # Preload all time series ?
         pass
 
     def load_resource(self, filepath, _):
-        self.df = pd.read_csv(filepath, index_col=self.index_column)
-        self.orig_df = copy.copy(self.df)        
-        return self.df
+        df = pd.read_csv(filepath, index_col=self.index_column)
+        return np.asarray(df.iloc[:, 0], dtype=np.float64)
+
+    def join_with(self, resource, reference):
+        assert(type(resource) is TableResource)
+        colname = reference.from_column["colName"]
+        (filepaths, rows) = np.unique(self.get_filepaths(resource, colname).values, return_inverse=True)
+
+        cachefile = self.get_cache_file(filepaths)
+        if cachefile is not None and PackedSeries.exists(cachefile):
+            packed = PackedSeries.load(cachefile)
+            print("Loaded {} time series of {} from the cache".format(len(packed), self.resPath))
+            sys.stdout.flush()
+        else:
+            arrays = []
+            def pack(loaded, values):
+                arrays.extend(values)
+                return len(values)
+            self.load_files(_load_resource_chunk, [(filepath, []) for filepath in filepaths], pack, "time series")
+            packed = PackedSeries.from_arrays(arrays)
+            del arrays
+            if cachefile is not None:
+                try:
+                    if not os.path.exists(os.path.dirname(cachefile)):
+                        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+                    packed.save(cachefile)
+                    packed = PackedSeries.load(cachefile)
+                except Exception as e:
+                    sys.stderr.write("ERROR: writing time series cache {}: {}\n".format(cachefile, e))
+        self.packed[colname] = packed
+        resource.df[colname] = rows
+
+    def get_cache_file(self, filepaths):
+        '''Cache of the collection, keyed by the files and their modification times and sizes'''
+        digest = hashlib.md5()
+        try:
+            for filepath in filepaths:
+                stat = os.stat(filepath)
+                digest.update(("%s %d %d\n" % (filepath, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+        except OSError:
+            return None
+        return os.path.join(self.resPath, TABLE_CACHE_DIR, "timeseries.%s" % digest.hexdigest()[:16])
 
 class GraphResource(DataResource):
+    """
+    GraphResource: A graph (GML file).
+
+    The graph is converted at load time to a CSRGraph (CSR adjacency
+    arrays, a node id index, and columnar node and edge attributes),
+    which is cached next to the file. A table column that refers to the
+    nodes (or edges) of the graph gets the attributes (and degree) of
+    its nodes as new columns, gathered with one lookup.
+    """
     graph = None
 
     def __init__(self, resID, resPath, resType, resFormat):
-        self.networkx = importlib.import_module('networkx')
         super(GraphResource, self).__init__(resID, resPath, resType, resFormat)
 
-    '''
-    Initial Load.. Does nothing for now. Could preload
-    '''
     def load(self):
-        self.graph = self.networkx.read_gml(self.resPath)
+        cachefile = self.get_cache_file()
+        if cachefile is not None and CSRGraph.exists(cachefile):
+            self.graph = CSRGraph.load(cachefile)
+            return
+        networkx = importlib.import_module('networkx')
+        # Nodes keyed by their GML id, labels are kept as an attribute
+        self.graph = CSRGraph.from_networkx(networkx.read_gml(self.resPath, label='id'))
+        if cachefile is not None:
+            try:
+                if not os.path.exists(os.path.dirname(cachefile)):
+                    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+                self.graph.save(cachefile)
+                self.graph = CSRGraph.load(cachefile)
+            except Exception as e:
+                sys.stderr.write("ERROR: writing graph cache {}: {}\n".format(cachefile, e))
+        print("Loaded graph {} with {} nodes and {} edges".format(
+            self.resPath, len(self.graph), self.graph.num_edges()))
+
+    def get_cache_file(self):
+        '''Cache of the graph, keyed by the file modification time and size'''
+        try:
+            stat = os.stat(self.resPath)
+        except OSError:
+            return None
+        digest = hashlib.md5(("%s %d %d" % (self.resPath, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+        return os.path.join(os.path.dirname(self.resPath), TABLE_CACHE_DIR,
+                            "%s.%s" % (os.path.basename(self.resPath), digest.hexdigest()[:16]))
 
     def join_with(self, resource, reference):
         assert(type(resource) is TableResource)
         colname = reference.from_column["colName"]
         toref = reference.to_reference
-        '''
-        resource.df[colname] = resource.df[colname].astype(object)
-        for index, row in resource.df.iterrows():
-            item = row[colname]
-            values = None
-            if toref == "node":
-                # Get node specific stuff
-                values = self.networkx.get_node_attributes(self.graph, item)
-            elif toref == "edge":
-                # Get edge specific stuff
-                values = self.networkx.get_edge_attributes(self.graph, item)
-            resource.df.at[index, colname] = values
-        '''
+        if colname == resource.index_column:
+            keys = resource.df.index.values
+        else:
+            keys = resource.df[colname].values
+
+        # The column holds node (edge) ids, or values of a node (edge) attribute
+        key_attribute = None
+        if isinstance(toref, dict):
+            key_attribute = toref.get("nodeAttribute", toref.get("edgeAttribute", None))
+            toref = "edge" if "edgeAttribute" in toref else "node"
+        elif toref == "node" and "nodeID" in self.graph.node_attributes:
+            key_attribute = "nodeID"
+
+        if toref == "edge":
+            rows = self.graph.edge_index(keys, key_attribute)
+            attributes = dict(self.graph.edge_attributes)
+            attributes["source"] = self.graph.node_ids[self.graph.source]
+            attributes["target"] = self.graph.node_ids[self.graph.target]
+        else:
+            rows = self.graph.node_index(keys, key_attribute)
+            attributes = dict(self.graph.node_attributes)
+            attributes["degree"] = self.graph.degree()
+        attributes.pop(key_attribute, None)
+        missing = rows < 0
+        if missing.any():
+            print(self.resPath, "Unknown graph keys in", colname, ":", int(missing.sum()))
+        rows = np.where(missing, 0, rows)
+
+        # The new columns go right after the reference column
+        position = 0 if colname == resource.index_column else resource.df.columns.get_loc(colname) + 1
+        newcols = []
+        for name, values in attributes.items():
+            values = np.asarray(values)[rows]
+            if missing.any():
+                values = values.astype(np.float64 if values.dtype.kind in 'iuf' else object)
+                values[missing] = np.nan
+            newname = "%s_%s" % (colname, name)
+            resource.df.insert(position + len(newcols), newname, values)
+            coltype = "integer" if values.dtype.kind in 'iu' else "real" if values.dtype.kind == 'f' else "string"
+            newcols.append({"colName": newname, "colType": coltype, "role": ["attribute"],
+                            "derivedFrom": colname})
+        self.add_columns(resource, colname, newcols)
+
+    def add_columns(self, resource, after, newcols):
+        '''Adds the descriptors of the new columns after the column'''
+        columns = []
+        for col in resource.columns:
+            columns.append(col)
+            if col['colName'] == after:
+                columns.extend(newcols)
+        for index, col in enumerate(columns):
+            col['colIndex'] = index
+        resource.initialize_columns(columns)
 
 class Reference(object):
     """
@@ -47,6 +47,9 @@ class Primitive(object):
         self.finished = False
 
         self.pipeline = None # The pipeline that this primitive is a part of (if any)
+        self.cachekey = None # Execution cache key, set when a resource manager runs the primitive
+        self.ladder_size = None # (parameter, value) if the primitive is a warm start ladder rung
+        self.partial_fit_epochs = None # Fit with this many partial_fit epochs, instead of fit
 
     def hasHyperparamClass(self):
         '''Returns True is primitive has hyperparameter class'''
@@ -130,17 +133,19 @@ class Primitive(object):
 
     def __str__(self):
         if self._hyperparams is None:
-            return '{}:None'.format(self.name)
-        hash = blake2b(digest_size=10)
-        hash.update(str(self._hyperparams).encode())
-        return '{}:{}'.format(self.name, hash.hexdigest())
+            name = '{}:None'.format(self.name)
+        else:
+            hash = blake2b(digest_size=10)
+            hash.update(str(self._hyperparams).encode())
+            name = '{}:{}'.format(self.name, hash.hexdigest())
+        ladder_size = getattr(self, 'ladder_size', None)
+        if ladder_size is not None:
+            # Warm start ladder rung, see ResourceManager._add_ladder_variants
+            name = '{}[{}={}]'.format(name, ladder_size[0], ladder_size[1])
+        return name
 
     def __repr__(self):
-        if self._hyperparams is None:
-            return '{}:None'.format(self.name)
-        hash = blake2b(digest_size=10)
-        hash.update(str(self._hyperparams).encode())
-        return '{}:{}'.format(self.name, hash.hexdigest())
+        return self.__str__()
 
     def getFamily(self) -> PrimitiveFamily:
         return self.d3m_metadata.query()['primitive_family']
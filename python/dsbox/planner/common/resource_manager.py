@@ -5,7 +5,6 @@ import copy
 import json
 import logging
 import sys
-import multiprocessing
 import traceback
 
 from collections import defaultdict
@@ -22,28 +21,20 @@ from dsbox.schema.data_profile import DataProfile
 from dsbox.planner.common.pipeline import Pipeline, PipelineExecutionResult
 from dsbox.planner.common.primitive import Primitive
 from dsbox.executer.executionhelper import ExecutionHelper
+from dsbox.executer.worker_pool import WorkerPool, PRIORITY_EXECUTION, PRIORITY_BACKGROUND
 
 TIMEOUT = 600  # Time out primitives running for more than 10 minutes
 
+# How learners are fitted on the full training data after cross validation
+#  full     - refit right after cross validation
+#  bagged   - keep the cross validation fold models as a bagged predictor
+#  deferred - refit only when the pipeline is exported or tested
+#  top_k    - same as deferred, but refit the top ranked pipelines in the background
+REFIT_MODES = ['full', 'bagged', 'deferred', 'top_k']
+
 # logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(name)s: %(message)s')
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(name)s: %(message)s')
 
-class MyExecutor(concurrent.futures.ProcessPoolExecutor):
-    '''Used to generate debugging prints'''
-    def __init__(self, max_workers=2):
-        # print('max_workers={}'.format(max_workers))
-        super().__init__(max_workers=max_workers)
-
-    def submit(self, fn, *args, **kwargs):
-        # print('executor submit({})'.format(fn))
-        return super().submit(fn, *args, **kwargs)
-
-    def map(self, fn, *iterables, timeout=None, chunksize=1):
-        return super().map(fn, *iterables, timeout=timeout, chunksize=chunksize)
-
-    def shutdown(self, wait=True):
-        super().shutdown(wait=wait)
-
 class PipelineExecStat:
     '''Pipeline execution statistics'''
     def __init__(self, pipeline, pending_at=None):
@@ -88,6 +79,20 @@ class PrimitiveExecStat:
         return 'finished {:.1f} min'.format((self.finishing_at-self.pending_at)/timedelta(seconds=60))
 
 
+class DeferredRefit:
+    '''Learner whose fit over the full training data has been postponed'''
+    def __init__(self, primitive, df, df_lbl):
+        self.primitive = primitive  # The learner, as cross validated
+        self.df = df
+        self.df_lbl = df_lbl
+        self.future = None  # Set if refit was submitted in the background
+        self.result = None  # (executables, unified_interface) once fitted
+
+    def done(self):
+        '''Returns True if the learner has been fitted'''
+        return self.result is not None
+
+
 class SimpleEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (datetime, date)):
@@ -118,6 +123,9 @@ class ExecutionStatistics:
         self.starting_at = datetime.now()
         self.ending_at = None
 
+        # Search sample view (name, rows, seed, ...), if the search ran on a sample
+        self.search_sample = None
+
         self._encoder = SimpleEncoder()
 
     def pipeline_pending(self, pipeline: Pipeline):
@@ -222,7 +230,8 @@ class ExecutionStatistics:
             'num_pipelines_successful' : self.num_pipelines_successful,
             'running' : self.starting_at,
             'finishing' : self.ending_at,
-            'running_time' : (self.ending_at - self.starting_at).total_seconds()
+            'running_time' : (self.ending_at - self.starting_at).total_seconds(),
+            'search_sample' : self.search_sample
         }
         print(self._encoder.encode(run_info), file=out)
 
@@ -288,6 +297,11 @@ class ResourceManager:
         # Cache trained primitive executables
         self.primitive_cache = {}
 
+        # Cache key -> (data, profile) of the results profiled so far, and
+        # cache key -> cache key of the previous step (see _data_profile)
+        self.profile_cache = {}
+        self.parent_keys = {}
+
         # Prmitives scheduled for execution
         self.scheduled = set()
 
@@ -297,15 +311,36 @@ class ResourceManager:
         # Used by primitives waiting for results
         self.condition = dict()
 
-        # Set max number of subprocesses
-        if max_workers == 0:
-            max_workers = multiprocessing.cpu_count()
-        # self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
-        self.executor = MyExecutor(max_workers=max_workers)
+        # Clients of the shared worker pool, running at most max_workers
+        # primitives at once (0 for as many as the pool has workers).
+        # Background refits only use workers that nothing else needs.
+        pool = WorkerPool.shared()
+        self.executor = pool.client("execution", PRIORITY_EXECUTION, max_workers or None)
+        self.background_executor = pool.client("background", PRIORITY_BACKGROUND, max_workers or None)
 
         self.cross_validation_folds = 10
         self.cv_seed = 0
 
+        # See REFIT_MODES
+        self.refit_mode = 'full'
+        self.refit_top_k = 5
+
+        # Profile the string columns of intermediate data on a sample of
+        # rows (None for all rows)
+        self.profile_sample_rows = None
+
+        # Prefix of the cache keys, the name of the data view the pipelines
+        # run on (cached results of different views must not mix)
+        self.data_view = ""
+
+        # Learners waiting to be fitted on full training data, keyed by the
+        # cache key of the learner (shared by the pipelines that reach it)
+        self.deferred_refits = {}  # type: Dict[str, DeferredRefit]
+
+        # Multipliers of the learner size (n_estimators or max_iter) to
+        # evaluate with one incremental fit. Empty list to disable.
+        self.warm_start_ladder = []
+
         self.stats = ExecutionStatistics()
 
     @stopit.threading_timeoutable()
@@ -320,7 +355,7 @@ class ResourceManager:
         # Create and schedule tasks for each pipeline
         tasks = []
         for pipeline in pipelines:
-            tasks.append(self.loop.create_task(self._run_pipeline(pipeline, df, df_lbl)))
+            tasks.append(self.loop.create_task(self._run_pipeline(pipeline, df, df_lbl, self.data_view)))
             self.stats.pipeline_pending(pipeline)
 
         if callbacks is not None:
@@ -356,7 +391,7 @@ class ResourceManager:
         self.log.debug('Adding pipeline %s %s', pipeline.id, pipeline)
 
         # Create and schedule task
-        task = self.loop.create_task(self._run_pipeline(pipeline, df, df_lbl))
+        task = self.loop.create_task(self._run_pipeline(pipeline, df, df_lbl, self.data_view))
 
         self.stats.pipeline_pending(pipeline)
 
@@ -366,6 +401,92 @@ class ResourceManager:
         # Make sure this task will be ran
         self.pending_tasks.append(task)
 
+    def _add_ladder_variants(self, exec_pipeline, primitive, param, rungs, df, df_lbl):
+        '''Register warm start ladder rungs as separate pipelines. Their learners
+        are fitted on full training data only when needed (see refit_pipeline).'''
+        index = exec_pipeline.primitives.index(primitive)
+        for (size, predictions, metric_values, stat) in rungs:
+            learner = copy.copy(primitive)
+            learner.d3m_metadata = primitive.d3m_metadata
+            learner.init_kwargs = dict(primitive.init_kwargs)
+            learner.init_kwargs[param] = size
+            learner.ladder_size = (param, size)
+            if param == 'max_iter':
+                # The rung was scored after size partial_fit epochs
+                learner.partial_fit_epochs = size
+            learner.executables = None
+            learner.cachekey = "%s.%s" % (self.parent_keys[primitive.cachekey], learner)
+
+            primitives = list(exec_pipeline.primitives)
+            primitives[index] = learner
+            variant = Pipeline(primitives=primitives)
+            variant.planner_result = PipelineExecutionResult(predictions, metric_values, stat)
+            variant.finished = True
+            learner.pipeline = variant
+
+            self.deferred_refits[learner.cachekey] = DeferredRefit(learner, df, df_lbl)
+
+            self.stats.pipeline_pending(variant)
+            self.stats.pipeline_running(variant)
+            self.stats.primitive_waiting(variant, learner)
+            self.stats.primitive_finishing(variant, learner)
+            self.stats.pipeline_finished(variant)
+
+            self.exec_pipelines.append(variant)
+            self.log.info('%s Warm start variant %s=%d of %s', variant.id, param, size, exec_pipeline.id)
+
+    def _get_deferred_refits(self, pipeline):
+        '''Returns (pipeline, primitive, cache key, DeferredRefit) for the
+        deferred learners of the pipeline, or of its ensemble members'''
+        pipelines = [pipeline]
+        if pipeline.ensemble is not None:
+            pipelines = pipeline.ensemble.pipelines
+        refits = []
+        for pipe in pipelines:
+            for primitive in pipe.primitives:
+                cachekey = getattr(primitive, 'cachekey', None)
+                if cachekey in self.deferred_refits:
+                    refits.append((pipe, primitive, cachekey, self.deferred_refits[cachekey]))
+        return refits
+
+    def refit_pipelines_in_background(self, pipelines):
+        '''Submit deferred learner refits of the pipelines to the subprocess pool.
+        Non-blocking returns right away. Use refit_pipeline to collect the results.
+        '''
+        for pipeline in pipelines:
+            for pipe, _, cachekey, refit in self._get_deferred_refits(pipeline):
+                if refit.future is None and not refit.done():
+                    self.log.debug('%s Submit background refit %s', pipe.id, cachekey)
+                    refit.future = self.background_executor.submit(
+                        self.helper.create_primitive_model_remote, refit.primitive, refit.df, refit.df_lbl)
+
+    def refit_pipeline(self, pipeline):
+        '''Make sure the learners of the pipeline are fitted on full training data.
+        Blocking, waits for background refits and runs any remaining refits inline.
+        '''
+        for pipe, primitive, cachekey, refit in self._get_deferred_refits(pipeline):
+            if not refit.done() and refit.future is not None:
+                try:
+                    refit.result = refit.future.result(timeout=TIMEOUT)
+                except Exception as e:
+                    print('Background refit failed {}: {}'.format(pipe.id, e))
+                refit.future = None
+            if not refit.done():
+                self.log.debug('%s Refit inline %s', pipe.id, primitive)
+                refit.result = self.helper.create_primitive_model_remote(
+                    refit.primitive, refit.df, refit.df_lbl)
+            # No longer need to hold on to the training data
+            refit.df = None
+            refit.df_lbl = None
+            # Pipelines that reach the learner through the cache get the fit too
+            (primitive.executables, primitive.unified_interface) = refit.result
+            self.primitive_cache[cachekey] = refit.result
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        '''Releases the worker pool clients. The pool itself is shared'''
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self.background_executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
     def _exception_handler(self, loop, context):
         print('my_handler: {}'.format(context['message']), file=sys.stderr)
         print('{}'.format(context), file=sys.stderr)
@@ -379,7 +500,7 @@ class ResourceManager:
             self.stats.print_status()
             return
 
-    async def _run_pipeline(self, pipeline, df, df_lbl):
+    async def _run_pipeline(self, pipeline, df, df_lbl, data_view=""):
         print("** Running Pipeline: %s %s" % (pipeline.id, pipeline))
         sys.stdout.flush()
         self.log.debug('%s Pipeline running %s', pipeline.id, pipeline)
@@ -389,7 +510,7 @@ class ResourceManager:
 
         self.stats.pipeline_running(exec_pipeline)
 
-        cachekey = ""
+        cachekey = data_view
 
         for primitive in exec_pipeline.primitives:
 
@@ -398,7 +519,10 @@ class ResourceManager:
             primitive.pipeline = exec_pipeline
 
             # Include hyperparameter in cache key
+            parentkey = cachekey
             cachekey = "%s.%s" % (cachekey, primitive)
+            self.parent_keys[cachekey] = parentkey
+            primitive.cachekey = cachekey
 
             # Check if result is in cache
             if cachekey in self.execution_cache:
@@ -477,6 +601,24 @@ class ResourceManager:
         return None
 
 
+    def _data_profile(self, key, df):
+        '''Profile of df, the result of the step with the cache key (the data
+        of the view for the view's key). Derived from the profile of the
+        step's input when it is known, so only the columns the step changed
+        are profiled again.'''
+        if key in self.profile_cache:
+            (cached_df, profile) = self.profile_cache[key]
+            if cached_df is df:
+                return profile
+        parentkey = self.parent_keys.get(key, None)
+        if parentkey in self.profile_cache:
+            (parent_df, parent_profile) = self.profile_cache[parentkey]
+            profile = DataProfile.derive(parent_profile, parent_df, df, self.profile_sample_rows)
+        else:
+            profile = DataProfile(df, self.profile_sample_rows)
+        self.profile_cache[key] = (df, profile)
+        return profile
+
     async def _run_primitive(self, exec_pipeline, cachekey, primitive, df, df_lbl):
         '''Run one primitive'''
         inline = getattr(primitive, 'run_inline', False)
@@ -522,8 +664,23 @@ class ResourceManager:
             # always run in subprocess
             self.stats.primitive_running(exec_pipeline, primitive)
             self.log.debug('%s Run primitive submit    %s', exec_pipeline.id, primitive)
-            task = self.loop.run_in_executor(self.executor, self.helper.cross_validation_score,
-                                             primitive, df, df_lbl, self.cross_validation_folds, self.cv_seed)
+            ladder = None
+            if self.warm_start_ladder and self.refit_mode != 'bagged':
+                ladder = self.helper.get_warm_start_param(primitive)
+            if ladder is not None:
+                (param, base_size) = ladder
+                if param == 'max_iter':
+                    # Fit as scored by the ladder, with max_iter partial_fit epochs
+                    primitive.partial_fit_epochs = max(1, int(base_size))
+                sizes = sorted(set([max(1, int(base_size * m)) for m in [1] + list(self.warm_start_ladder)]))
+                task = self.loop.run_in_executor(self.executor, self.helper.warm_start_ladder_score,
+                                                 primitive, df, df_lbl, param, sizes,
+                                                 self.cross_validation_folds, self.cv_seed)
+            else:
+                keep_fold_models = self.refit_mode == 'bagged'
+                task = self.loop.run_in_executor(self.executor, self.helper.cross_validation_score_remote,
+                                                 primitive, df, df_lbl, self.cross_validation_folds, self.cv_seed,
+                                                 keep_fold_models)
 
             self.log.debug('%s Run primitive waiting   %s', exec_pipeline.id, primitive)
             await asyncio.wait([task], timeout=TIMEOUT)
@@ -534,10 +691,33 @@ class ResourceManager:
             metric_values = []
             if task.done():
                 result = task.result()
-                if not isinstance(result, Exception) and result is not None:
-                    predictions, metric_values, cross_validation_stat = result
+                if ladder is not None and isinstance(result, list):
+                    # The rung with the original size stands for this pipeline
+                    for (size, rung_predictions, rung_metric_values, rung_stat) in result:
+                        if size == max(1, int(base_size)):
+                            (predictions, metric_values, cross_validation_stat) = (
+                                rung_predictions, rung_metric_values, rung_stat)
+                    unified_interface = False
+                    self._add_ladder_variants(exec_pipeline, primitive, param,
+                                              [rung for rung in result if rung[0] != max(1, int(base_size))],
+                                              df, df_lbl)
+                elif not isinstance(result, Exception) and result is not None:
+                    (predictions, metric_values, cross_validation_stat,
+                     fold_executables, unified_interface) = result
+
+            if metric_values and len(metric_values) > 0 and self.refit_mode != 'full':
+                print("Got results from %s" % exec_pipeline)
+                self.log.debug("%s Got results from %s", exec_pipeline.id, primitive)
+
+                if self.refit_mode == 'bagged':
+                    executables = fold_executables
+                else:
+                    # Fit on full training data only when the pipeline is needed
+                    self.deferred_refits[cachekey] = DeferredRefit(primitive, df, df_lbl)
+
+                exec_pipeline.planner_result = PipelineExecutionResult(predictions, metric_values, cross_validation_stat)
 
-            if metric_values and len(metric_values) > 0:
+            elif metric_values and len(metric_values) > 0:
                 print("Got results from %s" % exec_pipeline)
                 self.log.debug("%s Got results from %s", exec_pipeline.id, primitive)
 
@@ -577,14 +757,14 @@ class ResourceManager:
                 # Re-profile intermediate data here.
                 # TODO: Recheck if it is ok for the primitive's preconditions
                 #       and patch pipeline if necessary
-                cur_profile = DataProfile(df)
+                cur_profile = self._data_profile(self.parent_keys.get(cachekey), df)
 
                 # Glue primitive
                 df = self.helper.execute_primitive(
                     primitive, copy.copy(df), df_lbl, cur_profile, timeout=TIMEOUT)
                 self.primitive_cache[cachekey] = (primitive.executables, primitive.unified_interface)
             else:
-                cur_profile = DataProfile(df)
+                cur_profile = self._data_profile(self.parent_keys.get(cachekey), df)
 
                 self.log.debug('%s Run primitive submit    %s', exec_pipeline.id, primitive)
                 task = self.loop.run_in_executor(self.executor, self.helper.execute_primitive_remote, primitive,
@@ -0,0 +1,79 @@
+'''Samples of data streamed in chunks'''
+
+import numpy as np
+import pandas as pd
+
+
+class ReservoirSample(object):
+    """
+    Uniform random sample of a fixed number of rows from a stream of
+    DataFrame chunks (reservoir sampling, algorithm R, one chunk at a time).
+    """
+
+    def __init__(self, size, random_state=None):
+        self.size = size
+        self.random = random_state if isinstance(random_state, np.random.RandomState) \
+            else np.random.RandomState(random_state)
+        # Number of rows seen so far
+        self.seen = 0
+        self.sample = None
+
+    def add(self, chunk):
+        nrows = len(chunk)
+        if nrows == 0:
+            return
+        kept = 0 if self.sample is None else len(self.sample)
+        pool = chunk if self.sample is None else pd.concat([self.sample, chunk])
+
+        # Positions in the pool of the sample rows. The first rows fill the sample.
+        nfill = min(self.size - kept, nrows)
+        slots = np.concatenate([np.arange(kept), kept + np.arange(nfill)]).astype(np.int64)
+        rest = np.arange(nfill, nrows)
+        if len(rest) > 0:
+            # Row t of the stream replaces a random slot with probability size / (t + 1)
+            replace = (self.random.random_sample(len(rest)) * (self.seen + rest + 1)).astype(np.int64)
+            mask = replace < self.size
+            # Later rows of the chunk win, as if added one at a time
+            slots[replace[mask]] = kept + rest[mask]
+        self.seen += nrows
+        self.sample = pool.iloc[slots]
+
+    def get(self):
+        return self.sample
+
+
+class StratifiedSample(object):
+    """
+    Sample of a fixed number of rows from a stream of DataFrame chunks,
+    with each class in proportion to its count in the stream (and at
+    least one row per class). Each class keeps its own reservoir.
+    """
+
+    def __init__(self, size, random_state=None):
+        self.size = size
+        self.random = np.random.RandomState(random_state)
+        self.reservoirs = {}
+
+    def add(self, chunk, labels):
+        '''Adds the rows of the chunk, labels holds the class of each row'''
+        for (label, rows) in pd.Series(np.arange(len(chunk))).groupby(np.asarray(labels)):
+            if label not in self.reservoirs:
+                self.reservoirs[label] = ReservoirSample(self.size, self.random)
+            self.reservoirs[label].add(chunk.iloc[rows.values])
+
+    def get(self):
+        if not self.reservoirs:
+            return None
+        total = float(sum(reservoir.seen for reservoir in self.reservoirs.values()))
+        samples = []
+        for label in sorted(self.reservoirs.keys(), key=str):
+            reservoir = self.reservoirs[label]
+            quota = max(1, int(round(self.size * reservoir.seen / total)))
+            sample = reservoir.get()
+            if quota < len(sample):
+                sample = sample.iloc[np.sort(self.random.choice(len(sample), quota, replace=False))]
+            samples.append(sample)
+        return pd.concat(samples)
+
+    def classes(self):
+        return list(self.reservoirs.keys())
@@ -0,0 +1,151 @@
+'''Vectorized scoring of candidate predictions over cross-validation folds'''
+
+import sys
+
+import numpy as np
+
+from dsbox.schema.problem_schema import Metric, TaskSubType
+
+
+class ScoringEngine(object):
+    """
+    Computes all problem metrics for a matrix of predictions in one pass.
+
+    Predictions have one row per instance and one column per candidate
+    (pipeline, warm start rung, ensemble candidate, ...). Subsets of
+    rows, such as the cross-validation folds, are selected with a boolean
+    mask matrix with one row per subset. Accuracy, F1 (binary, micro and
+    macro), MSE, RMSE, MAE and R^2 are computed with NumPy, and give the
+    same values as the sklearn metric functions. Other metrics fall back
+    to calling the problem metric function for each subset and candidate.
+    """
+
+    def __init__(self, problem):
+        self.problem = problem
+
+    @staticmethod
+    def fold_masks(num_rows, test_indices, include_all=True):
+        '''Returns a boolean mask matrix with a row for each fold of test
+        indices. If include_all, the first row selects all rows.'''
+        masks = np.zeros((len(test_indices) + int(include_all), num_rows), dtype=bool)
+        if include_all:
+            masks[0, :] = True
+        for i, test in enumerate(test_indices):
+            masks[i + int(include_all), test] = True
+        return masks
+
+    @staticmethod
+    def value(score):
+        '''Converts a score to float, or None if the metric failed'''
+        if score is None or np.isnan(score):
+            return None
+        return float(score)
+
+    def score(self, y_true, predictions, masks=None):
+        '''Returns dict of metric name to array of shape (masks, candidates)'''
+        y = np.asarray(y_true).ravel()
+        preds = np.asarray(predictions)
+        if preds.ndim == 1:
+            preds = preds[:, np.newaxis]
+        if masks is None:
+            masks = np.ones((1, len(y)), dtype=bool)
+        masks = np.asarray(masks, dtype=bool)
+
+        result = {}
+        for metric, fn in zip(self.problem.metrics, self.problem.metric_functions):
+            result[metric.name] = self._score_metric(metric, fn, y, preds, masks)
+        return result
+
+    def _score_metric(self, metric, fn, y, preds, masks):
+        weights = masks.astype(np.float64)
+        counts = weights.sum(axis=1)[:, np.newaxis]
+        try:
+            if metric == Metric.ACCURACY:
+                return self._accuracy(y, preds, weights, counts)
+            elif metric == Metric.F1 and self.problem.task_subtype == TaskSubType.BINARY:
+                return self._f1_binary(y, preds, weights)
+            elif metric in [Metric.F1, Metric.F1_MICRO]:
+                # Micro averaged F1 over all labels of single label targets is accuracy
+                self._check_discrete(y, preds)
+                return self._accuracy(y, preds, weights, counts)
+            elif metric == Metric.F1_MACRO:
+                return self._f1_macro(y, preds, weights)
+            elif metric == Metric.MEAN_SQUARED_ERROR:
+                return self._squared_error(y, preds, weights, counts)
+            elif metric in [Metric.ROOT_MEAN_SQUARED_ERROR, Metric.ROOT_MEAN_SQUARED_ERROR_AVG]:
+                return np.sqrt(self._squared_error(y, preds, weights, counts))
+            elif metric == Metric.MEAN_ABSOLUTE_ERROR:
+                return self._absolute_error(y, preds, weights, counts)
+            elif metric == Metric.R_SQUARED:
+                return self._r_squared(y, preds, weights, counts)
+        except (TypeError, ValueError):
+            # Let the metric function decide (and report) what is wrong
+            pass
+        return self._score_with_function(fn, y, preds, masks)
+
+    def _score_with_function(self, fn, y, preds, masks):
+        scores = np.full((masks.shape[0], preds.shape[1]), np.nan)
+        if fn is None:
+            return scores
+        for i in range(masks.shape[0]):
+            for j in range(preds.shape[1]):
+                try:
+                    scores[i, j] = fn(y[masks[i]], preds[masks[i], j])
+                except Exception as e:
+                    sys.stderr.write("ERROR: ScoringEngine {}: {}\n".format(fn, e))
+        return scores
+
+    def _check_discrete(self, y, preds):
+        for values in [y, preds]:
+            if values.dtype.kind == 'f' and not np.all(np.mod(values[~np.isnan(values)], 1) == 0):
+                raise ValueError('Continuous values for classification metric')
+
+    def _accuracy(self, y, preds, weights, counts):
+        return weights.dot((preds == y[:, np.newaxis]).astype(np.float64)) / counts
+
+    def _f1_binary(self, y, preds, weights):
+        self._check_discrete(y, preds)
+        labels = set(np.unique(y).tolist()) | set(np.unique(preds).tolist())
+        if not labels <= {0, 1}:
+            raise ValueError('Binary F1 needs 0/1 labels')
+        pred_pos = preds == 1
+        true_pos = (y == 1)[:, np.newaxis]
+        tp = weights.dot((pred_pos & true_pos).astype(np.float64))
+        fp = weights.dot((pred_pos & ~true_pos).astype(np.float64))
+        fn = weights.dot((~pred_pos & true_pos).astype(np.float64))
+        denom = 2 * tp + fp + fn
+        return np.where(denom > 0, 2 * tp / np.maximum(denom, 1), 0.0)
+
+    def _f1_macro(self, y, preds, weights):
+        self._check_discrete(y, preds)
+        labels = np.unique(np.concatenate([y, preds.ravel()]))
+        total = np.zeros((weights.shape[0], preds.shape[1]))
+        present = np.zeros((weights.shape[0], preds.shape[1]))
+        for label in labels:
+            pred_label = preds == label
+            true_label = (y == label)[:, np.newaxis]
+            tp = weights.dot((pred_label & true_label).astype(np.float64))
+            support = (weights.dot(pred_label.astype(np.float64))
+                       + weights.dot(true_label.astype(np.float64)))
+            # Per label F1 is 2*tp / (predicted + true); labels absent from a subset are not averaged
+            total += np.where(support > 0, 2 * tp / np.maximum(support, 1), 0.0)
+            present += support > 0
+        return total / np.maximum(present, 1)
+
+    def _errors(self, y, preds):
+        return preds.astype(np.float64) - y.astype(np.float64)[:, np.newaxis]
+
+    def _squared_error(self, y, preds, weights, counts):
+        return weights.dot(self._errors(y, preds) ** 2) / counts
+
+    def _absolute_error(self, y, preds, weights, counts):
+        return weights.dot(np.abs(self._errors(y, preds))) / counts
+
+    def _r_squared(self, y, preds, weights, counts):
+        yf = y.astype(np.float64)
+        ss_res = weights.dot(self._errors(y, preds) ** 2)
+        means = weights.dot(yf) / counts.ravel()
+        ss_tot = (weights * (yf[np.newaxis, :] - means[:, np.newaxis]) ** 2).sum(axis=1)[:, np.newaxis]
+        # Same convention as sklearn for constant targets
+        constant = np.where(ss_res == 0, 1.0, 0.0)
+        return np.where(ss_tot > 0, 1 - ss_res / np.where(ss_tot > 0, ss_tot, 1), constant)
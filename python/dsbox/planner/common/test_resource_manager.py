@@ -0,0 +1,148 @@
+'''Tests of the refit modes of the ResourceManager (see REFIT_MODES).
+Run with pytest.'''
+
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+from dsbox.executer.bagging import BaggedPredictor
+from dsbox.executer.executionhelper import ExecutionHelper
+from dsbox.planner.common.pipeline import Pipeline
+from dsbox.planner.common.primitive import Primitive
+from dsbox.planner.common.problem_manager import Problem
+from dsbox.planner.common.resource_manager import ResourceManager
+from dsbox.schema.problem_schema import Metric
+
+NUM_ROWS = 60
+NUM_FOLDS = 3
+
+random = np.random.RandomState(0)
+INPUT = pd.DataFrame({'a': random.normal(size=NUM_ROWS), 'b': random.normal(size=NUM_ROWS)})
+TARGET = pd.DataFrame({'label': (INPUT['a'] + 0.5 * random.normal(size=NUM_ROWS) > 0).astype(int)})
+
+
+class DataManager(object):
+    target_columns = [{'colName': 'label'}]
+
+
+def make_helper():
+    problem = Problem()
+    problem.set_task_type('classification', 'binary')
+    problem.set_metrics([Metric.ACCURACY])
+    return ExecutionHelper(problem, DataManager())
+
+
+def learner():
+    primitive = Primitive('naive_bayes', 'GaussianNB', 'sklearn.naive_bayes.GaussianNB')
+    primitive.task = "Modeling"
+    return primitive
+
+
+def make_resource_manager(helper, refit_mode):
+    manager = ResourceManager(helper)
+    manager.shutdown()
+    # Run the primitives in threads of this process
+    manager.executor = concurrent.futures.ThreadPoolExecutor(2)
+    manager.background_executor = concurrent.futures.ThreadPoolExecutor(1)
+    manager.cross_validation_folds = NUM_FOLDS
+    manager.refit_mode = refit_mode
+    return manager
+
+
+def test_bagged_fold_models():
+    helper = make_helper()
+    primitive = learner()
+    primitive.pipeline = Pipeline(primitives=[primitive])
+    (predictions, metric_values, stat, executables, unified_interface) = helper.cross_validation_score_remote(
+        primitive, INPUT, TARGET, NUM_FOLDS, 0, keep_fold_models=True)
+
+    assert metric_values is not None
+    assert isinstance(executables, BaggedPredictor)
+    assert len(executables.models) == NUM_FOLDS
+
+    # Majority vote of the fold models
+    bagged = BaggedPredictor(executables.models, unified_interface, classification=True)
+    votes = np.column_stack([model.predict(INPUT) for model in executables.models])
+    expected = (votes.sum(axis=1) * 2 > NUM_FOLDS).astype(int)
+    assert list(bagged.predict(INPUT)) == list(expected)
+    assert list(executables.predict(INPUT)) == list(expected)
+
+    # The bagged mode uses the fold models and has nothing to refit
+    manager = make_resource_manager(helper, 'bagged')
+    run_pipelines(manager, [Pipeline(primitives=[learner()])])
+    cachekey = "%s.%s" % (manager.data_view, learner())
+    assert isinstance(manager.primitive_cache[cachekey][0], BaggedPredictor)
+    assert manager.deferred_refits == {}
+    manager.executor.shutdown()
+    manager.background_executor.shutdown()
+
+
+def count_fits(helper):
+    '''Records the cache keys of the learners fitted on full training data'''
+    fitted = []
+    create_primitive_model_remote = helper.create_primitive_model_remote
+
+    def create_and_count(primitive, X, y):
+        fitted.append(primitive.cachekey)
+        return create_primitive_model_remote(primitive, X, y)
+    helper.create_primitive_model_remote = create_and_count
+    return fitted
+
+
+def run_pipelines(manager, pipelines):
+    # One after the other, so a later pipeline scores a shared learner again under the same cache key
+    for pipeline in pipelines:
+        manager.stats.pipeline_pending(pipeline)
+        manager.loop.run_until_complete(manager._run_pipeline(pipeline, INPUT, TARGET, manager.data_view))
+
+
+def test_deferred_refit_shared_learner():
+    helper = make_helper()
+    fitted = count_fits(helper)
+    manager = make_resource_manager(helper, 'deferred')
+    run_pipelines(manager, [Pipeline(primitives=[learner()]), Pipeline(primitives=[learner()])])
+
+    # One deferred refit for the learner the pipelines share, nothing fitted yet
+    cachekey = "%s.%s" % (manager.data_view, learner())
+    assert list(manager.deferred_refits.keys()) == [cachekey]
+    assert manager.primitive_cache[cachekey][0] is None
+    assert fitted == []
+
+    (exec_pipeline, other) = manager.exec_pipelines
+    manager.refit_pipeline(exec_pipeline)
+
+    (executables, unified_interface) = manager.primitive_cache[cachekey]
+    assert executables is not None
+    assert exec_pipeline.primitives[-1].executables is executables
+    assert fitted == [cachekey]
+    assert manager.deferred_refits[cachekey].df is None
+
+    # Another pipeline with the same learner gets the same fit
+    manager.refit_pipeline(other)
+    assert other.primitives[-1].executables is executables
+    assert fitted == [cachekey]
+
+    manager.executor.shutdown()
+    manager.background_executor.shutdown()
+
+
+def test_top_k_background_refit():
+    helper = make_helper()
+    fitted = count_fits(helper)
+    manager = make_resource_manager(helper, 'top_k')
+    run_pipelines(manager, [Pipeline(primitives=[learner()])])
+
+    cachekey = "%s.%s" % (manager.data_view, learner())
+    refit = manager.deferred_refits[cachekey]
+    manager.refit_pipelines_in_background(manager.exec_pipelines)
+    assert refit.future is not None
+
+    manager.refit_pipeline(manager.exec_pipelines[0])
+    assert refit.future is None
+    assert fitted == [cachekey]
+    assert manager.primitive_cache[cachekey] == refit.result
+    assert manager.exec_pipelines[0].primitives[-1].executables is refit.result[0]
+
+    manager.executor.shutdown()
+    manager.background_executor.shutdown()
@@ -0,0 +1,78 @@
+'''The ScoringEngine must give the same values as the problem metric
+functions (sklearn). Run with pytest.'''
+
+import numpy as np
+
+from dsbox.planner.common.problem_manager import Problem
+from dsbox.planner.common.scoring import ScoringEngine
+from dsbox.schema.problem_schema import Metric
+
+NUM_ROWS = 120
+NUM_FOLDS = 4
+NUM_CANDIDATES = 5
+
+
+def make_problem(task_type, task_subtype, metrics):
+    problem = Problem()
+    problem.set_task_type(task_type, task_subtype)
+    problem.set_metrics(metrics)
+    return problem
+
+
+def random_folds(random):
+    positions = random.permutation(NUM_ROWS)
+    return [np.sort(test) for test in np.array_split(positions, NUM_FOLDS)]
+
+
+def check_same_scores(problem, y, predictions, folds):
+    masks = ScoringEngine.fold_masks(len(y), folds)
+    scores = ScoringEngine(problem).score(y, predictions, masks)
+    for metric, fn in zip(problem.metrics, problem.metric_functions):
+        assert scores[metric.name].shape == (len(masks), predictions.shape[1])
+        for i, mask in enumerate(masks):
+            for j in range(predictions.shape[1]):
+                expected = fn(y[mask], predictions[mask, j])
+                assert np.isclose(scores[metric.name][i, j], expected), (metric, i, j)
+
+
+def test_binary_f1():
+    random = np.random.RandomState(0)
+    problem = make_problem('classification', 'binary', [Metric.F1, Metric.ACCURACY])
+    y = random.randint(0, 2, NUM_ROWS)
+    predictions = random.randint(0, 2, (NUM_ROWS, NUM_CANDIDATES))
+    check_same_scores(problem, y, predictions, random_folds(random))
+
+
+def test_macro_f1_label_missing_from_fold():
+    random = np.random.RandomState(1)
+    problem = make_problem('classification', 'multiClass', [Metric.F1_MACRO, Metric.F1_MICRO])
+    folds = random_folds(random)
+    y = random.randint(0, 3, NUM_ROWS)
+    predictions = random.randint(0, 3, (NUM_ROWS, NUM_CANDIDATES))
+    # Label 2 is neither a target nor a prediction in the first fold
+    y[folds[0]] = random.randint(0, 2, len(folds[0]))
+    predictions[folds[0]] = random.randint(0, 2, (len(folds[0]), NUM_CANDIDATES))
+    check_same_scores(problem, y, predictions, folds)
+
+
+def test_accuracy_string_labels():
+    random = np.random.RandomState(2)
+    problem = make_problem('classification', 'multiClass', [Metric.ACCURACY])
+    labels = np.array(['cat', 'dog', 'bird'], dtype=object)
+    y = labels[random.randint(0, 3, NUM_ROWS)]
+    predictions = labels[random.randint(0, 3, (NUM_ROWS, NUM_CANDIDATES))]
+    check_same_scores(problem, y, predictions, random_folds(random))
+
+
+def test_regression_constant_target_fold():
+    random = np.random.RandomState(3)
+    problem = make_problem('regression', 'univariate',
+                           [Metric.R_SQUARED, Metric.MEAN_SQUARED_ERROR, Metric.MEAN_ABSOLUTE_ERROR,
+                            Metric.ROOT_MEAN_SQUARED_ERROR])
+    folds = random_folds(random)
+    y = random.normal(size=NUM_ROWS)
+    predictions = y[:, np.newaxis] + random.normal(scale=0.5, size=(NUM_ROWS, NUM_CANDIDATES))
+    # The targets of the first fold are constant, and the first candidate predicts them exactly
+    y[folds[0]] = 1.5
+    predictions[folds[0], 0] = 1.5
+    check_same_scores(problem, y, predictions, folds)
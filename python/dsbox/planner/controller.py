@@ -1,4 +1,5 @@
 import asyncio
+import concurrent.futures
 import copy
 import json
 import functools
@@ -7,25 +8,25 @@ import sys
 import traceback
 import pdb
 
-import pandas as pd
-
 from typing import List
 
-from collections import defaultdict
-
 from dsbox.planner.leveltwo.l1proxy import LevelOnePlannerProxy
 from dsbox.planner.leveltwo.planner import LevelTwoPlanner
 from dsbox.schema.data_profile import DataProfile
 from dsbox.executer.executionhelper import ExecutionHelper
-from dsbox.planner.common.data_manager import Dataset, DataManager
+from dsbox.executer.model_store import ModelStore
+from dsbox.executer.prefix_executor import PrefixExecutor
+from dsbox.planner.common.data_manager import Dataset, DataManager, FULL_VIEW
 from dsbox.planner.common.pipeline import Pipeline, PipelineExecutionResult, OneStandardErrorPipelineSorter, PipelineSorter
-from dsbox.planner.common.problem_manager import Problem
+from dsbox.planner.common.problem_manager import Problem, TaskType
 from dsbox.planner.common.resource_manager import ResourceManager
 from dsbox.planner.ensemble import Ensemble
 
 from dsbox.planner.hyperparam_tuning import RandomHyperparamTuning
 
 NUMBER_HYPERPARAM_SEARCHES = 100
+# Name of the data view the pipeline search runs on, if sampled
+SEARCH_VIEW = "search"
 
 class Feature:
     def __init__(self, resource_id, feature_name):
@@ -119,7 +120,34 @@ class Controller(object):
         self.problem = Problem()
         self.data_manager = DataManager()
         self.execution_helper = ExecutionHelper(self.problem, self.data_manager)
+        previous_resource_manager = self.resource_manager
         self.resource_manager = ResourceManager(self.execution_helper, self.num_cpus)
+        if previous_resource_manager is not None:
+            # Keep learners from an earlier training run that are waiting to be fitted
+            self.resource_manager.deferred_refits = previous_resource_manager.deferred_refits
+            # Its submitted tasks (such as background refits) still complete
+            previous_resource_manager.shutdown(wait=False)
+        self.resource_manager.refit_mode = config.get('refit_mode', 'full')
+        self.resource_manager.refit_top_k = int(config.get('refit_top_k', 5))
+        self.resource_manager.warm_start_ladder = config.get('warm_start_ladder', [])
+        self.resource_manager.profile_sample_rows = int(config.get('profile_sample_rows', 0)) or None
+
+        # Export only the top ranked pipelines at the end of training (0 for all)
+        self.export_top_k = int(config.get('export_top_k', 0))
+        self.export_workers = int(config.get('export_workers', self.num_cpus or os.cpu_count()))
+        self.deferred_exports = {}
+
+        # Search on a sample of the training data, sized by rows or by seconds
+        # (at search_rows_per_second), then run the top ranked pipelines again
+        # on all the data. 0 to search on all the data.
+        self.search_sample_rows = int(config.get('search_sample_rows', 0))
+        self.search_sample_seconds = float(config.get('search_sample_seconds', 0))
+        self.search_rows_per_second = int(config.get('search_rows_per_second', 20000))
+        self.search_sample_seed = int(config.get('search_sample_seed', 0))
+        self.search_refit_top_k = int(config.get('search_refit_top_k', 5))
+        # Ids of the pipelines refitted on the full data (out of core mode)
+        self.full_data_fitted = set()
+        self.model_store = ModelStore(os.path.join(self.tmp_dir, "models", "store"))
 
         if not self.development_mode:
             # Redirect stderr to error file
@@ -177,8 +205,27 @@ class Controller(object):
         datadoc = self.config.get('dataset_schema', None)
         assert(dataroot is not None)
         dataset = Dataset()
-        dataset.load_dataset(dataroot, datadoc)
-        self.data_manager.initialize_data(self.problem, [dataset], view='TRAIN')
+        if self.config.get('out_of_core', False):
+            # Search on a sample, the full data is streamed from disk
+            dataset.load_dataset(dataroot, datadoc, streaming=True, problem=self.problem,
+                                 **self._table_read_options())
+            self.data_manager.initialize_data_sample(
+                self.problem, [dataset], view='TRAIN',
+                sample_rows=int(self.config.get('training_sample_rows', 100000)),
+                chunksize=int(self.config.get('training_chunksize', 10000)),
+                stratify=self.problem.task_type == TaskType.CLASSIFICATION,
+                random_state=self.config.get('sample_seed', None))
+        else:
+            dataset.load_dataset(dataroot, datadoc, problem=self.problem, **self._table_read_options())
+            self.data_manager.initialize_data(self.problem, [dataset], view='TRAIN')
+
+    def _table_read_options(self):
+        '''How dataset tables are read (see Dataset.set_read_options)'''
+        # The columnar cache is written next to the tables, so it is off
+        # unless the dataset directory is writable and shared between runs
+        return {'engine': self.config.get('csv_engine', None),
+                'cache': bool(self.config.get('table_cache', False)),
+                'float32': bool(self.config.get('table_float32', False))}
 
     """
     Initialize from features
@@ -200,24 +247,26 @@ class Controller(object):
         self.initialize_from_config(config)
         data_directory = os.path.dirname(datafile)
 
-        # Load datasets first
+        # Set the problem features first, so that only their columns are read
         filters = {}
         targets = {}
-        dataset = Dataset()
-        dataset.load_dataset(data_directory, datafile)
+        with open(datafile, 'r') as f:
+            dsID = json.load(f)["about"]["datasetID"]
 
         if train_features is not None:
-            filters[dataset.dsID] = list(map(
+            filters[dsID] = list(map(
                 lambda x: {"resID": x.resource_id, "colName": x.feature_name}, train_features
             ))
             self.problem.dataset_filters = filters
 
         if target_features is not None:
-            targets[dataset.dsID] = list(map(
+            targets[dsID] = list(map(
                 lambda x: {"resID": x.resource_id, "colName": x.feature_name}, target_features
             ))
             self.problem.dataset_targets = targets
 
+        dataset = Dataset()
+        dataset.load_dataset(data_directory, datafile, problem=self.problem, **self._table_read_options())
         self.data_manager.initialize_data(self.problem, [dataset], view)
 
     def get_pipeline_sorter(self):
@@ -248,9 +297,17 @@ class Controller(object):
         # Get data details
         df = copy.copy(self.data_manager.input_data)
         df_lbl = copy.copy(self.data_manager.target_data)
-        df_profile = DataProfile(df)
+        if self.data_manager.profile is not None:
+            # Profile of the full data, df is a sample
+            df_profile = self.data_manager.profile
+        else:
+            df_profile = DataProfile(df, self.resource_manager.profile_sample_rows)
         self.logfile.write("Data profile: %s\n" % df_profile)
 
+        search_view = self._add_search_view()
+        if search_view is not None:
+            (df, df_lbl) = [copy.copy(data) for data in self.data_manager.get_view(search_view)]
+
         # Generate pipelines and store in self.exec_pipelines
         print('I am here')
 
@@ -312,12 +369,22 @@ class Controller(object):
         # self.exec_pipelines = sorted(self.exec_pipelines, key=lambda x: self._sort_by_metric(x))
         self.exec_pipelines = self.get_pipeline_sorter().sort_pipelines(self.exec_pipelines)
 
+        ensemble_pipelines = self.exec_pipelines
+        if search_view is not None:
+            # Rank, ensemble and fit the best pipelines on all the data
+            ensemble_pipelines = self._revalidate_on_full_view(timeout)
+            (df, df_lbl) = [copy.copy(data) for data in self.data_manager.get_view(FULL_VIEW)]
+
+        if self.resource_manager.refit_mode == 'top_k':
+            # Fit the best pipelines on full data, while ensembling and exporting
+            self.resource_manager.refit_pipelines_in_background(
+                self.exec_pipelines[:self.resource_manager.refit_top_k])
 
         # Create ensemble
         if ensemble:
             try:
                 ensemble_pipeline = self.ensemble.greedy_add(
-                    self.exec_pipelines, df, df_lbl, cv = self.resource_manager.cross_validation_folds, seed = self.resource_manager.cv_seed)
+                    ensemble_pipelines, df, df_lbl, cv = self.resource_manager.cross_validation_folds, seed = self.resource_manager.cv_seed)
                 if ensemble_pipeline:
                     self.exec_pipelines.append(ensemble_pipeline)
 
@@ -339,6 +406,48 @@ class Controller(object):
 
 
 
+    def _add_search_view(self):
+        '''Adds the search sample view if the training data is larger than the
+        search budget. Returns the name of the view, or None'''
+        rows = self.search_sample_rows
+        if self.search_sample_seconds > 0:
+            budget = int(self.search_sample_seconds * self.search_rows_per_second)
+            rows = min(rows, budget) if rows > 0 else budget
+        full_rows = len(self.data_manager.input_data)
+        if rows <= 0 or rows >= full_rows:
+            return None
+        stratify = self.problem.task_type == TaskType.CLASSIFICATION
+        rows = self.data_manager.add_sample_view(SEARCH_VIEW, rows, stratify, self.search_sample_seed)
+        print("Searching on a sample of %d of %d rows" % (rows, full_rows))
+        self.resource_manager.stats.search_sample = {
+            'view': SEARCH_VIEW, 'rows': rows, 'full_rows': full_rows,
+            'stratified': stratify, 'seed': self.search_sample_seed}
+        self.resource_manager.data_view = SEARCH_VIEW
+        return SEARCH_VIEW
+
+    def _revalidate_on_full_view(self, timeout):
+        '''Runs the top ranked pipelines of the sample search again on the full
+        view: they are cross validated and fitted on all the data. The other
+        pipelines (fitted and scored on the sample only) are dropped. Returns
+        the revalidated pipelines, ranked.'''
+        top_pipelines = self.exec_pipelines[:self.search_refit_top_k]
+        self._show_status("Validating %d pipeline(s) on the full training data..." % len(top_pipelines))
+        (df, df_lbl) = self.data_manager.get_view(FULL_VIEW)
+        self.resource_manager.data_view = ""
+        nsearched = len(self.resource_manager.exec_pipelines)
+        self.resource_manager.execute_pipelines(
+            top_pipelines, copy.copy(df), copy.copy(df_lbl), timeout=timeout)
+        revalidated = self.get_pipeline_sorter().sort_pipelines(
+            self.resource_manager.exec_pipelines[nsearched:])
+        if not revalidated:
+            sys.stderr.write("ERROR: no pipeline ran on the full training data (of %d)\n" % len(top_pipelines))
+        self.exec_pipelines = list(revalidated)
+        # Deferred refits of the sample pipelines are no longer needed
+        deferred_refits = self.resource_manager.deferred_refits
+        for cachekey in [key for key in deferred_refits if key.startswith(SEARCH_VIEW + ".")]:
+            del deferred_refits[cachekey]
+        return revalidated
+
     def pipeline_result_call_back(self, pipeline, df, df_lbl, task: asyncio.Future):
         if self.hyperparam_count > NUMBER_HYPERPARAM_SEARCHES:
             print('call_back limit reached')
@@ -373,6 +482,13 @@ class Controller(object):
 
         # Create executables
         self.pipelinesfile.write("# Pipelines ranked by (adjusted) metrics (%s)\n" % self.problem.metrics)
+        export_pipelines = []
+        if self.export_top_k > 0:
+            refit_pipelines = self.exec_pipelines[:self.export_top_k]
+        else:
+            refit_pipelines = self.exec_pipelines
+        # Deferred learner refits run in the worker pool, and are collected below
+        self.resource_manager.refit_pipelines_in_background(refit_pipelines)
         for index in range(0, len(self.exec_pipelines)):
             pipeline = self.exec_pipelines[index]
             rank = index + 1
@@ -385,9 +501,21 @@ class Controller(object):
             self.pipelinesfile.write("%s ( %s ) : %s\n" % (pipeline.id, pipeline, metric_values))
             #self.pipelinesfile.write("\n Failed Pipelines \n")
             #self.pipelinesfile.write("%s\n" % str(self.failed_pipelines))
-            self.execution_helper.create_pipeline_executable(pipeline, self.config)
+            if self.export_top_k > 0 and rank > self.export_top_k:
+                # Exported on request (see export_pipeline)
+                self.deferred_exports[pipeline.id] = pipeline
+            else:
+                try:
+                    self.resource_manager.refit_pipeline(pipeline)
+                    export_pipelines.append(pipeline)
+                except Exception as e:
+                    sys.stderr.write("ERROR refit_pipeline(%s) : %s\n" % (pipeline, e))
+                    traceback.print_exc()
             self.create_pipeline_logfile(pipeline, rank)
 
+        self.fit_on_full_data(export_pipelines)
+        self.export_pipelines(export_pipelines)
+
         # Flush pipeline
         self.pipelinesfile.flush()
 
@@ -395,6 +523,51 @@ class Controller(object):
         with open(self.statistics_filename, 'w') as outfile:
             self.resource_manager.stats.json_line_dump(outfile, problem_id=self.problem.get_problem_id(),
                                                        dataset_names=self.problem.get_dataset_ids())
+    def export_pipelines(self, pipelines):
+        '''Creates the pipeline executables in parallel threads. Fitted
+        primitives shared by the pipelines are written once to the model
+        store, which needs them in this process (not in worker processes)'''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.export_workers) as executor:
+            futures = {}
+            for pipeline in pipelines:
+                future = executor.submit(self.execution_helper.create_pipeline_executable,
+                                         pipeline, self.config, self.model_store)
+                futures[future] = pipeline
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    sys.stderr.write("ERROR export_pipelines(%s) : %s\n" % (futures[future], e))
+                    traceback.print_exc()
+        self.model_store.release()
+
+    def fit_on_full_data(self, pipelines):
+        '''Out of core mode: the learners were fitted on the training sample.
+        Fits the learners that support partial_fit again over the full
+        training data, streamed in chunks (one pass for all pipelines).'''
+        if not self.data_manager.sampled:
+            return
+        pipelines = [pipeline for pipeline in pipelines if pipeline.id not in self.full_data_fitted]
+        if not pipelines:
+            return
+        self._show_status("Fitting %d pipeline(s) on the full training data..." % len(pipelines))
+        prefix_executor = PrefixExecutor(self.execution_helper)
+        refitted = prefix_executor.partial_fit(
+            pipelines, self.data_manager.iter_full_data(), self.data_manager.target_classes)
+        print("Refitted %d learner(s) on the full training data" % refitted)
+        self.full_data_fitted.update(pipeline.id for pipeline in pipelines)
+
+    def export_pipeline(self, pipeline, config=None):
+        '''Creates the executable of a single pipeline (such as a deferred export)'''
+        self.resource_manager.refit_pipeline(pipeline)
+        self.fit_on_full_data([pipeline])
+        try:
+            self.execution_helper.create_pipeline_executable(
+                pipeline, config if config is not None else self.config, self.model_store)
+        finally:
+            self.model_store.release()
+        self.deferred_exports.pop(pipeline.id, None)
+
     def write_test_results(self):
         # Sort pipelines
         # self.exec_pipelines = sorted(self.exec_pipelines, key=lambda x: self._sort_by_metric(x))
@@ -411,6 +584,8 @@ class Controller(object):
             rank = index + 1
             # Format the metric values
             metric_values = []
+            if pipeline.test_result is None:
+                continue
             for metric in pipeline.test_result.metric_values.keys():
                 metric_value = pipeline.test_result.metric_values[metric]
                 metric_values.append("%s = %2.4f" % (metric, metric_value))
@@ -420,95 +595,51 @@ class Controller(object):
             self.create_pipeline_logfile(pipeline, rank)
 
 
-    def test_pipelines(self):
-        #handler = GRPC_PlannerEventHandler()
-        for pipeline in self.exec_pipelines:
-            #try:
-            #    res = self.test(pipeline, None)
-            #except Exception as e:
-            #    print(e)
-            for result in self.test(pipeline):#, handler):
-                if result is not None:
-                    yield result
+    def test_pipelines(self, pipelines=None, test_event_handler=None):
+        '''
+        Predict results on test data for several pipelines at once. Shared
+        primitive prefixes are applied once, and the learners are run in
+        the resource manager workers.
+        '''
+        if pipelines is None:
+            pipelines = self.exec_pipelines
+        helper = ExecutionHelper(self.problem, self.data_manager)
+        target_col = self.data_manager.target_columns[0]['colName']
+        # Deferred refits run in parallel, refit_pipeline collects them
+        self.resource_manager.refit_pipelines_in_background(pipelines)
+        for pipeline in pipelines:
+            print("** Evaluating pipeline %s" % str(pipeline))
+            sys.stdout.flush()
+            self.resource_manager.refit_pipeline(pipeline)
+
+        prefix_executor = PrefixExecutor(helper, self.resource_manager.executor)
+        for (pipeline, predictions, metric_values) in prefix_executor.execute(
+                pipelines, self.data_manager.input_data, self.data_manager.target_data, target_col):
+            if predictions is None:
+                pipeline.test_result = None
+            else:
+                pipeline.test_result = PipelineExecutionResult(predictions, metric_values, None)
+            if test_event_handler is not None:
+                yield test_event_handler.ExecutedPipeline(pipeline)
 
     '''
     Predict results on test data given a pipeline
     '''
     def test(self, pipeline, test_event_handler = None):
-        helper = ExecutionHelper(self.problem, self.data_manager)
-        testdf = pd.DataFrame(copy.copy(self.data_manager.input_data))
-        target_col = self.data_manager.target_columns[0]['colName']
-        sys.stdout.flush()
-        print("** Evaluating pipeline %s" % str(pipeline))
-        sys.stdout.flush()
-
-        metric_dict = defaultdict(int)
-        for i in self.problem.metrics:
-            metric_dict[i.name]= 0.0
-        results = []
-        pipelines = []
-
-        if pipeline.ensemble is not None:
-            try:
-                for ens_pipeline in pipeline.ensemble.pipelines:
-                    pipelines.append(ens_pipeline)
-            except:
-                pipelines.append(pipeline)
-        else:
-            pipelines.append(pipeline)
-        for pipeline_ in pipelines:
-            for primitive in pipeline_.primitives:
-                # Initialize primitive
-                try:
-                    print("Executing %s" % primitive)
-                    sys.stdout.flush()
-                    if primitive.task == "Modeling":
-                        if primitive.unified_interface:
-                            result = pd.DataFrame(primitive.executables.produce(inputs=testdf).value, index=testdf.index, columns=[target_col])
-                        else:
-                            result = pd.DataFrame(primitive.executables.predict(testdf), index=testdf.index, columns=[target_col])
-                        for ind in range(len(self.problem.metrics)):
-                            metric = self.problem.metrics[ind]
-                            metric_fn = self.problem.metric_functions[ind]
-                            metric_val = self.execution_helper._call_function(metric_fn, self.data_manager.target_data, result)
-                            metric_dict[metric.name] = metric_dict[metric.name]+ metric_val
-                        results.append(result)
-                        #pipeline.test_result = PipelineExecutionResult(result, metric_dict)
-                        break
-                    elif primitive.task == "PreProcessing":
-                        testdf = helper.test_execute_primitive(primitive, testdf)
-                    elif primitive.task == "FeatureExtraction":
-                        testdf = helper.test_featurise(primitive, testdf)
-                    if testdf is None:
-                        break
-                except Exception as e:
-                    sys.stderr.write(
-                        "ERROR test(%s) : %s\n" % (pipeline_, e))
-                    traceback.print_exc()
-        print('aggregating results')
-        for k, v in metric_dict.items():
-            metric_dict[k] = v/len(pipelines)
-        #try:
-        #    method = pipeline.ensemble.method
-        #except:
-        #    method = 'mean'
-        method = 'mean'
-        if method == 'mean':
-            res = numpy.mean(numpy.array(results), axis = 0)
-        elif method == 'median':
-            res  = numpy.median(numpy.array(results), axis = 0)
-
-        pipeline.test_result = PipelineExecutionResult(pd.DataFrame(res), metric_dict, None)
-
-        if test_event_handler is not None:
-            yield test_event_handler.ExecutedPipeline(pipeline)
-
+        for result in self.test_pipelines([pipeline], test_event_handler):
+            yield result
 
     def stop(self):
         '''
         Stop planning, and write out the current list (sorted by metric)
         '''
 
+    def shutdown(self):
+        '''Cancels the waiting worker pool tasks of the controller (such as
+        when its session ends). The pool is shared with other sessions'''
+        if self.resource_manager is not None:
+            self.resource_manager.shutdown(wait=False, cancel_futures=True)
+
     def create_pipeline_logfile(self, pipeline, rank):
         logfilename = "%s%s%s.json" % (self.log_dir, os.sep, pipeline.id)
         logdata = {
@@ -8,8 +8,6 @@ import json
 import numpy as np
 import shutil
 import traceback
-import inspect
-import importlib
 import pandas as pd
 import time
 
@@ -20,6 +18,7 @@ from dsbox.planner.common.resource_manager import ResourceManager
 from dsbox.planner.common.problem_manager import Metric, TaskType, TaskSubType
 from sklearn.model_selection import KFold
 from dsbox.planner.common.pipeline import CrossValidationStat
+from dsbox.planner.common.scoring import ScoringEngine
 
 MIN_METRICS = [Metric.MEAN_SQUARED_ERROR, Metric.ROOT_MEAN_SQUARED_ERROR, Metric.ROOT_MEAN_SQUARED_ERROR_AVG, Metric.MEAN_ABSOLUTE_ERROR, Metric.EXECUTION_TIME]
 DISCRETE_METRIC = [TaskSubType.BINARY, TaskSubType.MULTICLASS, TaskSubType.MULTILABEL, TaskSubType.OVERLAPPING, TaskSubType.NONOVERLAPPING]
@@ -35,6 +34,7 @@ class Ensemble(object):
         self.all_pipelines = []
         #self.test_pipeline_ids = []
         self.problem = problem
+        self.scoring = ScoringEngine(problem)
         self.median = median
         self._analyze_metrics()
         self.prediction_range = [-np.inf, np.inf]
@@ -65,6 +65,9 @@ class Ensemble(object):
 
         max_pipelines = self.max_pipelines if max_pipelines is None else max_pipelines
         found_improvement = True
+
+        kf = KFold(n_splits = cv, shuffle = True, random_state = seed)
+        folds = ScoringEngine.fold_masks(len(y), [test for (train, test) in kf.split(X, y)], include_all = False)
         
         while found_improvement and len(np.unique([pl.id for pl in self.all_pipelines])) < max_pipelines:
             best_score =  float('inf') if self.minimize_metric else 0
@@ -85,30 +88,30 @@ class Ensemble(object):
                 found_improvement = True
                 print('Best single pipeline score ',  str(best_score))
             else:
+                candidate_preds = []
                 for pipeline in pipelines:
-                    metric_val = CrossValidationStat()
-                    metric_values = {}
-
                     if median:
                         y_temp = self._add_median_prediction(self.all_pipelines, getattr(pipeline, which_result))
                     else:
                         y_temp = self._add_mean_prediction(self.predictions, getattr(pipeline, which_result))
-
-                    y_rounded = np.rint(y_temp) if self.discrete_metric else y_temp
-
-                    kf = KFold(n_splits = cv, shuffle = True, random_state = seed)
-                    for i in range(0, len(self.problem.metrics)):
-                        metric = self.problem.metrics[i]
-                        fn = self.problem.metric_functions[i]
-                        for k, (train, test) in enumerate(kf.split(X, y)):
-                            yfold = y.take(test, axis = 0).values.ravel()
-                            yround_fold = np.take(y_rounded, test, axis =0).ravel()
-                            fold_score = self._call_function(fn, yfold, yround_fold)
-                            metric_val.add_fold_metric(metric, fold_score)
-                            #metric_val = self._call_function(fn, y, y_rounded)
-                        if fold_score is None:
-                            return None
-                        metric_values[metric.name] = metric_val.get_metric(metric) #metric_val
+                    candidate_preds.append(y_temp)
+
+                # Score every candidate on every fold in one pass
+                y_rounded = np.column_stack([np.asarray(y_temp).ravel() for y_temp in candidate_preds])
+                y_rounded = np.rint(y_rounded) if self.discrete_metric else y_rounded
+                scores = self.scoring.score(y.values.ravel(), y_rounded, folds)
+
+                for j, pipeline in enumerate(pipelines):
+                    y_temp = candidate_preds[j]
+                    if any(np.any(np.isnan(scores[metric.name][:, j])) for metric in self.problem.metrics):
+                        # A metric failed on this candidate, try the others
+                        continue
+                    metric_val = CrossValidationStat()
+                    metric_values = {}
+                    for metric in self.problem.metrics:
+                        for fold_score in scores[metric.name][:, j]:
+                            metric_val.add_fold_metric(metric, float(fold_score))
+                        metric_values[metric.name] = metric_val.get_metric(metric)
 
                     score_improve = [v - best_metrics[k] for k, v in metric_values.items()]
                     score_improve = [score_improve[l] * (-1 if self.minimize_metric[l] else 1) for l in range(len(score_improve))]
@@ -180,9 +183,7 @@ class Ensemble(object):
         return y_temp
 
     def _call_function(self, scoring_function, *args):
-        mod = inspect.getmodule(scoring_function)
         try:
-            module = importlib.import_module(mod.__name__)
             return scoring_function(*args)
         except Exception as e:
             sys.stderr.write("ERROR _call_function %s: %s\n" % (scoring_function, e))
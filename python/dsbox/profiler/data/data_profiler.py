@@ -2,13 +2,24 @@ import pandas as pd
 import numpy as np
 
 # This is a pared-down version of the main Data profiling entry point
-# for faster processing
+# for faster processing. Columns of the same dtype are profiled together
+# with vectorized pandas operations, and string columns are profiled
+# through their distinct values.
 
-# from feature computation functions
-import dsbox.datapreprocessing.profiler.feature_compute_lfh as fc_lfh
-import dsbox.datapreprocessing.profiler.feature_compute_hih as fc_hih
 from collections import defaultdict
 
+# Normal quantiles of the (two sided) confidence levels of the sampling bounds
+Z_SCORES = {0.9: 1.645, 0.95: 1.96, 0.99: 2.576}
+
+# Columns of a numeric group profiled at once (bounds the temporary arrays)
+BLOCK_COLUMNS = 64
+
+# Strings that int() reads (other numeric strings are decimals)
+INTEGER_PATTERN = r'^\s*[+-]?\d+(?:_\d+)*\s*$'
+
+# Values further than this many standard deviations from the mean are outliers
+OUTLIER_STDS = 3
+
 # To allow pickling
 def default_dict():
     return defaultdict()
@@ -16,94 +27,260 @@ def default_dict():
 class DataProfiler(object):
     """
     Converted the main function of the data profiler into a class
+
+    With sample_rows, string columns (the expensive part of profiling)
+    are profiled on a random sample of at most sample_rows rows. Their
+    results then have a "sampling" entry with confidence bounds of the
+    sampled proportions (numeric, negative, list) and of the average
+    length (text), and their counts are estimates scaled to all the rows.
+    Missing values and the statistics of numeric dtype columns are always
+    computed on all the rows.
     """
-    def __init__(self, data):
+    def __init__(self, data, sample_rows=None, confidence=0.95, random_state=0):
+        self.sample_rows = sample_rows
+        self.confidence = confidence
+        self.random_state = random_state
         self.result = self.profile_data(data)
 
-    def profile_data(self, data, punctuation_outlier_weight=3,
-            numerical_outlier_weight=3, token_delimiter=" ", detect_language=False, topk=10):
+    def profile_data(self, data, token_delimiter=" "):
         """
         Main function to profile the data.
         Parameters
         ----------
-        data_path: file or pandas DataFrame that needs to be profiled
+        data: pandas DataFrame that needs to be profiled
         ----------
         """
-        isDF = True
+        # dict: map feature name to content, per column position
+        results = [defaultdict(default_dict) for _ in range(data.shape[1])]
+        groups = defaultdict(list)
+        for position, dtype in enumerate(data.dtypes):
+            if dtype.name == 'category':
+                groups['O'].append(position)
+            elif dtype.kind in 'iu':
+                groups['i'].append(position)
+            else:
+                groups[dtype.kind].append(position)
 
-        result = {} # final result: dict of dict
-        for column_name in data:
-            col = data[column_name]
-
-            # Get a sample value of the column
-            samplevalue = None
-
-            validindices = col.index.get_indexer(col.index[~col.isnull()])
-            if len(validindices > 0):
-                samplevalue = col.iloc[validindices[0]]
-
-            # dict: map feature name to content
-            # each_res = defaultdict(lambda: defaultdict())
-            each_res = defaultdict(default_dict)
-
-            if col.dtype.kind in np.typecodes['AllInteger']+'uMmf':
-                each_res["missing"]["num_missing"] = pd.isnull(col).sum()
-                each_res["missing"]["num_nonblank"] = col.count()
-                each_res["special_type"]["dtype"] = str(col.dtype)
-                ndistinct = col.nunique()
-                each_res["distinct"]["num_distinct_values"] = ndistinct
-                if col.size == 0:
-                    each_res["distinct"]["ratio_distinct_values"] = 1.0
-                else:
-                    each_res["distinct"]["ratio_distinct_values"] = ndistinct/ float(col.size)
-
-            if col.dtype.kind == 'b':
-                each_res["special_type"]["data_type"] = 'bool'
-                #fc_hih.compute_common_values(col.dropna().astype(str), each_res, topk)
-
-            elif col.dtype.kind in np.typecodes['AllInteger']+'u':
-                each_res["special_type"]["data_type"] = 'integer'
-                fc_hih.compute_numerics(col, each_res)
-                #fc_hih.compute_common_values(col.dropna().astype(str), each_res,topk)
-
-            elif col.dtype.kind == 'f':
-                each_res["special_type"]["data_type"] = "float"
-                fc_hih.compute_numerics(col, each_res)
-                #fc_hih.compute_common_values(col.dropna().astype(str), each_res,topk)
-
-            elif col.dtype.kind == 'M':
-                each_res["special_type"]["data_type"] = "datetime"
-
-            elif col.dtype.kind == 'm':
-                each_res["special_type"]["data_type"] = "timedelta"
-
-            elif col.dtype.kind == 'O' and isinstance(samplevalue, (np.ndarray, list, tuple)):
-                each_res["special_type"]["data_type"] = "list"
+        for kind in ('i', 'f', 'M', 'm', 'b'):
+            for start in range(0, len(groups[kind]), BLOCK_COLUMNS):
+                positions = groups[kind][start:start + BLOCK_COLUMNS]
+                self._profile_numeric(data.iloc[:, positions], kind, [results[i] for i in positions])
 
-            else:
-                if isDF:
-                    if col.dtype.name == 'category':
-                        each_res["special_type"]["data_type"] = 'category'
-                    col = col.astype(object).fillna('').astype(str)
-
-                # compute_missing_space Must be put as the first one because it may change the data content, see function def for details
-                #fc_lfh.compute_missing_space(col, each_res)
-                #fc_lfh.compute_filename(col, each_res)
-                fc_lfh.compute_length_distinct(col, each_res, delimiter=token_delimiter)
-                #if detect_language: fc_lfh.compute_lang(col, each_res)
-                #fc_lfh.compute_punctuation(col, each_res, weight_outlier=punctuation_outlier_weight)
-
-                fc_hih.compute_numerics(col, each_res)
-                #fc_hih.compute_common_numeric_tokens(col, each_res,topk)
-                #fc_hih.compute_common_alphanumeric_tokens(col, each_res, topk)
-                #fc_hih.compute_common_values(col, each_res, topk)
-                #fc_hih.compute_common_tokens(col, each_res, topk)
-                #fc_hih.compute_numeric_density(col, each_res)
-                #fc_hih.compute_contain_numeric_values(col, each_res)
-                #fc_hih.compute_common_tokens_by_puncs(col, each_res, topk)
+        # Other columns (objects, strings and categories)
+        others = [position for kind, positions in groups.items() if kind not in 'ifMmb' for position in positions]
+        if others:
+            rows = None
+            if self.sample_rows and data.shape[0] > self.sample_rows:
+                rows = np.sort(np.random.RandomState(self.random_state).choice(
+                    data.shape[0], self.sample_rows, replace=False))
+            for position in sorted(others):
+                col = data.iloc[:, position]
+                if rows is not None:
+                    col = col.iloc[rows]
+                self._profile_strings(col, results[position], data.shape[0], token_delimiter)
 
+        result = {} # final result: dict of dict
+        for column_name, each_res in zip(data.columns, results):
             if not each_res["numeric_stats"]: del each_res["numeric_stats"]
-
             result[column_name] = each_res # add this column features into final result
-
         return result
+
+    def _profile_numeric(self, block, kind, results):
+        '''Profiles the columns of one numeric (or date, or bool) dtype at once'''
+        num_missing = block.isnull().sum().values
+        num_nonblank = block.count().values
+        ndistinct = block.nunique().values
+        size = block.shape[0]
+        data_type = {'i': 'integer', 'f': 'float', 'M': 'datetime', 'm': 'timedelta', 'b': 'bool'}[kind]
+        for i, each_res in enumerate(results):
+            each_res["missing"]["num_missing"] = num_missing[i]
+            each_res["missing"]["num_nonblank"] = num_nonblank[i]
+            each_res["special_type"]["dtype"] = str(block.dtypes.iloc[i])
+            each_res["special_type"]["data_type"] = data_type
+            each_res["distinct"]["num_distinct_values"] = ndistinct[i]
+            each_res["distinct"]["ratio_distinct_values"] = ndistinct[i] / float(size) if size > 0 else 1.0
+
+        if kind not in 'if':
+            return
+        # Missing values are skipped
+        values = block.values.astype(np.float64)
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=0)
+        stats_type = 'integer' if kind == 'i' else 'decimal'
+        present = np.flatnonzero(counts > 0)
+        if len(present) == 0:
+            return
+        values = values[:, present]
+        valid = valid[:, present]
+        counts = counts[present]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(valid, values, 0.0).sum(axis=0) / counts
+            stds = np.sqrt(np.where(valid, (values - means) ** 2, 0.0).sum(axis=0) / (counts - 1))
+            quartiles = np.nanpercentile(values, [25, 50, 75], axis=0)
+            num_outlier = (np.abs(values - means) > OUTLIER_STDS * stds).sum(axis=0)
+            signs = [(values > 0).sum(axis=0), (values < 0).sum(axis=0), (values == 0).sum(axis=0),
+                     (values == 1).sum(axis=0), (values == -1).sum(axis=0)]
+        for j, i in enumerate(present):
+            results[i]["numeric_stats"][stats_type] = _numerical_stats(
+                counts[j], means[j], stds[j], quartiles[:, j], num_nonblank[i], num_outlier[j],
+                [sign[j] for sign in signs])
+
+    def _profile_strings(self, col, each_res, total_rows, token_delimiter):
+        '''Profiles an object (or category) column through its distinct
+        values. Missing values are profiled as empty strings, so the column
+        has no missing values and all its rows are nonblank.'''
+        notnull = col.notnull().values
+        samplevalue = col.iloc[notnull.argmax()] if notnull.any() else None
+        sampled = len(col) < total_rows
+
+        if isinstance(samplevalue, (np.ndarray, list, tuple)):
+            each_res["special_type"]["data_type"] = "list"
+            if sampled:
+                nlists = col[notnull].map(lambda value: isinstance(value, (np.ndarray, list, tuple))).sum()
+                self._add_bounds(each_res, col, total_rows, {"list": self._proportion(nlists, notnull.sum())})
+            return
+
+        each_res["missing"]["num_missing"] = 0
+        each_res["missing"]["num_nonblank"] = total_rows
+        if col.dtype.name == 'category':
+            each_res["special_type"]["data_type"] = 'category'
+            codes = col.cat.codes.values
+            uniques = np.asarray(col.cat.categories, dtype=object)
+        else:
+            codes, uniques = pd.factorize(col)
+            uniques = np.asarray(uniques, dtype=object)
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques)).astype(np.float64)
+        strings = pd.Series(uniques).astype(str)
+        num_missing = len(col) - counts.sum()
+        if num_missing > 0:
+            strings = pd.concat([strings, pd.Series([''])], ignore_index=True)
+            counts = np.append(counts, num_missing)
+        # Distinct values as strings (different values may have the same string)
+        strings_counts = pd.Series(counts).groupby(strings.values).sum()
+        strings = pd.Series(strings_counts.index, dtype=object)
+        sample_counts = strings_counts.values.astype(np.float64)
+        # Counts of a sample are scaled to estimates over all the rows
+        counts = sample_counts * (total_rows / float(len(col))) if sampled else sample_counts
+        nrows = counts.sum()
+        if len(col) == 0:
+            return
+
+        lengths = strings.str.len().values.astype(np.float64)
+        character = _weighted_stats(lengths, counts)
+        # Length of each token (tokens of all the rows)
+        tokens = strings.str.split(token_delimiter).explode()
+        token_counts = counts[tokens.index.values]
+        token = _weighted_stats(tokens.str.len().values.astype(np.float64), token_counts)
+        each_res["length"]["character"] = {"average": character["mean"], "standard-deviation": character["std"]}
+        each_res["length"]["token"] = {"average": token["mean"], "standard-deviation": token["std"]}
+        each_res["distinct"]["num_distinct_values"] = len(strings)
+        each_res["distinct"]["ratio_distinct_values"] = len(strings) / float(nrows)
+        num_tokens = tokens.nunique()
+        each_res["distinct"]["num_distinct_tokens"] = num_tokens
+        each_res["distinct"]["ratio_distinct_tokens"] = num_tokens / float(token_counts.sum())
+
+        (is_integer, is_decimal, values) = _parse_numbers(strings)
+        for (stats_type, mask) in (("integer", is_integer), ("decimal", is_decimal)):
+            if mask.any():
+                each_res["numeric_stats"][stats_type] = _weighted_numerical_stats(
+                    values[mask], counts[mask], total_rows)
+        numeric = is_integer | is_decimal
+        if numeric.any():
+            each_res["numeric_stats"]["numeric"] = _weighted_numerical_stats(
+                values[numeric], counts[numeric], total_rows)
+
+        if sampled:
+            z = Z_SCORES.get(self.confidence, 1.96)
+            nsample = sample_counts.sum()
+            half = z * character["std"] / np.sqrt(nsample) if nsample > 0 else np.inf
+            num_numeric = sample_counts[numeric].sum()
+            self._add_bounds(each_res, col, total_rows, {
+                "numeric": self._proportion(num_numeric, nsample),
+                "negative": self._proportion(sample_counts[numeric & (values < 0)].sum(), num_numeric),
+                "text": (character["mean"] - half, character["mean"] + half)})
+
+    def _proportion(self, successes, trials):
+        '''Wilson score interval of a proportion'''
+        if trials == 0:
+            return (0.0, 1.0)
+        z = Z_SCORES.get(self.confidence, 1.96)
+        p = successes / float(trials)
+        denominator = 1.0 + z * z / trials
+        center = (p + z * z / (2.0 * trials)) / denominator
+        half = z * np.sqrt(p * (1.0 - p) / trials + z * z / (4.0 * trials * trials)) / denominator
+        return (max(0.0, center - half), min(1.0, center + half))
+
+    def _add_bounds(self, each_res, col, total_rows, bounds):
+        each_res["sampling"] = {"rows": len(col), "total_rows": total_rows,
+                                "confidence": self.confidence, "bounds": bounds}
+
+
+def _parse_numbers(strings):
+    '''Which strings are integers and which are decimals (as int() and float()
+    read them), and their values. Strings of not a number are neither.'''
+    is_integer = strings.str.match(INTEGER_PATTERN).values
+    values = pd.to_numeric(strings.where(~is_integer), errors='coerce').values.astype(np.float64)
+    # Strings pandas does not read, but float() may (such as '1_000' or ' 1.5 ')
+    retry = np.flatnonzero(np.isnan(values) & ~is_integer & strings.str.contains(r'\d|inf', case=False).values)
+    for (positions, convert) in ((np.flatnonzero(is_integer), _to_int), (retry, _to_float)):
+        values[positions] = [convert(value) for value in strings.values[positions]]
+    return is_integer, ~is_integer & ~np.isnan(values), values
+
+
+def _to_int(value):
+    return float(int(value))
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _numerical_stats(count, mean, std, quartiles, num_nonblank, num_outlier, signs):
+    '''Statistics of the numbers of a column. std is the sample standard
+    deviation, signs the counts of positive, negative, 0, 1 and -1 values'''
+    return {"mean": mean,
+            # One value has no deviation
+            "standard-deviation": std if count > 1 else 0,
+            "Q1": quartiles[0], "Q2": quartiles[1], "Q3": quartiles[2],
+            "count": int(count),
+            "ratio": count / float(num_nonblank),
+            "num_outlier": int(num_outlier),
+            "num_positive": int(signs[0]), "num_negative": int(signs[1]),
+            "num_0": int(signs[2]), "num_1": int(signs[3]), "num_-1": int(signs[4])}
+
+
+def _weighted_numerical_stats(values, weights, num_nonblank):
+    '''_numerical_stats of values that occur weights times'''
+    stats = _weighted_stats(values, weights)
+    num_outlier = weights[np.abs(values - stats["mean"]) > OUTLIER_STDS * stats["std"]].sum()
+    signs = [weights[mask].sum() for mask in (values > 0, values < 0, values == 0, values == 1, values == -1)]
+    return _numerical_stats(int(round(stats["count"])), stats["mean"], stats["std"],
+                            _weighted_quantiles(values, weights, (0.25, 0.5, 0.75)),
+                            num_nonblank, round(num_outlier), [round(sign) for sign in signs])
+
+
+def _weighted_stats(values, weights):
+    '''count, mean, sample std, min and max of values that occur weights times'''
+    count = weights.sum()
+    if count == 0:
+        return {"count": 0, "mean": np.nan, "std": np.nan, "min": np.nan, "max": np.nan}
+    mean = (values * weights).sum() / count
+    std = np.sqrt((((values - mean) ** 2) * weights).sum() / (count - 1)) if count > 1 else np.nan
+    return {"count": count, "mean": mean, "std": std, "min": values.min(), "max": values.max()}
+
+
+def _weighted_quantiles(values, weights, quantiles):
+    '''Quantiles (with linear interpolation, as pandas) of values that occur weights times'''
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    ends = np.cumsum(weights[order])
+    result = []
+    for quantile in quantiles:
+        position = quantile * (ends[-1] - 1)
+        lower = values[min(np.searchsorted(ends, np.floor(position), side='right'), len(values) - 1)]
+        upper = values[min(np.searchsorted(ends, np.ceil(position), side='right'), len(values) - 1)]
+        result.append(lower + (position - np.floor(position)) * (upper - lower))
+    return result
@@ -0,0 +1,107 @@
+'''Regression tests of the data profiler: the column flags and result keys
+must stay those of the original (row by row) profiler. Run with pytest.'''
+
+import numpy as np
+import pandas as pd
+
+from dsbox.profiler.data.data_profiler import DataProfiler
+from dsbox.schema.data_profile import DataProfile
+from dsbox.schema.profile_schema import DataProfileType as dpt
+
+FRAME = pd.DataFrame({
+    'int_strings': ['1', '2', '-3', '4'],
+    'decimal_strings': ['1.5', '-2.25', '3e2', ' 4 '],
+    'mixed_strings': ['1', '2.5', 'x', '4'],
+    'strings_with_missing': ['1', '2', None, '4'],
+    'text': ['a fairly long sentence of text here', 'another long sentence of some text', None, 'short'],
+    'ints': [1, -2, 3, 4],
+    'floats': [1.0, np.nan, -2.5, 100.0],
+    'bools': [True, False, True, False],
+    'categories': pd.Categorical(['a', 'b', 'a', None]),
+    'lists': [[1, 2], [3], None, [4]],
+    'dates': pd.to_datetime(['2020-01-01', None, '2021-01-01', '2022-01-01']),
+})
+
+# Flags set by the original profiler on FRAME
+BASELINE_FLAGS = {
+    'int_strings': [dpt.NUMERICAL],
+    'decimal_strings': [],
+    'mixed_strings': [],
+    'strings_with_missing': [],
+    'text': [],
+    'ints': [dpt.NUMERICAL],
+    'floats': [dpt.NUMERICAL, dpt.MISSING_VALUES],
+    'bools': [],
+    'categories': [],
+    'lists': [dpt.LIST],
+    'dates': [dpt.MISSING_VALUES],
+}
+
+STATS_KEYS = ['mean', 'standard-deviation', 'Q1', 'Q2', 'Q3', 'count', 'ratio', 'num_outlier',
+              'num_positive', 'num_negative', 'num_0', 'num_1', 'num_-1']
+
+
+def flags(profile, column):
+    return [flag for flag, value in profile.getColumnProfile(column).items() if value]
+
+
+def test_flags_match_baseline():
+    DataProfile.clear_cache()
+    profile = DataProfile(FRAME)
+    for column, expected in BASELINE_FLAGS.items():
+        assert flags(profile, column) == expected, column
+
+
+def test_numeric_strings():
+    DataProfile.clear_cache()
+    profile = DataProfile(pd.DataFrame({'a': ['1', '2', '-3']}))
+    assert profile.getColumnProfile('a')[dpt.NUMERICAL]
+    # The original profiler never set NEGATIVE
+    assert not profile.getColumnProfile('a')[dpt.NEGATIVE]
+
+
+def test_result_keys_match_baseline():
+    result = DataProfiler(FRAME).result
+    assert dict(result['strings_with_missing']['missing']) == {'num_missing': 0, 'num_nonblank': 4}
+    for column, stats_types in (('floats', ['decimal']), ('ints', ['integer']),
+                                ('int_strings', ['integer', 'numeric'])):
+        numeric_stats = result[column]['numeric_stats']
+        assert sorted(numeric_stats.keys()) == sorted(stats_types), column
+        for stats_type in stats_types:
+            assert list(numeric_stats[stats_type].keys()) == STATS_KEYS, column
+
+    stats = result['floats']['numeric_stats']['decimal']
+    assert np.isclose(stats['mean'], 32.833333333333336)
+    assert np.isclose(stats['standard-deviation'], 58.19435826034456)
+    assert [stats['Q1'], stats['Q2'], stats['Q3']] == [-0.75, 1.0, 50.5]
+    assert (stats['count'], stats['num_positive'], stats['num_negative'], stats['num_1']) == (3, 2, 1, 1)
+
+    # Characters per cell and per token (sample standard deviations)
+    length = result['text']['length']
+    assert np.isclose(length['character']['average'], 18.5)
+    assert np.isclose(length['character']['standard-deviation'], 18.59211302317912)
+    assert np.isclose(length['token']['average'], 4.2)
+    assert np.isclose(length['token']['standard-deviation'], 2.366431913239847)
+    assert result['text']['distinct']['num_distinct_tokens'] == 11
+
+
+def test_sampled_numeric_strings():
+    DataProfile.clear_cache()
+    frame = pd.DataFrame({'a': [str(value) for value in range(-500, 1500)]})
+    profile = DataProfile(frame, sample_rows=100)
+    assert profile.getColumnProfile('a')[dpt.NUMERICAL]
+    result = profile.profiler_data.result['a']
+    assert result['missing']['num_nonblank'] == len(frame)
+    assert result['sampling']['rows'] == 100
+
+
+def test_cached_profile_needs_same_strings():
+    DataProfile.clear_cache()
+    short = pd.DataFrame({'text': ['a'] * 5000, 'value': np.arange(5000)})
+    long = short.copy()
+    # Only one cell differs, which a sample of rows would likely miss
+    long.loc[2501, 'text'] = 'b' * 200000
+    assert not DataProfile(short).getColumnProfile('text')[dpt.TEXT]
+    profile = DataProfile(long)
+    assert profile.getColumnProfile('text')[dpt.TEXT]
+    assert profile.profiler_data.result['text']['length']['character']['average'] > 40
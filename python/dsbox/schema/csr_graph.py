@@ -0,0 +1,190 @@
+'''Compact array representation of graphs'''
+
+import os
+import json
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+class CSRGraph(object):
+    """
+    A graph as compressed sparse row (CSR) adjacency arrays.
+
+    Nodes are numbered 0..n-1, in the order of node_ids. The neighbors of
+    node i are indices[indptr[i]:indptr[i + 1]], and edges[...] holds the
+    edge number of each of those entries. Edge e goes from source[e] to
+    target[e]. Undirected edges are listed under both of their nodes.
+    Node and edge attributes are columns (one array per attribute name).
+    """
+
+    def __init__(self, node_ids, source, target, directed=False,
+                 node_attributes=None, edge_attributes=None):
+        self.node_ids = node_ids
+        self.source = np.asarray(source, dtype=np.int64)
+        self.target = np.asarray(target, dtype=np.int64)
+        self.directed = directed
+        self.node_attributes = node_attributes if node_attributes is not None else {}
+        self.edge_attributes = edge_attributes if edge_attributes is not None else {}
+        self._build_adjacency()
+        self._node_index = None
+
+    def _build_adjacency(self):
+        edges = np.arange(len(self.source), dtype=np.int64)
+        rows, cols = self.source, self.target
+        if not self.directed:
+            edges = np.concatenate([edges, edges])
+            rows, cols = np.concatenate([self.source, self.target]), np.concatenate([self.target, self.source])
+        order = np.argsort(rows, kind='stable')
+        self.indices = cols[order]
+        self.edges = edges[order]
+        self.indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.node_ids)), out=self.indptr[1:])
+
+    @staticmethod
+    def from_networkx(graph):
+        '''Converts a networkx graph'''
+        node_ids = np.empty(graph.number_of_nodes(), dtype=object)
+        node_ids[:] = list(graph.nodes())
+        position = dict((node, i) for i, node in enumerate(node_ids))
+        node_attributes = _attribute_columns([data for _, data in graph.nodes(data=True)])
+        edge_list = list(graph.edges(data=True))
+        source = np.array([position[u] for u, _, _ in edge_list], dtype=np.int64)
+        target = np.array([position[v] for _, v, _ in edge_list], dtype=np.int64)
+        edge_attributes = _attribute_columns([data for _, _, data in edge_list])
+        return CSRGraph(_compact(node_ids), source, target, graph.is_directed(),
+                        node_attributes, edge_attributes)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def num_edges(self):
+        return len(self.source)
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbors(self, node):
+        '''Neighbors of the node (by position)'''
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def node_index(self, keys, attribute=None):
+        '''Positions of the nodes with the given ids (or values of the
+        attribute), -1 for unknown keys'''
+        if attribute is None:
+            if self._node_index is None:
+                self._node_index = pd.Index(self.node_ids)
+            index = self._node_index
+        else:
+            index = pd.Index(self.node_attributes[attribute])
+        return _lookup(index, keys)
+
+    def edge_index(self, keys, attribute=None):
+        '''Positions of the edges with the given values of the attribute
+        (the edge number if None), -1 for unknown keys'''
+        if attribute is None:
+            keys = pd.to_numeric(pd.Series(np.asarray(keys)), errors='coerce').values
+            valid = ~np.isnan(keys) & (keys >= 0) & (keys < self.num_edges())
+            return np.where(valid, np.nan_to_num(keys), -1).astype(np.int64)
+        return _lookup(pd.Index(self.edge_attributes[attribute]), keys)
+
+    def save(self, filename):
+        '''Writes the arrays to filename.<name>.npy files. The manifest
+        (filename.json) is written last, so a graph is complete if it exists.'''
+        arrays = {'node_ids': self.node_ids, 'source': self.source, 'target': self.target,
+                  'indptr': self.indptr, 'indices': self.indices, 'edges': self.edges}
+        for name, values in self.node_attributes.items():
+            arrays['node.%d' % len(arrays)] = values
+        for name, values in self.edge_attributes.items():
+            arrays['edge.%d' % len(arrays)] = values
+        manifest = {'directed': self.directed, 'arrays': list(arrays.keys()),
+                    'node_attributes': list(self.node_attributes.keys()),
+                    'edge_attributes': list(self.edge_attributes.keys())}
+        for name, values in arrays.items():
+            _save_array("%s.%s.npy" % (filename, name), values)
+        _save_json("%s.json" % filename, manifest)
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists("%s.json" % filename)
+
+    @staticmethod
+    def load(filename):
+        '''Loads a saved graph. Numeric arrays are memory mapped'''
+        with open("%s.json" % filename, 'r') as f:
+            manifest = json.load(f)
+        arrays = dict((name, _load_array("%s.%s.npy" % (filename, name))) for name in manifest['arrays'])
+        graph = CSRGraph.__new__(CSRGraph)
+        graph.node_ids = arrays['node_ids']
+        graph.source = arrays['source']
+        graph.target = arrays['target']
+        graph.indptr = arrays['indptr']
+        graph.indices = arrays['indices']
+        graph.edges = arrays['edges']
+        graph.directed = manifest['directed']
+        names = [name for name in manifest['arrays'] if name.startswith('node.')]
+        graph.node_attributes = dict((attr, arrays[name]) for attr, name in zip(manifest['node_attributes'], names))
+        names = [name for name in manifest['arrays'] if name.startswith('edge.')]
+        graph.edge_attributes = dict((attr, arrays[name]) for attr, name in zip(manifest['edge_attributes'], names))
+        graph._node_index = None
+        return graph
+
+
+def _attribute_columns(records):
+    '''Columns of a list of attribute dicts. Missing values are None (NaN for numbers)'''
+    names = []
+    for record in records:
+        for name in record.keys():
+            if name not in names:
+                names.append(name)
+    columns = {}
+    for name in names:
+        values = np.empty(len(records), dtype=object)
+        values[:] = [record.get(name, None) for record in records]
+        columns[name] = _compact(values)
+    return columns
+
+
+def _compact(values):
+    '''Numeric array for numeric values (with NaN for missing ones), else the object array'''
+    if len(values) > 0 and all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+                               for value in values if value is not None):
+        if not any(value is None for value in values) and all(isinstance(value, (int, np.integer)) for value in values):
+            return values.astype(np.int64)
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return values
+
+
+def _lookup(index, keys):
+    keys = np.asarray(keys)
+    positions = index.get_indexer(keys)
+    if (positions < 0).any() and index.dtype != object:
+        # Keys read as other types (such as strings of numbers)
+        numeric = pd.to_numeric(pd.Series(keys), errors='coerce').values
+        positions = np.where(positions < 0, index.get_indexer(numeric), positions)
+    elif (positions < 0).any():
+        positions = np.where(positions < 0, index.astype(str).get_indexer(keys.astype(str)), positions)
+    return positions.astype(np.int64)
+
+
+def _save_array(path, values):
+    # Write to a temporary file first, other processes may be reading it
+    tmppath = "%s.%s.tmp.npy" % (path, uuid.uuid4().hex)
+    np.save(tmppath, values, allow_pickle=(values.dtype == object))
+    os.replace(tmppath, path)
+
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # Object arrays (such as string ids) cannot be memory mapped
+        return np.load(path, allow_pickle=True)
+
+
+def _save_json(path, value):
+    tmppath = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    with open(tmppath, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmppath, path)
@@ -1,21 +1,134 @@
+import threading
+
+from collections import OrderedDict
+from hashlib import blake2b
+
+import pandas as pd
+
 from dsbox.profiler.data.data_profiler import DataProfiler
 from dsbox.schema.profile_schema import DataProfileType as dpt
 
+# Profiles of the most recently profiled data, by data fingerprint
+PROFILE_CACHE_SIZE = 256
+
 class DataProfile(object):
     """
     This class holds the profile for either the whole data, or a column
+
+    Profiles of whole dataframes are cached by a fingerprint of the data
+    (see fingerprint()), so profiling the same data again (such as the
+    same intermediate result in several pipelines) is a lookup.
     """
 
     MINCHARS_FOR_TEXT = 25
 
-    def __init__(self, dataframe):
-        self.profiler_data = DataProfiler(dataframe)
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, dataframe=None, sample_rows=None):
         self.profile = self.getDefaultProfile()
         self.columns = {}
+        # Column -> [rows, total characters], to combine TEXT over chunks
+        self.lengths = {}
+        # Profile string columns on a sample of rows (see DataProfiler)
+        self.sample_rows = sample_rows
+        if dataframe is not None:
+            key = fingerprint(dataframe, sample_rows)
+            if not self._copy_cached(key):
+                self.update(dataframe)
+                self._store_cached(key)
+
+    def _copy_cached(self, key):
+        '''Takes the profile of the cached data with the fingerprint, if any'''
+        if key is None:
+            return False
+        with DataProfile._cache_lock:
+            cached = DataProfile._cache.get(key, None)
+            if cached is None:
+                return False
+            DataProfile._cache.move_to_end(key)
+        self._copy_from(cached)
+        return True
+
+    def _store_cached(self, key):
+        if key is None:
+            return
+        cached = DataProfile(sample_rows=self.sample_rows)
+        cached._copy_from(self)
+        with DataProfile._cache_lock:
+            DataProfile._cache[key] = cached
+            DataProfile._cache.move_to_end(key)
+            while len(DataProfile._cache) > PROFILE_CACHE_SIZE:
+                DataProfile._cache.popitem(last=False)
+
+    def _copy_from(self, other):
+        self.profile = dict(other.profile)
+        self.columns = dict((column, dict(profile)) for column, profile in other.columns.items())
+        self.lengths = dict((column, list(lengths)) for column, lengths in other.lengths.items())
+        self.profiler_data = getattr(other, 'profiler_data', None)
+
+    @staticmethod
+    def clear_cache():
+        with DataProfile._cache_lock:
+            DataProfile._cache.clear()
+
+    def update(self, dataframe):
+        '''Adds the rows of the dataframe (such as the next chunk of a stream)
+        to the profile'''
+        self.profiler_data = DataProfiler(dataframe, sample_rows=self.sample_rows)
         for column_name, col_data in self.profiler_data.result.items():
             profile = self.parseColumnProfile(col_data)
+            if col_data.get('length', None) is not None:
+                # The average length is over all the rows (missing values are empty)
+                lengths = self.lengths.setdefault(column_name, [0, 0.0])
+                lengths[0] += len(dataframe)
+                lengths[1] += len(dataframe) * col_data['length']['character']['average']
+                if lengths[0] > 0:
+                    profile[dpt.TEXT] = bool(lengths[1] / lengths[0] > DataProfile.MINCHARS_FOR_TEXT)
+            previous = self.columns.get(column_name, None)
+            if previous is not None:
+                profile[dpt.NUMERICAL] = previous[dpt.NUMERICAL] and profile[dpt.NUMERICAL]
+                for key in (dpt.MISSING_VALUES, dpt.UNIQUE, dpt.NEGATIVE, dpt.LIST):
+                    profile[key] = previous[key] or profile[key]
+            self.columns[column_name] = profile
+
+        # Whole data profile from all the column profiles
+        self.profile = self.getDefaultProfile()
+        for column_name, profile in self.columns.items():
             self.addColumnProfile(column_name, profile)
 
+    @staticmethod
+    def derive(parent, parent_dataframe, dataframe, sample_rows=None):
+        '''Profile of dataframe, made from the profile of parent_dataframe
+        (such as the input of the step that produced dataframe). Only the
+        columns that are new or changed are profiled again.'''
+        profile = DataProfile(sample_rows=sample_rows)
+        key = fingerprint(dataframe, sample_rows)
+        if profile._copy_cached(key):
+            return profile
+        if (len(dataframe) != len(parent_dataframe)
+                or not dataframe.index.equals(parent_dataframe.index)):
+            # Rows were added, removed or reordered
+            profile.update(dataframe)
+            profile._store_cached(key)
+            return profile
+        changed = []
+        for position, column_name in enumerate(dataframe.columns):
+            if (column_name not in parent.columns or column_name not in parent_dataframe.columns
+                    or not dataframe.iloc[:, position].equals(parent_dataframe[column_name])):
+                changed.append(position)
+            else:
+                profile.columns[column_name] = dict(parent.columns[column_name])
+                if column_name in parent.lengths:
+                    profile.lengths[column_name] = list(parent.lengths[column_name])
+        if changed:
+            profile.update(dataframe.iloc[:, changed])
+        else:
+            for column_name, column_profile in profile.columns.items():
+                profile.addColumnProfile(column_name, column_profile)
+        profile._store_cached(key)
+        return profile
+
     def addColumnProfile(self, column, profile):
         self.columns[column] = profile
         #print "Column %s: %s" % (column, profile)
@@ -97,3 +210,19 @@ class DataProfile(object):
 
     def __repr__(self):
         return "%s" % self.profile
+
+
+def fingerprint(dataframe, sample_rows=None):
+    '''Fingerprint of the content of a dataframe: its shape, columns,
+    dtypes and index, and a hash of all its values (linear in the size of
+    the data, and much cheaper than profiling it). None if the data cannot
+    be hashed (such as columns of lists).'''
+    content = blake2b(digest_size=16)
+    try:
+        content.update(pd.util.hash_pandas_object(dataframe.index).values.tobytes())
+        if dataframe.shape[1] > 0:
+            content.update(pd.util.hash_pandas_object(dataframe, index=False).values.tobytes())
+    except TypeError:
+        return None
+    return (dataframe.shape, tuple(map(str, dataframe.columns)), tuple(map(str, dataframe.dtypes)),
+            content.hexdigest(), sample_rows)
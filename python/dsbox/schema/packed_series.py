@@ -0,0 +1,92 @@
+'''Packed storage of variable length series'''
+
+import os
+import uuid
+
+import numpy as np
+
+
+class PackedSeries(object):
+    """
+    A collection of variable length series of values, packed in one array.
+
+    Series i is values[offsets[i]:offsets[i + 1]]. A collection saved to
+    disk is memory mapped when loaded, and pickles as its file names, so
+    processes share the pages.
+    """
+
+    def __init__(self, values, offsets, filename=None):
+        self.values = values
+        self.offsets = offsets
+        # Saved collection, if memory mapped
+        self.filename = filename
+
+    @staticmethod
+    def from_arrays(arrays):
+        '''Packs a list of 1-d arrays'''
+        lengths = np.array([len(array) for array in arrays], dtype=np.int64)
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.concatenate(arrays).astype(np.float64) if len(arrays) > 0 else np.empty(0)
+        return PackedSeries(values, offsets)
+
+    @staticmethod
+    def from_frames(frames):
+        '''Packs the first column of each DataFrame'''
+        return PackedSeries.from_arrays([np.asarray(frame.iloc[:, 0], dtype=np.float64) for frame in frames])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, indices):
+        '''The collection of the series at the indices'''
+        indices = np.asarray(indices, dtype=np.intp)
+        starts = self.offsets[:-1][indices]
+        lengths = self.lengths()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of each value in the packed values
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return PackedSeries(self.values[positions], offsets)
+
+    def to_matrix(self, length):
+        '''Series as rows of a (series x length) matrix. Longer series are
+        truncated, and shorter ones padded with zeros.'''
+        lengths = self.lengths()
+        columns = np.arange(length)
+        mask = columns[np.newaxis, :] < lengths[:, np.newaxis]
+        result = np.zeros((len(self), length))
+        result[mask] = self.values[(self.offsets[:-1, np.newaxis] + columns[np.newaxis, :])[mask]]
+        return result
+
+    def save(self, filename):
+        '''Writes filename.values.npy and filename.offsets.npy. The offsets are
+        written last, so a collection is complete if its offsets exist.'''
+        for (suffix, array) in (('values', self.values), ('offsets', self.offsets)):
+            path = "%s.%s.npy" % (filename, suffix)
+            # Write to a temporary file first, other processes may be reading it
+            tmppath = "%s.%s.tmp.npy" % (path, uuid.uuid4().hex)
+            np.save(tmppath, array)
+            os.replace(tmppath, path)
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists("%s.offsets.npy" % filename)
+
+    @staticmethod
+    def load(filename):
+        return PackedSeries(np.load("%s.values.npy" % filename, mmap_mode='r'),
+                            np.load("%s.offsets.npy" % filename, mmap_mode='r'), filename)
+
+    def __getstate__(self):
+        if self.filename is not None:
+            return {'filename': self.filename}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'values' not in state:
+            state = PackedSeries.load(state['filename']).__dict__
+        self.__dict__.update(state)
@@ -33,6 +33,9 @@ class Core(crpc.CoreServicer):
         return session_response
 
     def EndSession(self, request, context):
+        session = Session.get(request.session_id)
+        if session is not None and session.controller is not None:
+            session.controller.shutdown()
         Session.delete(request.session_id)
         return self._create_response("Session ended")
 
@@ -192,8 +195,7 @@ class Core(crpc.CoreServicer):
             return self._create_response("Invalid pipeline id", code="INVALID_ARGUMENT")
 
         if request.pipeline_exec_uri is not None:
-            ex = session.controller.execution_helper
-            ex.create_pipeline_executable(pipeline, session.config)
+            session.controller.export_pipeline(pipeline, session.config)
             exefile = self._create_path_from_uri(request.pipeline_exec_uri)
             origfile = os.path.join(session.execdir, pipeline.id)
             shutil.copy(origfile, exefile)
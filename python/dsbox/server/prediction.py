@@ -0,0 +1,232 @@
+'''Long running prediction server for exported pipeline bundles'''
+
+import sys
+import json
+import time
+import queue
+import threading
+import traceback
+import socketserver
+
+from collections import deque, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from dsbox.executer.bundle import PipelineBundle
+from dsbox.executer.runtime import PipelineRuntime
+from dsbox.schema.dataset_schema import VariableFileType
+
+# Default time a request may wait for other requests to join its batch
+DEFAULT_LATENCY_BUDGET = 0.005
+DEFAULT_MAX_BATCH_ROWS = 4096
+# Number of recent requests used for the latency percentiles
+LATENCY_WINDOW = 10000
+# Media read from files of the dataset, which requests do not carry
+UNSUPPORTED_MEDIA_TYPES = (VariableFileType.IMAGE, VariableFileType.AUDIO, VariableFileType.VIDEO,
+                           VariableFileType.SPEECH, VariableFileType.TIMESERIES)
+
+
+class PredictionRequest(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.received = time.time()
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+
+
+class LatencyStats(object):
+    '''Latencies of the most recent requests'''
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.requests += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            requests = self.requests
+        if len(latencies) == 0:
+            return {'requests': requests}
+        p50, p90, p99 = np.percentile(latencies * 1000.0, [50, 90, 99])
+        return {'requests': requests, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99,
+                'mean_batch_requests': float(batch_sizes.mean())}
+
+
+class PipelineWorker(object):
+    """
+    Scores the requests for one pipeline bundle.
+
+    Requests arriving within the latency budget of the first waiting
+    request are combined into one batch (up to max_batch_rows rows), so
+    the pipeline runs once for many small concurrent requests. The rows
+    are cast to the dtypes of the training data.
+
+    Only pipelines of tabular and text data can be served: the image,
+    audio, video and time series pipelines read their inputs from the
+    files of the dataset, so their bundles are rejected.
+    """
+
+    def __init__(self, bundle_file, latency_budget=DEFAULT_LATENCY_BUDGET, max_batch_rows=DEFAULT_MAX_BATCH_ROWS):
+        self.bundle = PipelineBundle.load(bundle_file)
+        self.runtime = PipelineRuntime.from_manifest(self.bundle.manifest)
+        self.pipeline_id = self.bundle.pipeline_id
+        if self.runtime.media_type in UNSUPPORTED_MEDIA_TYPES:
+            raise ValueError("Cannot serve pipeline %s of %s data (%s): only tabular and text pipelines are supported"
+                             % (self.pipeline_id, self.runtime.media_type.value, bundle_file))
+        self.columns = [col['colName'] for col in self.runtime.input_columns]
+        self.latency_budget = latency_budget
+        self.max_batch_rows = max_batch_rows
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="predict-%s" % self.pipeline_id, daemon=True)
+        self.thread.start()
+
+    def predict(self, rows):
+        '''Blocks until the rows (a DataFrame) are scored. Returns the predictions'''
+        request = PredictionRequest(rows)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def stop(self):
+        self.requests.put(None)
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        nrows = len(first.rows)
+        deadline = first.received + self.latency_budget
+        while nrows < self.max_batch_rows:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Finish this batch, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+            nrows += len(request.rows)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                # Row positions keep requests apart, even if their indices overlap
+                testdata = pd.concat([request.rows for request in batch], ignore_index=True)
+                testdata = self.runtime.apply_dtypes(testdata[self.columns].copy())
+                predictions = self.runtime.predict(self.bundle, testdata)
+                start = 0
+                for request in batch:
+                    request.predictions = predictions.iloc[start:start + len(request.rows)]
+                    start += len(request.rows)
+            except Exception as e:
+                traceback.print_exc()
+                for request in batch:
+                    request.error = e
+            finished = time.time()
+            for request in batch:
+                request.done.set()
+            self.stats.add_batch([finished - request.received for request in batch])
+
+
+class PredictionServer(object):
+    """
+    Serves predictions for a set of pipeline bundles over a local socket.
+
+    The protocol is one JSON object per line. Requests:
+      {"pipeline_id": ..., "rows": [{column: value, ...}, ...], "index": [...]}
+      {"command": "stats"}
+      {"command": "pipelines"}
+    Prediction responses are {"pipeline_id": ..., "index": [...], "predictions": [...]},
+    and errors are {"error": message}. The row values are cast to the
+    dtypes of the training data (see PipelineRuntime.apply_dtypes).
+    Bundles of image, audio, video and time series pipelines cannot be
+    served (see PipelineWorker).
+    """
+
+    def __init__(self, bundle_files, latency_budget=DEFAULT_LATENCY_BUDGET, max_batch_rows=DEFAULT_MAX_BATCH_ROWS):
+        self.workers = OrderedDict()
+        for bundle_file in bundle_files:
+            print("Loading %s" % bundle_file)
+            worker = PipelineWorker(bundle_file, latency_budget, max_batch_rows)
+            self.workers[worker.pipeline_id] = worker
+        self.server = None
+
+    def handle(self, request):
+        command = request.get('command', None)
+        if command == 'stats':
+            return {'stats': dict((pid, worker.stats.summary()) for pid, worker in self.workers.items())}
+        elif command == 'pipelines':
+            return {'pipelines': [{'pipeline_id': pid, 'pipeline': worker.bundle.manifest.get('pipeline'),
+                                   'columns': worker.columns} for pid, worker in self.workers.items()]}
+        elif command is not None:
+            return {'error': "Unknown command %s" % command}
+
+        worker = self.workers.get(request.get('pipeline_id', None), None)
+        if worker is None:
+            return {'error': "Unknown pipeline %s" % request.get('pipeline_id', None)}
+        rows = pd.DataFrame(request['rows'])
+        index = request.get('index', list(range(len(rows))))
+        predictions = worker.predict(rows)
+        return {'pipeline_id': worker.pipeline_id, 'index': index,
+                'predictions': predictions.iloc[:, 0].tolist()}
+
+    def serve(self, host='127.0.0.1', port=45043):
+        prediction_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        response = prediction_server.handle(json.loads(line.decode('utf-8')))
+                    except Exception as e:
+                        sys.stderr.write("ERROR: prediction request: {}\n".format(e))
+                        response = {'error': str(e)}
+                    self.wfile.write((json.dumps(response, default=_to_json) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        print("Prediction server listening on %s:%d" % (host, port))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            for worker in self.workers.values():
+                worker.stop()
+
+    def stop(self):
+        '''Stops serve() running in another thread'''
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def _to_json(value):
+    '''Converts NumPy scalars in responses'''
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot serialize %s" % type(value))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import os.path
+
+# Setup Paths
+PARENTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PARENTDIR)
+
+from dsbox_dev_setup import path_setup
+path_setup()
+
+import argparse
+
+from dsbox.server.prediction import PredictionServer, DEFAULT_LATENCY_BUDGET, DEFAULT_MAX_BATCH_ROWS
+
+PORT = 45043
+
+def serve():
+    parser = argparse.ArgumentParser(description="Serve predictions of exported pipeline bundles")
+    parser.add_argument("bundles", nargs="+", help="Pipeline bundle files (temp/models/<pipeline id>.bundle)")
+    parser.add_argument("--host", dest="host", help="Address to listen on. [default: %(default)s]", default="127.0.0.1")
+    parser.add_argument("-p", "--port", dest="port", type=int, help="Port. [default: %(default)s]", default=PORT)
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float,
+                        help="Time a request may wait to be batched with others. [default: %(default)s]",
+                        default=DEFAULT_LATENCY_BUDGET * 1000)
+    parser.add_argument("--max-batch-rows", dest="max_batch_rows", type=int,
+                        help="Maximum rows in a batch. [default: %(default)s]", default=DEFAULT_MAX_BATCH_ROWS)
+    args = parser.parse_args()
+
+    server = PredictionServer(args.bundles, args.latency_ms / 1000.0, args.max_batch_rows)
+    try:
+        server.serve(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    serve()
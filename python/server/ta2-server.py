@@ -17,16 +17,12 @@ import numpy
 import argparse
 from concurrent import futures
 
-from dsbox.planner.common.resource_manager import ResourceManager
-from dsbox.planner.common.data_manager import RawResource
+from dsbox.executer.worker_pool import WorkerPool
 
 from dsbox.server.controller.core import Core
 from dsbox.server.controller.data_ext import DataExt
 from dsbox.server.controller.dataflow_ext import DataflowExt
 
-import multiprocessing
-from multiprocessing import Pool
-
 numpy.set_printoptions(threshold=numpy.nan)
 
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
@@ -39,8 +35,8 @@ def serve():
     parser.add_argument("-l", "--library", dest="library", help="Primitives library directory. [default: %(default)s]", default=DEFAULT_LIB_DIRECTORY)
     args = parser.parse_args()
 
-    ResourceManager.EXECUTION_POOL = Pool(multiprocessing.cpu_count())
-    RawResource.LOADING_POOL = Pool(multiprocessing.cpu_count())
+    # One pool of workers for loading, execution and all the sessions
+    WorkerPool.shared()
 
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
     library = args.library
@@ -57,6 +53,7 @@ def serve():
             time.sleep(_ONE_DAY_IN_SECONDS)
     except KeyboardInterrupt:
         server.stop(0)
+        WorkerPool.shutdown_shared()
 
 if __name__ == '__main__':
     serve()